@@ -85,6 +85,13 @@ def get_parser():
         help="Choice of kernel shape for the CNN. Segmentation with 3D kernels is slower than with 2D kernels.",
         choices=('2d', '3d'),
         default="2d")
+    optional.add_argument(
+        "-batch",
+        type=int,
+        help="Number of axial slices segmented at once with the 2D kernel. Larger values are faster but use more "
+             "memory. By default, it is set according to the available RAM.",
+        metavar=Metavar.int,
+        default=None)
     optional.add_argument(
         "-ofolder",
         metavar=Metavar.str,
@@ -167,6 +174,9 @@ def main():
         if threshold > 1.0 or (threshold < 0.0 and threshold != -1.0):
             raise SyntaxError("Threshold should be between 0 and 1, or equal to -1 (no threshold)")
 
+    if args.batch is not None and args.batch < 1:
+        raise SyntaxError("Batch size should be a strictly positive integer")
+
     remove_temp_files = args.r
     verbose = args.v
     sct.init_sct(log_level=verbose, update=True)  # Update log level
@@ -189,7 +199,8 @@ def main():
     im_seg, im_image_RPI_upsamp, im_seg_RPI_upsamp = \
         deep_segmentation_spinalcord(im_image.copy(), contrast_type, ctr_algo=ctr_algo,
                                      ctr_file=manual_centerline_fname, brain_bool=brain_bool, kernel_size=kernel_size,
-                                     threshold_seg=threshold, remove_temp_files=remove_temp_files, verbose=verbose)
+                                     threshold_seg=threshold, remove_temp_files=remove_temp_files, verbose=verbose,
+                                     batch_size=args.batch)
 
     # Save segmentation
     fname_seg = os.path.abspath(os.path.join(output_folder, sct.extract_fname(fname_image)[1] + '_seg' +
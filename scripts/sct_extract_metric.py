@@ -24,13 +24,13 @@ import sys
 import os
 import argparse
 
-import numpy as np
-
 from spinalcordtoolbox.metadata import read_label_file
 from spinalcordtoolbox.utils import parse_num_list
-from spinalcordtoolbox.aggregate_slicewise import check_labels, extract_metric, save_as_csv, Metric, LabelStruc
+from spinalcordtoolbox.aggregate_slicewise import check_labels, extract_metric, save_results, Metric, LabelStruc, \
+    PartialVolumeSolver
 import sct_utils as sct
-from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.image import Image, load_slab
+from spinalcordtoolbox.template import LabelStack, VertLevelIndex
 from spinalcordtoolbox.utils import Metavar, SmartFormatter, list_type
 
 # get path of the script and the toolbox
@@ -95,8 +95,12 @@ def get_parser():
     mandatory.add_argument(
         '-i',
         metavar=Metavar.file,
+        nargs='+',
         required=True,
-        help="Image file to extract metrics from. Example: FA.nii.gz"
+        help="R|Image file to extract metrics from. Example: FA.nii.gz\n"
+             "Several images in the same space can be listed (example: -i FA.nii.gz MD.nii.gz RD.nii.gz). The atlas, "
+             "vertebral levels and ML/MAP systems are then only computed once, and the results of all images are "
+             "written in the same output file (see column 'Filename')."
     )
 
     optional = parser.add_argument_group("\nOPTIONAL ARGUMENTS")
@@ -156,7 +160,9 @@ def get_parser():
         metavar=Metavar.file,
         default=param_default.fname_output,
         help="R|File name of the output result file collecting the metric estimation results. Include the '.csv' "
-             "file extension in the file name. Example: extract_metric.csv"
+             "file extension in the file name. Example: extract_metric.csv\n"
+             "If the extension is '.db' or '.sqlite', results are saved in a SQLite database, which can be safely "
+             "written by several processes at the same time (e.g. with sct_run_batch)."
     )
     optional.add_argument(
         '-output-map',
@@ -254,15 +260,27 @@ def get_parser():
         default='0',
         help='Whether to discard voxels with negative value when computing metrics statistics. 0 = no, 1 = yes'
     )
+    advanced.add_argument(
+        '-quantize-labels',
+        type=int,
+        choices=(0, 1),
+        default=0,
+        help="R|Whether to store atlas labels with 8 bits (256 values between 0 and the maximum of each label) to "
+             "reduce memory usage. 0 = no, 1 = yes.\n"
+             "Labels are cropped around their non-null voxels in any case. To share loaded labels across processes "
+             "(e.g. with sct_run_batch), set the environment variable SCT_ATLAS_CACHE to a cache folder.\n"
+             "Note: with -method ml or map, every estimation uses all labels, so the full atlas is expanded once in "
+             "memory (as float32 if quantized): the memory saving then mostly applies to the cache and to loading."
+    )
 
     return parser
 
 
 def main(fname_data, path_label, method, slices, levels, fname_output, labels_user, append_csv,
-         fname_vertebral_labeling="", perslice=1, perlevel=1, verbose=1, combine_labels=True):
+         fname_vertebral_labeling="", perslice=1, perlevel=1, verbose=1, combine_labels=True, quantize_labels=False):
     """
     Extract metrics from MRI data based on mask (could be single file of folder to atlas)
-    :param fname_data: data to extract metric from
+    :param fname_data: data to extract metric from, or list of data sharing the same space
     :param path_label: mask: could be single file or folder to atlas (which contains info_label.txt)
     :param method {'wa', 'bin', 'ml', 'map'}
     :param slices. Slices of interest. Accepted format:
@@ -281,6 +299,7 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
            instead of a single average output.
     :param verbose
     :param combine_labels: bool: Combine labels into a single value
+    :param quantize_labels: bool: Quantize atlas labels to 8 bits to reduce memory usage
     :return:
     """
 
@@ -338,30 +357,39 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
     labels_id_user = check_labels(indiv_labels_ids + combined_labels_ids, parse_num_list(labels_user))
     nb_labels = len(indiv_labels_files)
 
+    if not isinstance(fname_data, (list, tuple)):
+        fname_data = [fname_data]
+
+    # Load vertebral levels, and index them once for all labels
+    if levels:
+        vert_level_index = VertLevelIndex(Image(fname_vertebral_labeling).change_orientation("RPI"))
+        # Only the slab of slices of the selected levels is read from the data and labels
+        slices_levels = [iz for level in levels for iz in vert_level_index.get_slices(level)]
+        slab = (min(slices_levels), max(slices_levels) + 1) if slices_levels else None
+    else:
+        vert_level_index = None
+        slab = None
+    z_offset = slab[0] if slab is not None else 0
+
     # Load data and systematically reorient to RPI because we need the 3rd dimension to be z
     sct.printv('\nLoad metric image...', verbose)
-    input_im = Image(fname_data).change_orientation("RPI")
-
-    data = Metric(data=input_im.data, label='')
-    # Load labels
-    labels_tmp = np.empty([nb_labels], dtype=object)
-    for i_label in range(nb_labels):
-        im_label = Image(os.path.join(path_label, indiv_labels_files[i_label])).change_orientation("RPI")
-        labels_tmp[i_label] = np.expand_dims(im_label.data, 3)  # TODO: generalize to 2D input label
-    labels = np.concatenate(labels_tmp[:], 3)  # labels: (x,y,z,label)
-    # Load vertebral levels
-    if vertebral_levels:
-        im_vertebral_labeling = Image(fname_vertebral_labeling).change_orientation("RPI")
+    if slab is None:
+        data = [Metric(data=Image(fname).change_orientation("RPI").data, label='') for fname in fname_data]
     else:
-        im_vertebral_labeling = None
+        sct.printv('  Only loading slices {}:{}'.format(slab[0], slab[1] - 1), verbose)
+        data = [Metric(data=load_slab(fname, slab[0], slab[1], orientation="RPI").data, label='')
+                for fname in fname_data]
+    # Labels: (x,y,z,label). Label files are only read when needed by the estimation.
+    labels = LabelStack([os.path.join(path_label, indiv_labels_files[i_label]) for i_label in range(nb_labels)],
+                        quantize=quantize_labels, slab=slab)
 
     # Get dimensions of data and labels
-    nx, ny, nz = data.data.shape
     nx_atlas, ny_atlas, nz_atlas, nt_atlas = labels.shape
 
     # Check dimensions consistency between atlas and data
-    if (nx, ny, nz) != (nx_atlas, ny_atlas, nz_atlas):
-        sct.printv('\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.', 1, type='error')
+    for fname, metric in zip(fname_data, data):
+        if metric.data.shape != (nx_atlas, ny_atlas, nz_atlas):
+            sct.printv('\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS: ' + fname, 1, type='error')
 
     # Combine individual labels for estimation
     if combine_labels:
@@ -370,14 +398,18 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
                                      map_cluster=None)
         labels_id_user = [99]
 
+    # ML/MAP systems are shared by all metrics (and labels)
+    solver = PartialVolumeSolver()
     for id_label in labels_id_user:
         sct.printv('Estimation for label: '+label_struc[id_label].name, verbose)
-        agg_metric = extract_metric(data, labels=labels, slices=slices, levels=levels, perslice=perslice,
-                                    perlevel=perlevel, vert_level=im_vertebral_labeling, method=method,
-                                    label_struc=label_struc, id_label=id_label, indiv_labels_ids=indiv_labels_ids)
-
-        save_as_csv(agg_metric, fname_output, fname_in=fname_data, append=append_csv)
-        append_csv = True  # when looping across labels, need to append results in the same file
+        list_agg_metric = extract_metric(data, labels=labels, slices=slices, levels=levels, perslice=perslice,
+                                         perlevel=perlevel, vert_level=vert_level_index, method=method,
+                                         label_struc=label_struc, id_label=id_label,
+                                         indiv_labels_ids=indiv_labels_ids, solver=solver, z_offset=z_offset)
+
+        for fname, agg_metric in zip(fname_data, list_agg_metric):
+            save_results(agg_metric, fname_output, fname_in=fname, append=append_csv)
+            append_csv = True  # when looping across labels and metrics, need to append results in the same file
     sct.display_open(fname_output)
 
 
@@ -391,7 +423,7 @@ if __name__ == "__main__":
     arguments = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
 
     overwrite = 0  # TODO: Not used. Why?
-    fname_data = sct.get_absolute_path(arguments.i)
+    fname_data = [sct.get_absolute_path(fname) for fname in arguments.i]
     path_label = arguments.f
     method = arguments.method
     fname_output = arguments.o
@@ -410,6 +442,7 @@ if __name__ == "__main__":
     fname_output_metric_map = arguments.output_map  # TODO: Not used. Why?
     fname_mask_weight = arguments.mask_weighted  # TODO: Not used. Why?
     discard_negative_values = int(arguments.discard_neg_val)  # TODO: Not used. Why?
+    quantize_labels = bool(arguments.quantize_labels)
     verbose = int(arguments.v)
     sct.init_sct(log_level=verbose, update=True)  # Update log level
 
@@ -417,4 +450,4 @@ if __name__ == "__main__":
     main(fname_data=fname_data, path_label=path_label, method=method, slices=parse_num_list(slices_of_interest),
          levels=parse_num_list(vertebral_levels), fname_output=fname_output, labels_user=labels_user,
          append_csv=append_csv, fname_vertebral_labeling=fname_vertebral_labeling, perslice=perslice,
-         perlevel=perlevel, verbose=verbose, combine_labels=combine_labels)
+         perlevel=perlevel, verbose=verbose, combine_labels=combine_labels, quantize_labels=quantize_labels)
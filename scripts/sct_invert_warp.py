@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Invert a warping field.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2020 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import absolute_import, division
+
+import sys
+import os
+import argparse
+
+import sct_utils as sct
+from spinalcordtoolbox.utils import Metavar, SmartFormatter
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.registration.warp import invert_warp
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Invert a warping field (ITK/ANTs displacement field) using fixed-point iteration. This is useful '
+                    'to generate the inverse transformation on demand (e.g. warp_straight2curve from '
+                    'warp_curve2straight) when only one direction was computed.',
+        add_help=None,
+        formatter_class=SmartFormatter,
+        prog=os.path.splitext(os.path.basename(__file__))[0])
+
+    mandatoryArguments = parser.add_argument_group("\nMANDATORY ARGUMENTS")
+    mandatoryArguments.add_argument(
+        '-i',
+        required=True,
+        help='Warping field to invert. Example: warp_curve2straight.nii.gz',
+        metavar=Metavar.file,
+    )
+
+    optional = parser.add_argument_group("\nOPTIONAL ARGUMENTS")
+    optional.add_argument(
+        '-d',
+        help='Destination image, defining the grid of the inverse warping field. This is typically the source image '
+             'of the input warping field. By default, the grid of the input warping field is used.',
+        metavar=Metavar.file,
+    )
+    optional.add_argument(
+        '-iter',
+        type=int,
+        help='Maximum number of fixed-point iterations.',
+        metavar=Metavar.int,
+        default=20,
+    )
+    optional.add_argument(
+        '-tol',
+        type=float,
+        help='Convergence tolerance, in mm.',
+        metavar=Metavar.float,
+        default=0.01,
+    )
+    optional.add_argument(
+        '-chunk',
+        type=int,
+        help='Number of slices processed at once. Decrease this value to reduce memory usage.',
+        metavar=Metavar.int,
+        default=8,
+    )
+    optional.add_argument(
+        '-o',
+        help='Path to output file.',
+        metavar=Metavar.str,
+        default=os.path.join('.', 'warp_inverse.nii.gz')
+    )
+    optional.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        help="Show this help message and exit"
+    )
+    optional.add_argument(
+        '-v',
+        type=int,
+        choices=(0, 1, 2),
+        help='Verbose: 0 = nothing, 1 = classic, 2 = expended',
+        default=1
+    )
+    return parser
+
+
+def main(args=None):
+    # Check input parameters
+    parser = get_parser()
+    if args is None:
+        args = None if sys.argv[1:] else ['--help']
+    arguments = parser.parse_args(args=args)
+    verbose = arguments.v
+    sct.init_sct(log_level=verbose, update=True)  # Update log level
+
+    im_ref = Image(arguments.d) if arguments.d is not None else None
+
+    sct.printv('\nInvert warping field...', verbose)
+    im_inv = invert_warp(Image(arguments.i), im_ref=im_ref, max_iter=arguments.iter, tolerance=arguments.tol,
+                         chunk_size=arguments.chunk, verbose=verbose)
+    im_inv.save(arguments.o, dtype='float32')
+
+    sct.display_viewer_syntax([arguments.o], verbose=verbose)
+
+
+if __name__ == "__main__":
+    sct.init_sct()
+    main()
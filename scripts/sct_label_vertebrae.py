@@ -23,6 +23,7 @@ from spinalcordtoolbox.vertebrae.core import create_label_z, get_z_and_disc_valu
 from spinalcordtoolbox.vertebrae.detect_c2c3 import detect_c2c3
 from spinalcordtoolbox.reports.qc import generate_qc
 from spinalcordtoolbox.math import dilate
+from spinalcordtoolbox.straightening import StraighteningCache, get_straightening_params
 
 from sct_label_utils import ProcessLabels
 # TODO: Properly test when first PR (that includes list_type) gets merged
@@ -287,26 +288,25 @@ def main(args=None):
     # Straighten spinal cord
     sct.printv('\nStraighten spinal cord...', verbose)
     # check if warp_curve2straight and warp_straight2curve already exist (i.e. no need to do it another time)
-    cache_sig = sct.cache_signature(
-     input_files=[fname_in, fname_seg],
-    )
-    cachefile = os.path.join(curdir, "straightening.cache")
-    if sct.cache_valid(cachefile, cache_sig) and os.path.isfile(os.path.join(curdir, "warp_curve2straight.nii.gz")) and os.path.isfile(os.path.join(curdir, "warp_straight2curve.nii.gz")) and os.path.isfile(os.path.join(curdir, "straight_ref.nii.gz")):
-        # if they exist, copy them into current folder
+    args_straighten = [
+        '-i', 'data.nii',
+        '-s', 'segmentation.nii',
+        '-r', str(remove_temp_files),
+        '-v', str(verbose),
+    ]
+    cache = StraighteningCache()
+    sc_straight = sct_straighten_spinalcord.get_straightener(
+        sct_straighten_spinalcord.get_parser().parse_args(args_straighten))
+    cache_key = cache.key('segmentation.nii', params=get_straightening_params(sc_straight))
+    if cache.fetch(cache_key):
         sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
-        sct.copy(os.path.join(curdir, "warp_curve2straight.nii.gz"), 'warp_curve2straight.nii.gz')
-        sct.copy(os.path.join(curdir, "warp_straight2curve.nii.gz"), 'warp_straight2curve.nii.gz')
-        sct.copy(os.path.join(curdir, "straight_ref.nii.gz"), 'straight_ref.nii.gz')
         # apply straightening
         s, o = sct.run(['sct_apply_transfo', '-i', 'data.nii', '-w', 'warp_curve2straight.nii.gz', '-d', 'straight_ref.nii.gz', '-o', 'data_straight.nii'])
+        # the straight reference of the cached entry might come from another image
+        Image('data_straight.nii').save('straight_ref.nii.gz')
     else:
-        sct_straighten_spinalcord.main(args=[
-            '-i', 'data.nii',
-            '-s', 'segmentation.nii',
-            '-r', str(remove_temp_files),
-            '-v', str(verbose),
-        ])
-        sct.cache_save(cachefile, cache_sig)
+        sct_straighten_spinalcord.main(args=args_straighten)
+        cache.store(cache_key)
 
     # resample to 0.5mm isotropic to match template resolution
     sct.printv('\nResample to 0.5mm isotropic...', verbose)
@@ -28,10 +28,12 @@ import sct_utils as sct
 # TODO: Properly test when first PR (that includes list_type) gets merged
 from spinalcordtoolbox.utils import Metavar, SmartFormatter, ActionCreateFolder, list_type
 from spinalcordtoolbox import process_seg
-from spinalcordtoolbox.aggregate_slicewise import aggregate_per_slice_or_level, save_as_csv, func_wa, func_std, \
+from spinalcordtoolbox.aggregate_slicewise import aggregate_per_slice_or_level, save_results, func_wa, func_std, \
     func_sum, _merge_dict
 from spinalcordtoolbox.utils import parse_num_list
 from spinalcordtoolbox.centerline.core import ParamCenterline
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.template import VertLevelIndex
 from spinalcordtoolbox.reports.qc import generate_qc
 
 
@@ -82,7 +84,9 @@ def get_parser():
     optional.add_argument(
         '-o',
         metavar=Metavar.file,
-        help="Output file name (add extension). Default: csa.csv."
+        help="Output file name (add extension). Default: csa.csv. If the extension is '.db' or '.sqlite', results are "
+             "saved in a SQLite database, which can be safely written by several processes at the same time (e.g. "
+             "with sct_run_batch)."
     )
     optional.add_argument(
         '-append',
@@ -154,6 +158,14 @@ def get_parser():
         default=30,
         help="Degree of smoothing for centerline fitting. Only use with -centerline-algo {bspline, linear}."
     )
+    optional.add_argument(
+        '-jobs',
+        metavar=Metavar.int,
+        type=int,
+        default=1,
+        help="Number of processes used to compute the morphometrics across slices. Set to 0 to use all available "
+             "cores, or to a negative integer to use all available cores minus that number."
+    )
     optional.add_argument(
         '-qc',
         metavar=Metavar.folder,
@@ -323,22 +335,25 @@ def main(args=None):
     metrics, fit_results = process_seg.compute_shape(fname_segmentation,
                                                      angle_correction=angle_correction,
                                                      param_centerline=param_centerline,
-                                                     verbose=verbose)
+                                                     verbose=verbose,
+                                                     n_jobs=arguments.jobs)
+    # Index the vertebral labeling once for all metrics
+    vert_level_index = VertLevelIndex(Image(fname_vert_levels).change_orientation('RPI')) if vert_levels else None
     for key in metrics:
         if key == 'length':
             # For computing cord length, slice-wise length needs to be summed across slices
             metrics_agg[key] = aggregate_per_slice_or_level(metrics[key], slices=parse_num_list(slices),
                                                             levels=parse_num_list(vert_levels), perslice=perslice,
-                                                            perlevel=perlevel, vert_level=fname_vert_levels,
+                                                            perlevel=perlevel, vert_level=vert_level_index,
                                                             group_funcs=(('SUM', func_sum),))
         else:
             # For other metrics, we compute the average and standard deviation across slices
             metrics_agg[key] = aggregate_per_slice_or_level(metrics[key], slices=parse_num_list(slices),
                                                             levels=parse_num_list(vert_levels), perslice=perslice,
-                                                            perlevel=perlevel, vert_level=fname_vert_levels,
+                                                            perlevel=perlevel, vert_level=vert_level_index,
                                                             group_funcs=group_funcs)
     metrics_agg_merged = _merge_dict(metrics_agg)
-    save_as_csv(metrics_agg_merged, file_out, fname_in=fname_segmentation, append=append)
+    save_results(metrics_agg_merged, file_out, fname_in=fname_segmentation, append=append, subject=qc_subject)
 
     # QC report (only show CSA for clarity)
     if path_qc is not None:
@@ -30,6 +30,7 @@ from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.centerline.core import ParamCenterline, get_centerline
 from spinalcordtoolbox.reports.qc import generate_qc
 from spinalcordtoolbox.resampling import resample_file
+from spinalcordtoolbox.straightening import StraighteningCache, get_straightening_params
 from spinalcordtoolbox.math import dilate
 from spinalcordtoolbox.registration.register import *
 from spinalcordtoolbox.registration.landmarks import *
@@ -500,50 +501,43 @@ def main(args=None):
         sct.printv('\nStraighten the spinal cord using centerline/segmentation...', verbose)
 
         # check if warp_curve2straight and warp_straight2curve already exist (i.e. no need to do it another time)
-        fn_warp_curve2straight = os.path.join(curdir, "warp_curve2straight.nii.gz")
-        fn_warp_straight2curve = os.path.join(curdir, "warp_straight2curve.nii.gz")
-        fn_straight_ref = os.path.join(curdir, "straight_ref.nii.gz")
-
-        cache_input_files = [ftmp_seg]
+        cache_input_files = []
         if level_alignment:
             cache_input_files += [
              ftmp_template_seg,
              ftmp_label,
              ftmp_template_label,
             ]
-        cache_sig = sct.cache_signature(
-         input_files=cache_input_files,
-        )
-        cachefile = os.path.join(curdir, "straightening.cache")
-        if sct.cache_valid(cachefile, cache_sig) and os.path.isfile(fn_warp_curve2straight) and os.path.isfile(fn_warp_straight2curve) and os.path.isfile(fn_straight_ref):
+        from spinalcordtoolbox.straightening import SpinalCordStraightener
+        sc_straight = SpinalCordStraightener(ftmp_seg, ftmp_seg)
+        sc_straight.param_centerline = param_centerline
+        sc_straight.output_filename = add_suffix(ftmp_seg, '_straight')
+        sc_straight.path_output = './'
+        sc_straight.qc = '0'
+        sc_straight.remove_temp_files = param.remove_temp_files
+        sc_straight.verbose = verbose
+
+        if level_alignment:
+            sc_straight.centerline_reference_filename = ftmp_template_seg
+            sc_straight.use_straight_reference = True
+            sc_straight.discs_input_filename = ftmp_label
+            sc_straight.discs_ref_filename = ftmp_template_label
+
+        cache = StraighteningCache()
+        cache_key = cache.key(ftmp_seg, params=get_straightening_params(sc_straight), fnames_extra=cache_input_files)
+        if cache.fetch(cache_key):
             sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
-            sct.copy(fn_warp_curve2straight, 'warp_curve2straight.nii.gz')
-            sct.copy(fn_warp_straight2curve, 'warp_straight2curve.nii.gz')
-            sct.copy(fn_straight_ref, 'straight_ref.nii.gz')
             # apply straightening
             sct_apply_transfo.main(args=[
                 '-i', ftmp_seg,
                 '-w', 'warp_curve2straight.nii.gz',
                 '-d', 'straight_ref.nii.gz',
                 '-o', add_suffix(ftmp_seg, '_straight')])
+            # the straight reference of the cached entry might come from another image
+            Image(add_suffix(ftmp_seg, '_straight')).save('straight_ref.nii.gz')
         else:
-            from spinalcordtoolbox.straightening import SpinalCordStraightener
-            sc_straight = SpinalCordStraightener(ftmp_seg, ftmp_seg)
-            sc_straight.param_centerline = param_centerline
-            sc_straight.output_filename = add_suffix(ftmp_seg, '_straight')
-            sc_straight.path_output = './'
-            sc_straight.qc = '0'
-            sc_straight.remove_temp_files = param.remove_temp_files
-            sc_straight.verbose = verbose
-
-            if level_alignment:
-                sc_straight.centerline_reference_filename = ftmp_template_seg
-                sc_straight.use_straight_reference = True
-                sc_straight.discs_input_filename = ftmp_label
-                sc_straight.discs_ref_filename = ftmp_template_label
-
             sc_straight.straighten()
-            sct.cache_save(cachefile, cache_sig)
+            cache.store(cache_key)
 
         # N.B. DO NOT UPDATE VARIABLE ftmp_seg BECAUSE TEMPORARY USED LATER
         # re-define warping field using non-cropped space (to avoid issue #367)
@@ -24,6 +24,8 @@ import numpy as np
 import sct_utils as sct
 import sct_maths
 import spinalcordtoolbox.image as msct_image
+from spinalcordtoolbox.straightening import StraighteningCache, get_straightening_params
+from sct_straighten_spinalcord import get_straightener, get_parser as get_parser_straighten
 from sct_convert import convert
 # TODO: Properly test when first PR (that includes list_type) gets merged
 from spinalcordtoolbox.utils import Metavar, SmartFormatter, list_type
@@ -192,23 +194,19 @@ def main(args=None):
     # Straighten the spinal cord
     # straighten segmentation
     sct.printv('\nStraighten the spinal cord using centerline/segmentation...', verbose)
-    cache_sig = sct.cache_signature(input_files=[fname_anat_rpi, fname_centerline_rpi],
-                                    input_params={"x": "spline"})
-    cachefile = os.path.join(curdir, "straightening.cache")
-    if sct.cache_valid(cachefile, cache_sig) and os.path.isfile(os.path.join(curdir, 'warp_curve2straight.nii.gz')) and os.path.isfile(os.path.join(curdir, 'warp_straight2curve.nii.gz')) and os.path.isfile(os.path.join(curdir, 'straight_ref.nii.gz')):
-        # if they exist, copy them into current folder
+    args_straighten = ['-i', fname_anat_rpi, '-o', 'anat_rpi_straight.nii', '-s', fname_centerline_rpi, '-x', 'spline',
+                       '-param', 'algo_fitting='+param.algo_fitting]
+    cache = StraighteningCache()
+    params_straighten = get_straightening_params(get_straightener(get_parser_straighten().parse_args(args_straighten)))
+    params_straighten['algo_fitting'] = param.algo_fitting
+    cache_key = cache.key(fname_centerline_rpi, params=params_straighten)
+    if cache.fetch(cache_key):
         sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
-        sct.copy(os.path.join(curdir, 'warp_curve2straight.nii.gz'), 'warp_curve2straight.nii.gz')
-        sct.copy(os.path.join(curdir, 'warp_straight2curve.nii.gz'), 'warp_straight2curve.nii.gz')
-        sct.copy(os.path.join(curdir, 'straight_ref.nii.gz'), 'straight_ref.nii.gz')
         # apply straightening
         sct.run(['sct_apply_transfo', '-i', fname_anat_rpi, '-w', 'warp_curve2straight.nii.gz', '-d', 'straight_ref.nii.gz', '-o', 'anat_rpi_straight.nii', '-x', 'spline'], verbose)
     else:
-        sct.run(['sct_straighten_spinalcord', '-i', fname_anat_rpi, '-o', 'anat_rpi_straight.nii', '-s', fname_centerline_rpi, '-x', 'spline', '-param', 'algo_fitting='+param.algo_fitting], verbose)
-        sct.cache_save(cachefile, cache_sig)
-        # move warping fields locally (to use caching next time)
-        sct.copy('warp_curve2straight.nii.gz', os.path.join(curdir, 'warp_curve2straight.nii.gz'))
-        sct.copy('warp_straight2curve.nii.gz', os.path.join(curdir, 'warp_straight2curve.nii.gz'))
+        sct.run(['sct_straighten_spinalcord'] + args_straighten, verbose)
+        cache.store(cache_key)
 
     # Smooth the straightened image along z
     sct.printv('\nSmooth the straightened image...')
@@ -196,17 +196,12 @@ def get_parser():
 
 # MAIN
 # ==========================================================================================
-def main(args=None):
+def get_straightener(arguments):
     """
-    Main function
-    :param args:
-    :return:
+    Configure a straightener from parsed command-line arguments
+    :param arguments: argparse.Namespace: output of get_parser().parse_args()
+    :return: SpinalCordStraightener
     """
-    # Get parser args
-    if args is None:
-        args = None if sys.argv[1:] else ['--help']
-    parser = get_parser()
-    arguments = parser.parse_args(args=args)
     input_filename = arguments.i
     centerline_file = arguments.s
 
@@ -234,10 +229,6 @@ def main(args=None):
     sc_straight.interpolation_warp = arguments.x
     sc_straight.output_filename = arguments.o
     sc_straight.path_output = arguments.ofolder
-    path_qc = arguments.qc
-    verbose = arguments.v
-    sct.init_sct(log_level=verbose, update=True)  # Update log level
-    sc_straight.verbose = verbose
 
     # if "-cpu-nb" in arguments:
     #     sc_straight.cpu_number = arguments.cpu-nb)
@@ -269,6 +260,27 @@ def main(args=None):
             if param_split[0] == 'template_orientation':
                 sc_straight.template_orientation = int(param_split[1])
 
+    return sc_straight
+
+
+def main(args=None):
+    """
+    Main function
+    :param args:
+    :return:
+    """
+    # Get parser args
+    if args is None:
+        args = None if sys.argv[1:] else ['--help']
+    parser = get_parser()
+    arguments = parser.parse_args(args=args)
+    path_qc = arguments.qc
+    verbose = arguments.v
+    sct.init_sct(log_level=verbose, update=True)  # Update log level
+
+    sc_straight = get_straightener(arguments)
+    sc_straight.verbose = verbose
+
     fname_straight = sc_straight.straighten()
 
     sct.printv("\nFinished! Elapsed time: {} s".format(sc_straight.elapsed_time), verbose)
@@ -430,6 +430,7 @@ def get_functions_parallelizable():
         'sct_fmri_moco',
         'sct_get_centerline',
         'sct_image',
+        'sct_invert_warp',
         'sct_label_utils',
         'sct_label_vertebrae',
         'sct_maths',
@@ -15,7 +15,7 @@
 
 from __future__ import print_function, division, absolute_import
 
-import sys, io, os, re, time, datetime, platform
+import sys, os, re, time, datetime, platform
 import errno
 import logging
 import shutil
@@ -1199,70 +1199,3 @@ class RunError(Error):
     sct runtime error
     """
     pass
-
-
-def cache_signature(input_files=[], input_data=[], input_params={}):
-    """
-    Create a signature to be used for caching purposes
-
-    :param input_files: paths of input files (that can influence output)
-    :param input_data: input data (that can influence output)
-    :param input_params: input parameters (that can influence output)
-
-    Notes:
-
-    - Use this with cache_valid (to validate caching assumptions)
-      and cache_save (to store them)
-
-    - Using this system, the outputs are not checked, only the
-      inputs and parameters (to regenerate the outputs in case
-      these change).
-      If the outputs have been modified directly, then they may
-      be reused.
-      To prevent that, the next step would be to record the outputs
-      signature in the cache file, so as to also verify them prior
-      to taking a shortcut.
-
-    """
-    import hashlib
-    h = hashlib.md5()
-    for path in input_files:
-        with io.open(path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                h.update(chunk)
-    for data in input_data:
-        h.update(str(type(data)))
-        try:
-            h.update(data)
-        except:
-            h.update(str(data))
-    for k, v in sorted(input_params.items()):
-        h.update(str(type(k)).encode('utf-8'))
-        h.update(str(k).encode('utf-8'))
-        h.update(str(type(v)).encode('utf-8'))
-        h.update(str(v).encode('utf-8'))
-
-    return "# Cache file generated by SCT\nDEPENDENCIES_SIG={}\n".format(h.hexdigest()).encode()
-
-
-def cache_valid(cachefile, sig_expected):
-    """
-    Verify that the cachefile contains the right signature
-    """
-    if not os.path.exists(cachefile):
-        return False
-    with io.open(cachefile, "rb") as f:
-        sig_measured = f.read()
-    return sig_measured == sig_expected
-
-
-def cache_save(cachefile, sig):
-    """
-    Save signature to cachefile
-
-    :param cachefile: path to cache file to be saved
-    :param sig: cache signature created with cache_signature()
-    """
-    with io.open(cachefile, "wb") as f:
-        f.write(sig)
-
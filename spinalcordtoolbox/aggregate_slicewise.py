@@ -14,8 +14,10 @@ import functools
 import csv
 import datetime
 import logging
+import sqlite3
+from collections import OrderedDict
 
-from spinalcordtoolbox.template import get_slices_from_vertebral_levels, get_vertebral_level_from_slice
+from spinalcordtoolbox.template import LabelStack, VertLevelIndex
 from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.utils import __version__, parse_num_list_inv
 
@@ -77,7 +79,7 @@ def func_map(data, mask, map_clusters):
     Compute maximum a posteriori (MAP) by aggregating the last dimension of mask according to a clustering method
     defined by map_clusters
 
-    :param data: nd-array: input data
+    :param data: nd-array: input data. To estimate several metrics at once, add a last dimension of size n_metrics.
     :param mask: (n+1)d-array: input mask. Note: this mask should include ALL labels to satisfy the necessary condition for\
     ML-based estimation, i.e., at each voxel, the sum of all labels (across the last dimension) equals the probability\
     to be inside the tissue. For example, for a pixel within the spinal cord, the sum of all labels should be 1.
@@ -86,6 +88,17 @@ def func_map(data, mask, map_clusters):
     :return: float: beta corresponding to the first label (beta[0])
     :return: nd-array: matrix of all beta
     """
+    return _estimate_map(data, mask, map_clusters, _pinv_normal_map, _pinv_normal)
+
+
+def _estimate_map(data, mask, map_clusters, pinv_normal, pinv_normal_clusters):
+    """
+    See func_map().
+
+    :param pinv_normal: function computing the pseudo-inverse of (Xt . X + 1) from the design matrix X.
+    :param pinv_normal_clusters: function computing the pseudo-inverse of Xt . X from the design matrix X of the\
+    clusters (ML estimation of beta_0).
+    """
     # Check number of labels and map_clusters
     assert mask.shape[-1] == len(map_clusters)
 
@@ -129,7 +142,7 @@ def func_map(data, mask, map_clusters):
     mask_clusters = np.concatenate(mask_l, axis=(mask.ndim-1))
 
     # Run ML estimation for each clustered labels
-    _, beta_cluster = func_ml(data, mask_clusters)
+    _, beta_cluster = _estimate_ml(data, mask_clusters, pinv_normal_clusters)
 
     # MAP estimation:
     #   y [nb_vox x 1]: measurements vector (to which weights are applied)
@@ -138,11 +151,11 @@ def func_map(data, mask, map_clusters):
     #   beta [nb_labels] = beta_0 + (Xt . X + 1)^(-1) . Xt . (y - X . beta_0): The estimated metric value in each label
     #
     # Note: for simplicity we consider that sigma_noise = sigma_label
-    n_vox = functools.reduce(operator.mul, data.shape, 1)
-    y = np.reshape(data, n_vox)
+    n_vox = functools.reduce(operator.mul, mask.shape[:-1], 1)
+    y = _reshape_measurements(data, mask)
     x = np.reshape(mask, (n_vox, mask.shape[mask.ndim-1]))
-    beta_0 = [beta_cluster[id_clusters[i_label]] for i_label in range(mask.shape[-1])]
-    beta = beta_0 + np.dot(np.linalg.pinv(np.dot(x.T, x) + np.diag(np.ones(mask.shape[-1]))),
+    beta_0 = np.asarray(beta_cluster)[id_clusters]
+    beta = beta_0 + np.dot(pinv_normal(x),
                            np.dot(x.T,
                                   (y - np.dot(x, beta_0))))
     return beta[0], beta
@@ -152,26 +165,104 @@ def func_ml(data, mask, map_clusters=None):
     """
     Compute maximum likelihood (ML) for the first label of mask.
 
-    :param data: nd-array: input data
+    :param data: nd-array: input data. To estimate several metrics at once, add a last dimension of size n_metrics.
     :param mask: (n+1)d-array: input mask. Note: this mask should include ALL labels to satisfy the necessary condition\
     for ML-based estimation, i.e., at each voxel, the sum of all labels (across the last dimension) equals the\
     probability to be inside the tissue. For example, for a pixel within the spinal cord, the sum of all labels should\
     be 1.
     :return: float: beta corresponding to the first label
     """
+    return _estimate_ml(data, mask, _pinv_normal)
+
+
+def _estimate_ml(data, mask, pinv_normal):
+    """
+    See func_ml().
+
+    :param pinv_normal: function computing the pseudo-inverse of Xt . X from the design matrix X.
+    """
     # TODO: support weighted least square
     # reshape as 1d vector (for data) and 2d vector (for mask)
-    n_vox = functools.reduce(operator.mul, data.shape, 1)
+    n_vox = functools.reduce(operator.mul, mask.shape[:-1], 1)
     # ML estimation:
     #   y: measurements vector (to which weights are applied)
     #   x: linear relation between the measurements y
     #   beta [nb_labels] = (Xt . X)^(-1) . Xt . y: The estimated metric value in each label
-    y = np.reshape(data, n_vox)  # [nb_vox x 1]
+    y = _reshape_measurements(data, mask)  # [nb_vox x 1]
     x = np.reshape(mask, (n_vox, mask.shape[mask.ndim-1]))
-    beta = np.dot(np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y))
+    beta = np.dot(pinv_normal(x), np.dot(x.T, y))
     return beta[0], beta
 
 
+def _pinv_normal(x):
+    """Pseudo-inverse of Xt . X (ML estimation)"""
+    return np.linalg.pinv(np.dot(x.T, x))
+
+
+def _pinv_normal_map(x):
+    """Pseudo-inverse of Xt . X + 1 (MAP estimation)"""
+    return np.linalg.pinv(np.dot(x.T, x) + np.diag(np.ones(x.shape[1])))
+
+
+def _reshape_measurements(data, mask):
+    """
+    Reshape data as a vector [nb_vox], or as a matrix [nb_vox x n_metrics] if data has an additional last dimension\
+    compared to the voxel dimensions of mask.
+    """
+    n_vox = functools.reduce(operator.mul, mask.shape[:-1], 1)
+    if data.shape == mask.shape[:-1]:
+        return np.reshape(data, n_vox)
+    return np.reshape(data, (n_vox, -1))
+
+
+class PartialVolumeSolver(object):
+    """
+    ML and MAP estimation (see func_ml() and func_map()) which computes the pseudo-inverse of each design matrix only\
+    once. Pseudo-inverses are cached by mask and slice group (argument key of ml() and map()), so that a cached\
+    pseudo-inverse is used without computing Xt . X again. aggregate_per_slice_or_level() passes the key when the\
+    design matrix is the mask of the slice group. Only the pseudo-inverses of the last mask are kept in memory.
+
+    The methods ml() and map() have the same interface as func_ml() and func_map(), so they can be used in group_funcs\
+    (see aggregate_per_slice_or_level()).
+    """
+    def __init__(self):
+        self._mask = None
+        self._cache = {}
+
+    def _cached(self, pinv_normal, key, name):
+        """
+        Wrap pinv_normal so that its result is cached.
+
+        :param pinv_normal: function computing a pseudo-inverse from the design matrix, e.g. _pinv_normal()
+        :param key: tuple (Metric, tuple of int): mask and slice group of the design matrix. If None, nothing is\
+        cached.
+        :param name: hashable: identify pinv_normal for the same key (e.g. ML estimation of the MAP clusters)
+        :return: function
+        """
+        if key is None:
+            return pinv_normal
+        mask, slicegroup = key
+        if mask is not self._mask:
+            self._mask = mask
+            self._cache = {}
+
+        def pinv_normal_cached(x):
+            if (slicegroup, name) not in self._cache:
+                self._cache[(slicegroup, name)] = pinv_normal(x)
+            return self._cache[(slicegroup, name)]
+        return pinv_normal_cached
+
+    def ml(self, data, mask, map_clusters=None, key=None):
+        """See func_ml() and PartialVolumeSolver._cached() for key"""
+        return _estimate_ml(data, mask, self._cached(_pinv_normal, key, 'ml'))
+
+    def map(self, data, mask, map_clusters, key=None):
+        """See func_map() and PartialVolumeSolver._cached() for key"""
+        name = ('map', tuple(tuple(cluster) for cluster in map_clusters))
+        return _estimate_map(data, mask, map_clusters, self._cached(_pinv_normal_map, key, name),
+                             self._cached(_pinv_normal, key, name + ('clusters',)))
+
+
 def func_std(data, mask=None, map_clusters=None):
     """
     Compute standard deviation
@@ -218,22 +309,28 @@ def func_wa(data, mask=None, map_clusters=None):
 
 
 def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], perslice=None, perlevel=False,
-                                 vert_level=None, group_funcs=(('MEAN', func_wa),), map_clusters=None):
+                                 vert_level=None, group_funcs=(('MEAN', func_wa),), map_clusters=None, z_offset=0):
     """
     The aggregation will be performed along the last dimension of 'metric' ndarray.
 
-    :param metric: Class Metric(): data to aggregate.
+    :param metric: Class Metric(): data to aggregate, or list of Metric with the same shape. For a list, ML and MAP\
+      estimations are run once per slice group for all metrics (stacked as several right-hand sides).
     :param mask: Class Metric(): mask to use for aggregating the data. Optional.
     :param slices: List[int]: Slices to aggregate metric from. If empty, select all slices.
     :param levels: List[int]: Vertebral levels to aggregate metric from. It has priority over "slices".
     :param Bool perslice: Aggregate per slice (True) or across slices (False)
     :param Bool perlevel: Aggregate per level (True) or across levels (False). Has priority over "perslice".
-    :param vert_level: Vertebral level. Could be either an Image or a file name.
+    :param vert_level: Vertebral level. Could be either an Image, a file name or a VertLevelIndex. When aggregating\
+      several metrics with the same vertebral labeling, pass a VertLevelIndex to avoid indexing the image every time.
     :param tuple group_funcs: Name and function to apply on metric. Example: (('MEAN', func_wa),)). Note, the function
       has special requirements in terms of i/o. See the definition to func_wa and use it as a template.
     :param map_clusters: list of list of int: See func_map()
-    :return: Aggregated metric
+    :param z_offset: int: index of the first slice of metric and mask, if they only cover a slab of the volume (see\
+      spinalcordtoolbox.image.load_slab()). slices, levels, vert_level and the output are in the slices of the volume.
+    :return: Aggregated metric, or list of aggregated metrics if metric is a list.
     """
+    is_list = isinstance(metric, (list, tuple))
+    metrics = metric if is_list else [metric]
     # If user neither specified slices nor levels, set perslice=True, otherwise, the output will likely contain nan
     # because in many cases the segmentation does not span the whole I-S dimension.
     if perslice is None:
@@ -243,15 +340,16 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
             perslice = False
 
     # if slices is empty, select all available slices from the metric
-    ndim = metric.data.ndim
+    ndim = metrics[0].data.ndim
     if not slices:
-        slices = range(metric.data.shape[ndim-1])
+        slices = range(z_offset, z_offset + metrics[0].data.shape[ndim-1])
 
     # aggregation based on levels
     if levels:
-        im_vert_level = Image(vert_level).change_orientation('RPI')
+        if not isinstance(vert_level, VertLevelIndex):
+            vert_level = VertLevelIndex(Image(vert_level).change_orientation('RPI'))
         # slicegroups = [(0, 1, 2), (3, 4, 5), (6, 7, 8)]
-        slicegroups = [tuple(get_slices_from_vertebral_levels(im_vert_level, level)) for level in levels]
+        slicegroups = [tuple(vert_level.get_slices(level)) for level in levels]
         if perlevel:
             # vertgroups = [(2,), (3,), (4,)]
             vertgroups = [tuple([level]) for level in levels]
@@ -259,7 +357,7 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
             # slicegroups = [(0,), (1,), (2,), (3,), (4,), (5,), (6,), (7,), (8,)]
             slicegroups = [tuple([i]) for i in functools.reduce(operator.concat, slicegroups)]  # reduce to individual tuple
             # vertgroups = [(2,), (2,), (2,), (3,), (3,), (3,), (4,), (4,), (4,)]
-            vertgroups = [tuple([get_vertebral_level_from_slice(im_vert_level, i[0])]) for i in slicegroups]
+            vertgroups = [tuple([vert_level.get_level(i[0])]) for i in slicegroups]
         # output aggregate metric across levels
         else:
             # slicegroups = [(0, 1, 2, 3, 4, 5, 6, 7, 8)]
@@ -275,54 +373,238 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
         else:
             # slicegroups = [(0, 1, 2, 3, 4, 5, 6, 7, 8)]
             slicegroups = [tuple(slices)]
-    agg_metric = dict((slicegroup, dict()) for slicegroup in slicegroups)
+    list_agg_metric = [dict((slicegroup, dict()) for slicegroup in slicegroups) for _ in metrics]
+    # Slices within metric.data
+    slicegroups_data = [tuple(i - z_offset for i in slicegroup) for slicegroup in slicegroups]
+
+    # Compute the results of the functions that support it for all slice groups at once
+    list_results_grouped = [_aggregate_grouped(metric, mask, slicegroups_data, group_funcs) for metric in metrics]
 
     # loop across slice group
-    for slicegroup in slicegroups:
+    for i_group, slicegroup in enumerate(slicegroups):
         # add level info
-        if vertgroups is None:
-            agg_metric[slicegroup]['VertLevel'] = None
-        else:
-            agg_metric[slicegroup]['VertLevel'] = vertgroups[slicegroups.index(slicegroup)]
+        for agg_metric in list_agg_metric:
+            if vertgroups is None:
+                agg_metric[slicegroup]['VertLevel'] = None
+            else:
+                agg_metric[slicegroup]['VertLevel'] = vertgroups[slicegroups.index(slicegroup)]
         # Loop across functions (e.g.: MEAN, STD)
         for (name, func) in group_funcs:
-            try:
-                data_slicegroup = metric.data[..., slicegroup]  # selection is done in the last dimension
+            # Results already computed for all metrics (one per metric), and size of the mask
+            results, size = None, None
+            if name in list_results_grouped[0]:
+                results = [results_grouped[name][i_group] for results_grouped in list_results_grouped]
                 if mask is not None:
-                    mask_slicegroup = mask.data[..., slicegroup, :]
-                    agg_metric[slicegroup]['Label'] = mask.label
-                    # Add volume fraction
-                    agg_metric[slicegroup]['Size [vox]'] = np.sum(mask_slicegroup.flatten())
-                else:
-                    mask_slicegroup = np.ones(data_slicegroup.shape)
-                # Ignore nonfinite values
-                i_nonfinite = np.where(np.isfinite(data_slicegroup) == False)
-                data_slicegroup[i_nonfinite] = 0.
-                # TODO: the lines below could probably be done more elegantly
-                if mask_slicegroup.ndim == data_slicegroup.ndim + 1:
-                    arr_tmp_concat = []
-                    for i in range(mask_slicegroup.shape[-1]):
-                        arr_tmp = np.reshape(mask_slicegroup[..., i], data_slicegroup.shape)
-                        arr_tmp[i_nonfinite] = 0.
-                        arr_tmp_concat.append(np.expand_dims(arr_tmp, axis=(mask_slicegroup.ndim-1)))
-                    mask_slicegroup = np.concatenate(arr_tmp_concat, axis=(mask_slicegroup.ndim-1))
-                else:
-                    mask_slicegroup[i_nonfinite] = 0.
-                # Make sure the number of pixels to extract metrics is not null
-                if mask_slicegroup.sum() == 0:
-                    result = None
-                else:
-                    # Run estimation
-                    result, _ = func(data_slicegroup, mask_slicegroup, map_clusters)
-                    # check if nan
-                    if np.isnan(result):
+                    size = list_results_grouped[0]['Size [vox]'][i_group]
+            elif len(metrics) > 1 and mask is not None and _is_multiple_rhs(func):
+                # ML and MAP: run the estimation once for all metrics, stacked on the last axis. If the metrics do not
+                # share the design matrix (nonfinite values at different voxels), results is None and the estimation
+                # is run for each metric below.
+                try:
+                    results, size = _estimate_stacked(metrics, mask, slicegroup, slicegroups_data[i_group], func,
+                                                      map_clusters, z_offset)
+                except Exception as e:
+                    results = [str(e)] * len(metrics)
+            for agg_metric, metric, result in zip(list_agg_metric, metrics, results or [None] * len(metrics)):
+                if results is not None:
+                    if size is not None:
+                        agg_metric[slicegroup]['Label'] = mask.label
+                        agg_metric[slicegroup]['Size [vox]'] = size
+                    if isinstance(result, str):
+                        logging.warning(result)
+                    agg_metric[slicegroup]['{}({})'.format(name, metric.label)] = result
+                    continue
+                try:
+                    nz = np.shape(metric.data)[-1]
+                    if slicegroup and (min(slicegroups_data[i_group]) < 0 or max(slicegroups_data[i_group]) >= nz):
+                        raise IndexError("Slices {} are not within the data (slices {} to {})".format(
+                            slicegroup, z_offset, z_offset + nz - 1))
+                    # selection is done in the last dimension
+                    data_slicegroup = metric.data[..., slicegroups_data[i_group]]
+                    if mask is not None:
+                        mask_slicegroup = mask.data[..., slicegroups_data[i_group], :]
+                        agg_metric[slicegroup]['Label'] = mask.label
+                        # Add volume fraction
+                        agg_metric[slicegroup]['Size [vox]'] = np.sum(mask_slicegroup.flatten())
+                    else:
+                        mask_slicegroup = np.ones(data_slicegroup.shape)
+                    # Ignore nonfinite values
+                    i_nonfinite = np.where(np.isfinite(data_slicegroup) == False)
+                    data_slicegroup[i_nonfinite] = 0.
+                    # TODO: the lines below could probably be done more elegantly
+                    if mask_slicegroup.ndim == data_slicegroup.ndim + 1:
+                        arr_tmp_concat = []
+                        for i in range(mask_slicegroup.shape[-1]):
+                            arr_tmp = np.reshape(mask_slicegroup[..., i], data_slicegroup.shape)
+                            arr_tmp[i_nonfinite] = 0.
+                            arr_tmp_concat.append(np.expand_dims(arr_tmp, axis=(mask_slicegroup.ndim-1)))
+                        mask_slicegroup = np.concatenate(arr_tmp_concat, axis=(mask_slicegroup.ndim-1))
+                    else:
+                        mask_slicegroup[i_nonfinite] = 0.
+                    # Make sure the number of pixels to extract metrics is not null
+                    if mask_slicegroup.sum() == 0:
                         result = None
-                # here we create a field with name: FUNC(METRIC_NAME). Example: MEAN(CSA)
-                agg_metric[slicegroup]['{}({})'.format(name, metric.label)] = result
-            except Exception as e:
-                logging.warning(e)
-                agg_metric[slicegroup]['{}({})'.format(name, metric.label)] = str(e)
-    return agg_metric
+                    else:
+                        # Run estimation. The solver can reuse the pseudo-inverse of the design matrix if it is the mask
+                        # of this slice group (i.e. the mask was not changed because of nonfinite values)
+                        if isinstance(getattr(func, '__self__', None), PartialVolumeSolver) and mask is not None:
+                            key = (mask, slicegroup) if not i_nonfinite[0].size else None
+                            result, _ = func(data_slicegroup, mask_slicegroup, map_clusters, key=key)
+                        else:
+                            result, _ = func(data_slicegroup, mask_slicegroup, map_clusters)
+                        # check if nan
+                        if np.isnan(result):
+                            result = None
+                    # here we create a field with name: FUNC(METRIC_NAME). Example: MEAN(CSA)
+                    agg_metric[slicegroup]['{}({})'.format(name, metric.label)] = result
+                except Exception as e:
+                    logging.warning(e)
+                    agg_metric[slicegroup]['{}({})'.format(name, metric.label)] = str(e)
+    if is_list:
+        return list_agg_metric
+    return list_agg_metric[0]
+
+
+def _is_multiple_rhs(func):
+    """Whether func supports data with an additional last dimension of metrics (see func_ml() and func_map())"""
+    return func in (func_ml, func_map) or isinstance(getattr(func, '__self__', None), PartialVolumeSolver)
+
+
+def _estimate_stacked(metrics, mask, slicegroup, slicegroup_data, func, map_clusters, z_offset=0):
+    """
+    Run ML or MAP estimation on a slice group for several metrics at once, by stacking the metrics on the last axis\
+    (see aggregate_per_slice_or_level()). The metrics need to share the design matrix, i.e. their nonfinite values\
+    (which are removed from the mask) are at the same voxels.
+
+    :param metrics: list of Metric: data to aggregate, with the same shape.
+    :param mask: Class Metric(): mask to use for aggregating the data.
+    :param slicegroup: tuple of int: slice group, in the slices of the volume.
+    :param slicegroup_data: tuple of int: slice group, in the slices of the data.
+    :param func: function supporting multiple right-hand sides (see _is_multiple_rhs()).
+    :param map_clusters: see func_map()
+    :param z_offset: see aggregate_per_slice_or_level()
+    :return: list: result for each metric, or None if nonfinite values are not at the same voxels for all metrics.
+    :return: size of the mask within the slice group.
+    """
+    nz = np.shape(metrics[0].data)[-1]
+    if slicegroup and (min(slicegroup_data) < 0 or max(slicegroup_data) >= nz):
+        raise IndexError("Slices {} are not within the data (slices {} to {})".format(
+            slicegroup, z_offset, z_offset + nz - 1))
+    # selection is done in the last dimension, metrics are stacked on a new last dimension
+    data_slicegroup = np.stack([metric.data[..., slicegroup_data] for metric in metrics], axis=-1)
+    mask_slicegroup = mask.data[..., slicegroup_data, :]
+    # Ignore nonfinite values
+    nonfinite = ~np.isfinite(data_slicegroup)
+    if (nonfinite != nonfinite[..., :1]).any():
+        return None, None
+    data_slicegroup[nonfinite] = 0.
+    size = np.sum(mask_slicegroup.flatten())
+    mask_slicegroup[nonfinite[..., 0]] = 0.
+    # Make sure the number of pixels to extract metrics is not null
+    if mask_slicegroup.sum() == 0:
+        return [None] * len(metrics), size
+    if isinstance(getattr(func, '__self__', None), PartialVolumeSolver):
+        # The solver can reuse the pseudo-inverse of the design matrix if it is the mask of this slice group
+        result, _ = func(data_slicegroup, mask_slicegroup, map_clusters,
+                         key=(mask, slicegroup) if not nonfinite.any() else None)
+    else:
+        result, _ = func(data_slicegroup, mask_slicegroup, map_clusters)
+    # check if nan
+    return [None if np.isnan(value) else value for value in result], size
+
+
+def _aggregate_grouped(metric, mask, slicegroups, group_funcs):
+    """
+    Compute WA, STD and BIN (func_wa, func_std and func_bin) for all slice groups at once. Weighted sums are computed\
+    for all slices in one array operation, then accumulated per slice group with np.bincount. Results have the same\
+    types as when running the functions on each slice group in aggregate_per_slice_or_level() (e.g. float32 for float32\
+    data and mask). Sums are accumulated in float64, so float32 results may differ in their last digit.
+
+    :param metric: Class Metric(): data to aggregate.
+    :param mask: Class Metric(): mask to use for aggregating the data, or None.
+    :param slicegroups: list of tuple of int: slice groups
+    :param group_funcs: see aggregate_per_slice_or_level()
+    :return: dict: {name: list of results (one per slice group)} for the functions of group_funcs that were computed,\
+    with 'Size [vox]' if mask is provided. Empty if no function is supported, or if the slice groups overlap or are\
+    out of range.
+    """
+    funcs = [(name, func) for name, func in group_funcs if func in (func_wa, func_std, func_bin)]
+    if not funcs:
+        return {}
+    data = np.asarray(metric.data)
+    nz = data.shape[-1]
+    # Slice group of each slice (-1: not selected)
+    slices_all = np.array([iz for slicegroup in slicegroups for iz in slicegroup], dtype=int)
+    if np.any((slices_all < 0) | (slices_all >= nz)) or len(np.unique(slices_all)) < len(slices_all):
+        return {}
+    group_of_slice = np.full(nz, -1)
+    group_of_slice[slices_all] = np.repeat(np.arange(len(slicegroups)), [len(g) for g in slicegroups])
+    if not np.issubdtype(data.dtype, np.number):
+        return {}
+
+    n_groups = len(slicegroups)
+    selected = np.flatnonzero(group_of_slice != -1)
+    data_dtype = data.dtype
+    data = data[..., selected].astype(np.float64)
+    groups = group_of_slice[selected]
+    if mask is not None:
+        mask_data = mask.data[..., selected, :]
+    else:
+        mask_data = np.ones(data.shape + (1,))
+    # Types of the results of np.sum() and np.average() in the functions
+    dtypes = {'Size [vox]': np.zeros(0, dtype=mask_data.dtype).sum().dtype,
+              func_wa: _average_dtype(data_dtype, mask_data.dtype),
+              func_bin: _average_dtype(data_dtype, np.where(np.zeros(0), 1, 0).dtype),
+              func_std: np.dtype(np.float64)}
+
+    def bincount(values):
+        # Sum values across voxels of each slice, then across slices of each group
+        values_slice = np.reshape(values, (-1, len(selected))).sum(axis=0)
+        return np.bincount(groups, weights=values_slice, minlength=n_groups)
+
+    results = {}
+    if mask is not None:
+        results['Size [vox]'] = bincount(mask_data.sum(axis=-1)).astype(dtypes['Size [vox]'])
+    # Ignore nonfinite values
+    finite = np.isfinite(data)
+    data[~finite] = 0.
+    mask_data = mask_data * finite[..., np.newaxis]
+    mask_sum = bincount(mask_data.sum(axis=-1))
+    # Weighted average and standard deviation, with the first label as weights
+    weights = {'wa': mask_data[..., 0], 'bin': np.where(mask_data[..., 0] >= 0.5, 1, 0)}
+    averages = {}
+    for key in weights:
+        weights_sum = bincount(weights[key])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            averages[key] = (bincount(weights[key] * data) / weights_sum, weights_sum)
+    average, weights_sum = averages['wa']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(bincount(weights['wa'] * (data - average[groups]) ** 2) / weights_sum)
+    values = {func_wa: averages['wa'], func_bin: averages['bin'], func_std: (std, weights_sum)}
+
+    for name, func in funcs:
+        value, weights_sum = values[func]
+        value = value.astype(dtypes[func])
+        results[name] = []
+        for i_group in range(n_groups):
+            # Same outputs as in aggregate_per_slice_or_level()
+            if mask_sum[i_group] == 0:
+                result = None
+            elif weights_sum[i_group] == 0:
+                result = "Weights sum to zero, can't be normalized"
+            elif np.isnan(value[i_group]):
+                result = None
+            else:
+                result = value[i_group]
+            results[name].append(result)
+    return results
+
+
+def _average_dtype(data_dtype, weights_dtype):
+    """Type of the result of np.average(data, weights=weights)"""
+    if np.issubdtype(data_dtype, np.integer) or np.issubdtype(data_dtype, np.bool_):
+        return np.result_type(data_dtype, weights_dtype, np.float64)
+    return np.result_type(data_dtype, weights_dtype)
 
 
 def check_labels(indiv_labels_ids, selected_labels):
@@ -360,27 +642,41 @@ def diff_between_list_or_int(l1, l2):
 
 
 def extract_metric(data, labels=None, slices=None, levels=None, perslice=True, perlevel=False,
-                   vert_level=None, method=None, label_struc=None, id_label=None, indiv_labels_ids=None):
+                   vert_level=None, method=None, label_struc=None, id_label=None, indiv_labels_ids=None, solver=None,
+                   z_offset=0):
     """
     Extract metric within a data, using mask and a given method.
 
-    :param data: Class Metric(): Data (a.k.a. metric) of n-dimension to extract aggregated value from
-    :param labels: Class Metric(): Labels of (n+1)dim. The last dim encloses the labels.
+    :param data: Class Metric(): Data (a.k.a. metric) of n-dimension to extract aggregated value from. Can also be a\
+    list of Metric() sharing the same space as labels (e.g. FA, MD, RD and AD), in which case the mask is only built\
+    once and, for ML/MAP, the metrics are stacked and estimated with one solve per slice group.
+    :param labels: nd-array or LabelStack: Labels of (n+1)dim. The last dim encloses the labels. For ML/MAP, the\
+    dense stack of all labels is kept in the LabelStack, so pass the same LabelStack across labels.
     :param slices:
     :param levels:
     :param perslice:
     :param perlevel:
-    :param vert_level:
+    :param vert_level: see aggregate_per_slice_or_level()
     :param method:
     :param label_struc: LabelStruc class defined above
     :param id_label: int: ID of label to select
     :param indiv_labels_ids: list of int: IDs of labels corresponding to individual (as opposed to combined) labels for\
     use with ML or MAP estimation.
-    :return: aggregate_per_slice_or_level()
+    :param solver: PartialVolumeSolver: solver used for ML/MAP estimation. Pass the same solver across calls that use\
+    the same labels to reuse its cache. If None, a new one is created.
+    :param z_offset: int: index of the first slice of data and labels, if they only cover a slab (see\
+    aggregate_per_slice_or_level()).
+    :return: aggregate_per_slice_or_level(), or a list of it (one per metric) if data is a list.
     """
     # Initializations
     map_clusters = None
-    func_methods = {'ml': ('ML', func_ml), 'map': ('MAP', func_map)}  # TODO: complete dict with other methods
+    if solver is None:
+        solver = PartialVolumeSolver()
+    func_methods = {'ml': ('ML', solver.ml), 'map': ('MAP', solver.map)}  # TODO: complete dict with other methods
+    # ML/MAP need all labels: build the dense stack once, and reuse it for the next labels instead of pasting all compact
+    # labels again
+    if method in ['ml', 'map'] and isinstance(labels, LabelStack):
+        labels = labels.get_dense()
     # If label_struc[id_label].id is a list (i.e. comes from a combined labels), sum all labels
     if isinstance(label_struc[id_label].id, list):
         labels_sum = np.sum(labels[..., label_struc[id_label].id], axis=labels.ndim-1)  # (nx, ny, nz, 1)
@@ -427,7 +723,7 @@ def extract_metric(data, labels=None, slices=None, levels=None, perslice=True, p
 
     return aggregate_per_slice_or_level(data, mask=mask, slices=slices, levels=levels, perslice=perslice,
                                         perlevel=perlevel, vert_level=vert_level, group_funcs=group_funcs,
-                                        map_clusters=map_clusters)
+                                        map_clusters=map_clusters, z_offset=z_offset)
 
 
 def make_a_string(item):
@@ -521,3 +817,183 @@ def save_as_csv(agg_metric, fname_out, fname_in=None, append=False):
                         line.append(str(agg_metric[slicegroup][key]))
                         break
             spamwriter.writerow(line)
+
+
+# File extensions for which results are saved in a SQLite database instead of a csv file
+SQLITE_EXTENSIONS = ('.db', '.sqlite')
+# Columns of the SQLite table of results: one row per (file, slice group, label, metric)
+SQLITE_TABLE = 'metrics'
+SQLITE_COLUMNS = [('Timestamp', 'TEXT'), ('SCTVersion', 'TEXT'), ('Subject', 'TEXT'), ('Filename', 'TEXT'),
+                  ('Slice', 'TEXT'), ('SliceMin', 'INTEGER'), ('SliceMax', 'INTEGER'), ('VertLevel', 'TEXT'),
+                  ('Label', 'TEXT'), ('Metric', 'TEXT'), ('Value', 'REAL'), ('Message', 'TEXT')]
+
+
+def save_results(agg_metric, fname_out, fname_in=None, append=False, subject=None):
+    """
+    Write metric structure in a csv file or, if the extension of fname_out is in SQLITE_EXTENSIONS, in a SQLite\
+    database. See save_as_csv() and save_as_sqlite().
+    """
+    if os.path.splitext(fname_out)[1] in SQLITE_EXTENSIONS:
+        save_as_sqlite(agg_metric, fname_out, fname_in=fname_in, append=append, subject=subject)
+    else:
+        save_as_csv(agg_metric, fname_out, fname_in=fname_in, append=append)
+
+
+def _connect_sqlite(fname, timeout=60.0):
+    """
+    Open a connection to a SQLite database of results, and create the table of results if needed.
+
+    :param fname: file name of the database
+    :param timeout: float: time (in s) to wait for a lock held by another process (e.g. parallel sct_run_batch jobs)
+    :return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(fname, timeout=timeout)
+    conn.row_factory = sqlite3.Row
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            SQLITE_TABLE, ', '.join('{} {}'.format(name, type) for name, type in SQLITE_COLUMNS)))
+    return conn
+
+
+def _sqlite_where(where):
+    """
+    Build a WHERE clause from a dictionary {column: value or list of values}.
+
+    :return: str: clause, list: parameters
+    """
+    if not where:
+        return '', []
+    columns = [name for name, _ in SQLITE_COLUMNS]
+    clauses, params = [], []
+    for column, value in where.items():
+        if column not in columns:
+            raise ValueError("Unknown column: {}. Available columns: {}".format(column, columns))
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        clauses.append('{} IN ({})'.format(column, ', '.join('?' * len(values))))
+        params += values
+    return ' WHERE ' + ' AND '.join(clauses), params
+
+
+def save_as_sqlite(agg_metric, fname_out, fname_in=None, append=False, subject=None):
+    """
+    Write metric structure in a SQLite database, with one typed row per slice group, label and metric. Rows of one call\
+    are inserted in a single transaction, so that several processes can safely write in the same database.
+
+    :param agg_metric: output of aggregate_per_slice_or_level()
+    :param fname_out: output filename (see SQLITE_EXTENSIONS).
+    :param fname_in: input file to be listed in the database (e.g., segmentation file which produced the results).
+    :param append: Bool: Append results to the database (if exists) instead of overwriting its content.
+    :param subject: str: subject associated with the results.
+    :return:
+    """
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    for slicegroup in sorted(agg_metric.keys()):
+        fields = agg_metric[slicegroup]
+        # Empty slice groups (e.g. vertebral levels not found in the labeling) have no slice range
+        slice_min, slice_max = (min(slicegroup), max(slicegroup)) if slicegroup else (None, None)
+        info = [timestamp, __version__, subject, fname_in, parse_num_list_inv(slicegroup), slice_min, slice_max,
+                parse_num_list_inv(fields['VertLevel']), fields.get('Label')]
+        for key, value in fields.items():
+            if key in ['VertLevel', 'Label']:
+                continue
+            if value is None or isinstance(value, (int, float, np.number)):
+                rows.append(info + [key, None if value is None else float(value), None])
+            else:
+                # Error message
+                rows.append(info + [key, None, str(value)])
+    conn = _connect_sqlite(fname_out)
+    try:
+        with conn:
+            # Lock the database for writing before modifying it
+            conn.execute('BEGIN IMMEDIATE')
+            if not append:
+                conn.execute('DELETE FROM {}'.format(SQLITE_TABLE))
+            conn.executemany('INSERT INTO {} VALUES ({})'.format(SQLITE_TABLE, ', '.join('?' * len(SQLITE_COLUMNS))),
+                             rows)
+    finally:
+        conn.close()
+
+
+def query_sqlite(fname, where=None):
+    """
+    Get results from a SQLite database written by save_as_sqlite().
+
+    :param fname: file name of the database
+    :param where: dict: {column: value or list of values} used to select rows. Example:\
+      {'Metric': 'MEAN(area)', 'VertLevel': ['2', '3']}
+    :return: list of dict: one dict {column: value} per row, in order of insertion.
+    """
+    clause, params = _sqlite_where(where)
+    conn = _connect_sqlite(fname)
+    try:
+        rows = conn.execute('SELECT * FROM {}{} ORDER BY rowid'.format(SQLITE_TABLE, clause), params).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+
+def aggregate_sqlite(fname, metric, group_by=('Subject',), where=None):
+    """
+    Aggregate a metric across the rows of a SQLite database written by save_as_sqlite(), e.g. to get group statistics.
+
+    :param fname: file name of the database
+    :param metric: str: name of the metric. Example: 'MEAN(area)'
+    :param group_by: tuple of str: columns defining the groups. Example: ('Subject', 'VertLevel')
+    :param where: dict: additional selection of rows, see query_sqlite().
+    :return: dict: {group: {'N': int, 'MEAN': float, 'STD': float, 'MIN': float, 'MAX': float}}, with group being the\
+    tuple of values of the columns in group_by. Rows without value (e.g. failed estimation) are ignored. STD is the\
+    sample standard deviation (nan if N < 2).
+    """
+    where = dict(where or {}, Metric=metric)
+    columns = [name for name, _ in SQLITE_COLUMNS]
+    for column in group_by:
+        if column not in columns:
+            raise ValueError("Unknown column: {}. Available columns: {}".format(column, columns))
+    clause, params = _sqlite_where(where)
+    group_clause = ', '.join(group_by)
+    query = 'SELECT {group}COUNT(Value), SUM(Value), SUM(Value * Value), MIN(Value), MAX(Value) FROM {table}{where} ' \
+            'AND Value IS NOT NULL{group_by}'.format(group=group_clause + ', ' if group_by else '', table=SQLITE_TABLE,
+                                                     where=clause,
+                                                     group_by=' GROUP BY ' + group_clause if group_by else '')
+    conn = _connect_sqlite(fname)
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+    results = {}
+    for row in rows:
+        row = tuple(row)
+        group, (n, s1, s2, vmin, vmax) = row[:len(group_by)], row[len(group_by):]
+        if not n:
+            continue
+        std = math.sqrt(max(s2 - s1 ** 2 / n, 0) / (n - 1)) if n > 1 else np.nan
+        results[group] = {'N': n, 'MEAN': s1 / n, 'STD': std, 'MIN': vmin, 'MAX': vmax}
+    return results
+
+
+def sqlite_to_csv(fname, fname_out, where=None):
+    """
+    Export a SQLite database written by save_as_sqlite() as a csv file, with one line per file, slice group and label,\
+    and one column per metric.
+
+    :param fname: file name of the database
+    :param fname_out: output csv file name
+    :param where: dict: selection of rows, see query_sqlite().
+    :return:
+    """
+    keys = ['Timestamp', 'SCTVersion', 'Subject', 'Filename', 'Slice', 'VertLevel', 'Label']
+    lines, metrics = OrderedDict(), []
+    for row in query_sqlite(fname, where=where):
+        key = tuple(row[k] for k in keys)
+        if key not in lines:
+            lines[key] = {}
+        if row['Metric'] not in metrics:
+            metrics.append(row['Metric'])
+        lines[key][row['Metric']] = row['Value'] if row['Message'] is None else row['Message']
+    with open(fname_out, 'w') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        header = ['Timestamp', 'SCT Version', 'Subject', 'Filename', 'Slice (I->S)', 'VertLevel', 'Label']
+        writer.writerow(header + metrics)
+        for key, values in lines.items():
+            writer.writerow(['' if v is None else v for v in key] + [str(values.get(metric)) for metric in metrics])
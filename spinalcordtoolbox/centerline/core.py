@@ -3,11 +3,18 @@
 # Core functions dealing with centerline extraction from 3D data.
 
 
+import os
 import logging
+import hashlib
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
 import numpy as np
 
 from spinalcordtoolbox.image import Image, zeros_like
 from spinalcordtoolbox.centerline import curve_fitting
+from spinalcordtoolbox.utils import __version__
 
 logger = logging.getLogger(__name__)
 
@@ -57,6 +64,126 @@ class FitResults:
         self.data = Data()  # Raw and fitted data (for plotting in QC report)
         self.param = None  # ParamCenterline()
 
+    def to_dict(self):
+        """Return the metrics and data as a (picklable) dictionary. The parameters are not included."""
+        return {'rmse': self.rmse, 'laplacian_max': self.laplacian_max, 'data': dict(vars(self.data))}
+
+    @classmethod
+    def from_dict(cls, dict_results, param=None):
+        fit_results = cls()
+        fit_results.rmse, fit_results.laplacian_max = dict_results['rmse'], dict_results['laplacian_max']
+        for k, v in dict_results['data'].items():
+            setattr(fit_results.data, k, v)
+        fit_results.param = param
+        return fit_results
+
+
+class CenterlineCache(object):
+    """
+    Opt-in cache of the results of get_centerline().
+
+    Results are indexed by a key computed from the data, orientation and resolution of the input image, from the
+    fitting parameters and from the SCT version, so that cached results are identical to fresh ones. Results are kept
+    in memory (up to size_max entries), and optionally on disk so that they can be shared across processes.
+
+    The cache is disabled by default. It can be enabled with enable(), or with the environment variable
+    SCT_CENTERLINE_CACHE, set to "memory" (in-memory cache only) or to the path of a folder (in-memory and on-disk
+    cache).
+    """
+    def __init__(self, path=None, size_max=32):
+        """
+        :param path: str: "memory", or folder of the on-disk cache. Default: $SCT_CENTERLINE_CACHE (disabled if unset)
+        :param size_max: int: maximum number of entries kept in memory
+        """
+        self.enabled, self.path = False, None
+        self.size_max = size_max
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path is None:
+            path = os.environ.get('SCT_CENTERLINE_CACHE', '')
+        if path.lower() not in ['', 'off', 'no', 'false']:
+            self.enable(None if path.lower() == 'memory' else path)
+
+    def enable(self, path=None):
+        """
+        :param path: str: folder of the on-disk cache. If None, results are only cached in memory.
+        """
+        self.enabled = True
+        self.path = os.path.abspath(path) if path is not None else None
+
+    def disable(self):
+        self.enabled, self.path = False, None
+        self.clear()
+
+    def clear(self):
+        """Clear the in-memory cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def key(self, im_seg, param):
+        """
+        :param im_seg: Image: input of get_centerline()
+        :param param: ParamCenterline
+        :return: str
+        """
+        h = hashlib.sha256()
+        data = np.ascontiguousarray(im_seg.data)
+        h.update(str((data.shape, data.dtype.str, im_seg.orientation, tuple(im_seg.dim[4:7]))).encode('utf-8'))
+        h.update(data.tobytes())
+        for k, v in sorted(vars(param).items()):
+            h.update('{}={!r};'.format(k, v).encode('utf-8'))
+        h.update(__version__.encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        :return: dict: cached entry (see set()), or None if the key is not in the cache
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.path is not None:
+            try:
+                with open(os.path.join(self.path, key + '.pkl'), 'rb') as f:
+                    entry = pickle.load(f)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                return None
+            self._store_in_memory(key, entry)
+        if entry is None:
+            return None
+        logger.debug("Reusing centerline from cache (key: {})".format(key))
+        # Return a copy, so that the cached entry cannot be modified by the caller
+        return pickle.loads(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def set(self, key, entry):
+        """
+        :param entry: dict with keys: data (centerline image data), arr_centerline, arr_centerline_deriv, fit_results\
+        (dict of attributes of FitResults, or None)
+        """
+        entry = pickle.loads(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+        self._store_in_memory(key, entry)
+        if self.path is not None:
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                # Write to a temporary file then rename it, so that other processes never read partial entries
+                fd, fname_tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(fname_tmp, os.path.join(self.path, key + '.pkl'))
+            except (IOError, OSError):
+                logger.warning("Centerline could not be written in cache: {}".format(self.path))
+
+    def _store_in_memory(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size_max:
+                self._entries.popitem(last=False)
+
+
+centerline_cache = CenterlineCache()
+
 
 def find_and_sort_coord(img):
     """
@@ -71,16 +198,9 @@ def find_and_sort_coord(img):
     arr = np.array(np.where(img.data))
     # Sort indices according to SI axis
     dim_si = [img.orientation.find(x) for x in ['I', 'S'] if img.orientation.find(x) != -1][0]
-    # Loop across SI axis and average coordinates within duplicate SI values
-    arr_sorted_avg = [np.array([])] * 3
-    for i_si in sorted(set(arr[dim_si])):
-        # Get indices corresponding to i_si
-        ind_si_all = np.where(arr[dim_si] == i_si)
-        if len(ind_si_all[0]):
-            # loop across dimensions and average all existing coordinates (equivalent to center of mass)
-            for i_dim in range(3):
-                arr_sorted_avg[i_dim] = np.append(arr_sorted_avg[i_dim], arr[i_dim][ind_si_all].mean())
-    return np.array(arr_sorted_avg)
+    # Average coordinates within duplicate SI values (equivalent to center of mass)
+    _, ind_si, count_si = np.unique(arr[dim_si], return_inverse=True, return_counts=True)
+    return np.array([np.bincount(ind_si, weights=arr[i_dim]) / count_si for i_dim in range(3)])
 
 
 def get_centerline(im_seg, param=ParamCenterline(), verbose=1):
@@ -98,6 +218,20 @@ def get_centerline(im_seg, param=ParamCenterline(), verbose=1):
 
     if not isinstance(im_seg, Image):
         raise ValueError("Expecting an image")
+
+    # Reuse cached results (if the cache is enabled). Figures are only generated when fitting.
+    key = None
+    if centerline_cache.enabled and verbose < 2:
+        key = centerline_cache.key(im_seg, param)
+        entry = centerline_cache.get(key)
+        if entry is not None:
+            im_centerline = im_seg.copy()
+            im_centerline.data = entry['data']
+            fit_results = entry['fit_results']
+            if fit_results is not None:
+                fit_results = FitResults.from_dict(fit_results, param)
+            return im_centerline, entry['arr_centerline'], entry['arr_centerline_deriv'], fit_results
+
     # Open image and change to RPI orientation
     native_orientation = im_seg.orientation
     im_seg.change_orientation('RPI')
@@ -156,11 +290,12 @@ def get_centerline(im_seg, param=ParamCenterline(), verbose=1):
         # TODO: Fix below with reorientation of axes
         _, x_centerline_deriv = curve_fitting.polyfit_1d(z_centerline, x_centerline_fit, z_centerline, deg=param.degree)
         _, y_centerline_deriv = curve_fitting.polyfit_1d(z_centerline, y_centerline_fit, z_centerline, deg=param.degree)
-        return \
-            im_centerline.change_orientation(native_orientation), \
-            np.array([x_centerline_fit, y_centerline_fit, z_centerline]), \
-            np.array([x_centerline_deriv, y_centerline_deriv, np.ones_like(z_centerline)]), \
-            None
+        return _cache_centerline(
+            key,
+            im_centerline.change_orientation(native_orientation),
+            np.array([x_centerline_fit, y_centerline_fit, z_centerline]),
+            np.array([x_centerline_deriv, y_centerline_deriv, np.ones_like(z_centerline)]),
+            None)
     else:
         logger.error('algo_fitting "' + param.algo_fitting + '" does not exist.')
         raise ValueError
@@ -240,10 +375,23 @@ def get_centerline(im_seg, param=ParamCenterline(), verbose=1):
         plt.savefig('fig_centerline_' + datetime.now().strftime("%y%m%d-%H%M%S%f") + '_' + param.algo_fitting + '.png')
         plt.close()
 
-    return im_centerline, \
-           np.array([x_centerline_fit, y_centerline_fit, z_ref]), \
-           np.array([x_centerline_deriv, y_centerline_deriv, np.ones_like(z_ref)]), \
-           fit_results
+    return _cache_centerline(key,
+                             im_centerline,
+                             np.array([x_centerline_fit, y_centerline_fit, z_ref]),
+                             np.array([x_centerline_deriv, y_centerline_deriv, np.ones_like(z_ref)]),
+                             fit_results)
+
+
+def _cache_centerline(key, im_centerline, arr_centerline, arr_centerline_deriv, fit_results):
+    """
+    Store the outputs of get_centerline() in the centerline cache (if key is not None), and return them.
+    """
+    if key is not None:
+        centerline_cache.set(key, {'data': im_centerline.data,
+                                   'arr_centerline': arr_centerline,
+                                   'arr_centerline_deriv': arr_centerline_deriv,
+                                   'fit_results': fit_results.to_dict() if fit_results is not None else None})
+    return im_centerline, arr_centerline, arr_centerline_deriv, fit_results
 
 
 def round_and_clip(arr, clip=None):
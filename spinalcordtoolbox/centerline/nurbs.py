@@ -42,6 +42,7 @@ from __future__ import division, absolute_import
 import os
 import numpy as np
 import logging
+from scipy.spatial import cKDTree
 
 from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.types import Centerline
@@ -118,20 +119,13 @@ class NURBS:
                     #     type="error")
 
                 # compute weights based on curve density
-                w = [1.0] * len(P_x)
+                w = np.ones(len(P_x))
                 if weights:
                     if not twodim:
-                        for i in range(1, len(P_x) - 1):
-                            dist_before = np.sqrt(
-                                (P_x[i - 1] - P_x[i]) ** 2 + (P_y[i - 1] - P_y[i]) ** 2 + (P_z[i - 1] - P_z[i]) ** 2)
-                            dist_after = np.sqrt(
-                                (P_x[i] - P_x[i + 1]) ** 2 + (P_y[i] - P_y[i + 1]) ** 2 + (P_z[i] - P_z[i + 1]) ** 2)
-                            w[i] = (dist_before + dist_after) / 2.0
+                        dist = np.sqrt(np.sum(np.diff(np.column_stack((P_x, P_y, P_z)), axis=0) ** 2, axis=1))
                     else:
-                        for i in range(1, len(P_x) - 1):
-                            dist_before = np.sqrt((P_x[i - 1] - P_x[i]) ** 2 + (P_y[i - 1] - P_y[i]) ** 2)
-                            dist_after = np.sqrt((P_x[i] - P_x[i + 1]) ** 2 + (P_y[i] - P_y[i + 1]) ** 2)
-                            w[i] = (dist_before + dist_after) / 2.0
+                        dist = np.sqrt(np.sum(np.diff(np.column_stack((P_x, P_y)), axis=0) ** 2, axis=1))
+                    w[1:-1] = (dist[:-1] + dist[1:]) / 2.0
                     w[0], w[-1] = w[1], w[-2]
 
                 list_param_that_worked = []
@@ -160,24 +154,12 @@ class NURBS:
                                                                                   self.precision / 3)
 
                         # compute error between the input data and the nurbs
-                        error_curve = 0.0
                         if not twodim:
-                            for i in range(0, len(P_x)):
-                                min_dist = 10000.0
-                                for k in range(0, len(self.courbe3D[0])):
-                                    dist = (self.courbe3D[0][k] - P_x[i]) ** 2 + (self.courbe3D[1][k] - P_y[i]) ** 2 + (
-                                                self.courbe3D[2][k] - P_z[i]) ** 2
-                                    if dist < min_dist:
-                                        min_dist = dist
-                                error_curve += min_dist
+                            courbe, data = np.column_stack(self.courbe3D), np.column_stack((P_x, P_y, P_z))
                         else:
-                            for i in range(0, len(P_x)):
-                                min_dist = 10000.0
-                                for k in range(0, len(self.courbe2D[0])):
-                                    dist = (self.courbe2D[0][k] - P_x[i]) ** 2 + (self.courbe2D[1][k] - P_y[i]) ** 2
-                                    if dist < min_dist:
-                                        min_dist = dist
-                                error_curve += min_dist
+                            courbe, data = np.column_stack(self.courbe2D), np.column_stack((P_x, P_y))
+                        min_dist = cKDTree(courbe).query(data)[0] ** 2
+                        error_curve = np.sum(np.minimum(min_dist, 10000.0))
                         error_curve /= float(len(P_x))
 
                         if verbose >= 1:
@@ -256,488 +238,105 @@ class NURBS:
     def getCourbe2D_deriv(self):
         return self.courbe2D_deriv
 
-    # Multiplie deux polynomes
-    def multipolynome(self, polyA, polyB):
-        result = []
-        for r in polyB:
-            temp = polyA * r[0]
-            result.append([temp, r[-1]])
-        return result
-
-    def N(self, i, k, x):
-        global Nik_temp
-        if k == 1:
-            tab = [[np.poly1d(1), i + 1]]
-        else:
-            tab = []
-            den_g = x[i + k - 1] - x[i]
-            den_d = x[i + k] - x[i + 1]
-            if den_g != 0:
-                if Nik_temp[i][k - 1] == -1:
-                    Nik_temp[i][k - 1] = self.N(i, k - 1, x)
-                tab_b = self.multipolynome(np.poly1d([1 / den_g, -x[i] / den_g]), Nik_temp[i][k - 1])
-                tab.extend(tab_b)
-            if den_d != 0:
-                if Nik_temp[i + 1][k - 1] == -1:
-                    Nik_temp[i + 1][k - 1] = self.N(i + 1, k - 1, x)
-                tab_d = self.multipolynome(np.poly1d([-1 / den_d, x[i + k] / den_d]), Nik_temp[i + 1][k - 1])
-                tab.extend(tab_d)
-
-        return tab
-
-    def Np(self, i, k, x):
-        global Nik_temp_deriv, Nik_temp
-        if k == 1:
-            tab = [[np.poly1d(0), i + 1]]
-        else:
-            tab = []
-            den_g = x[i + k - 1] - x[i]
-            den_d = x[i + k] - x[i + 1]
-            if den_g != 0:
-                if Nik_temp_deriv[i][-1] == -1:
-                    Nik_temp_deriv[i][-1] = self.N(i, k - 1, x)
-                tab_b = self.multipolynome(np.poly1d([k / den_g]), Nik_temp_deriv[i][-1])
-                tab.extend(tab_b)
-            if den_d != 0:
-                if Nik_temp_deriv[i + 1][-1] == -1:
-                    Nik_temp_deriv[i + 1][-1] = self.N(i + 1, k - 1, x)
-                tab_d = self.multipolynome(np.poly1d([-k / den_d]), Nik_temp_deriv[i + 1][-1])
-                tab.extend(tab_d)
-
-        return tab
-
-    def evaluateN(self, Ni, t, x):
-        result = 0
-        for Ni_temp in Ni:
-            if x[Ni_temp[-1] - 1] <= t <= x[Ni_temp[-1]]:
-                result += Ni_temp[0](t)
-        return result
-
     def calculX3D(self, P, k):
-        n = len(P) - 1
-        c = []
-        sumC = 0
-        for i in range(n):
-            dist = np.sqrt((P[i + 1][0] - P[i][0]) ** 2 + (P[i + 1][1] - P[i][1]) ** 2 + (P[i + 1][2] - P[i][2]) ** 2)
-            c.append(dist)
-            sumC += dist
-
-        x = [0] * k
-        sumCI = 0
-        for i in range(n - k + 1):
-            sumCI += c[i + 1]
-            x.append((n - k + 2) / sumC * ((i + 1) * c[i + 1] / (n - k + 2) + sumCI))
-
-        x.extend([n - k + 2] * k)
-
-        return x
+        return self.calculX(np.asarray(P)[:, 0:3], k)
 
     def calculX2D(self, P, k):
-        n = len(P) - 1
-        c = []
-        sumC = 0
-        for i in range(n):
-            dist = np.sqrt((P[i + 1][0] - P[i][0]) ** 2 + (P[i + 1][1] - P[i][1]) ** 2)
-            c.append(dist)
-            sumC += dist
-
-        x = [0] * k
-        sumCI = 0
-        for i in range(n - k + 1):
-            sumCI += c[i + 1]
-            x.append((n - k + 2) / sumC * ((i + 1) * c[i + 1] / (n - k + 2) + sumCI))
+        return self.calculX(np.asarray(P)[:, 0:2], k)
 
-        x.extend([n - k + 2] * k)
-
-        return x
+    def calculX(self, P, k):
+        """
+        Compute the knot vector of a curve of order k defined by its control points P (array of shape (n + 1, dim)).
+        """
+        n = len(P) - 1
+        c = np.sqrt(np.sum(np.diff(P, axis=0) ** 2, axis=1))
+        sumC = np.sum(c)
+        i = np.arange(n - k + 1)
+        sumCI = np.cumsum(c[1:n - k + 2])
+        x = (n - k + 2) / sumC * ((i + 1) * c[1:n - k + 2] / (n - k + 2) + sumCI)
+        return np.concatenate(([0.0] * k, x, [n - k + 2] * k))
 
     def construct3D(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX3D(P, k)
-
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in range(k)] for i in range(n)]
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in range(n)]
-        for i in range(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in range(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
         param = np.linspace(x[0], x[-1], int(round(prec)))
-        P_x, P_y, P_z = [], [], []  # coord fitees
-        P_x_d, P_y_d, P_z_d = [], [], []  # derivees
-        for i in range(len(param)):
-            sum_num_x, sum_num_y, sum_num_z, sum_den = 0, 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_num_z_der, sum_den_der = 0, 0, 0, 0
-
-            for l in range(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_num_z += N_temp * point[2]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_num_z_der += N_temp_deriv * point[2]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_z.append(sum_num_z / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-            P_z_d.append(sum_num_z_der)
-
-            if sum_den <= 0.05:
-                raise ReconstructionError()
-
-        P_x = [P_x[i] for i in np.argsort(P_z)]
-        P_y = [P_y[i] for i in np.argsort(P_z)]
-        P_x_d = [P_x_d[i] for i in np.argsort(P_z)]
-        P_y_d = [P_y_d[i] for i in np.argsort(P_z)]
-        P_z_d = [P_z_d[i] for i in np.argsort(P_z)]
-        P_z = np.sort(P_z)
-
-        # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = np.array(P_x)
-        P_y = np.array(P_y)
-        P_x_d = np.array(P_x_d)
-        P_y_d = np.array(P_y_d)
-        P_z_d = np.array(P_z_d)
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
 
         if self.all_slices:
-            P_z = np.array([int(np.round(P_z[i])) for i in range(0, len(P_z))])
-
-            # not perfect but works (if "enough" points), in order to deal with missing z slices
-            for i in range(min(P_z), max(P_z) + 1, 1):
-                if i not in P_z:
-                    P_z_temp = np.insert(P_z, np.where(P_z == i - 1)[-1][-1] + 1, i)
-                    P_x_temp = np.insert(P_x, np.where(P_z == i - 1)[-1][-1] + 1, (
-                                P_x[np.where(P_z == i - 1)[-1][-1]] + P_x[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_temp = np.insert(P_y, np.where(P_z == i - 1)[-1][-1] + 1, (
-                                P_y[np.where(P_z == i - 1)[-1][-1]] + P_y[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_x_d_temp = np.insert(P_x_d, np.where(P_z == i - 1)[-1][-1] + 1, (
-                                P_x_d[np.where(P_z == i - 1)[-1][-1]] + P_x_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_d_temp = np.insert(P_y_d, np.where(P_z == i - 1)[-1][-1] + 1, (
-                                P_y_d[np.where(P_z == i - 1)[-1][-1]] + P_y_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_z_d_temp = np.insert(P_z_d, np.where(P_z == i - 1)[-1][-1] + 1, (
-                                P_z_d[np.where(P_z == i - 1)[-1][-1]] + P_z_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp
-
-            coord_mean = np.array(
-                [[np.mean(P_x[P_z == i]), np.mean(P_y[P_z == i]), i] for i in range(min(P_z), max(P_z) + 1, 1)])
-
-            P_x = coord_mean[:, :][:, 0]
-            P_y = coord_mean[:, :][:, 1]
-
-            coord_mean_d = np.array(
-                [[np.mean(P_x_d[P_z == i]), np.mean(P_y_d[P_z == i]), np.mean(P_z_d[P_z == i])] for i in
-                 range(min(P_z), max(P_z) + 1, 1)])
-
-            P_z = coord_mean[:, :][:, 2]
-
-            P_x_d = coord_mean_d[:, :][:, 0]
-            P_y_d = coord_mean_d[:, :][:, 1]
-            P_z_d = coord_mean_d[:, :][:, 2]
+            # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des
+            # entiers et on moyenne en x et y.
+            P_z, (P_x, P_y, P_x_d, P_y_d, P_z_d) = _average_over_slices(P_z, [P_x, P_y, P_x_d, P_y_d, P_z_d])
 
         return [P_x, P_y, P_z], [P_x_d, P_y_d, P_z_d]
 
     def construct2D(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX2D(P, k)
-
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in range(k)] for i in range(n)]
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in range(n)]
-        for i in range(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in range(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
-        param = np.linspace(x[0], x[-1], prec)
-        P_x, P_y = [], []  # coord fitees
-        P_x_d, P_y_d = [], []  # derivees
-        for i in range(len(param)):
-            sum_num_x, sum_num_y, sum_den = 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_den_der = 0, 0, 0
-
-            for l in range(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-
-            if sum_den <= 0.05:
-                raise ReconstructionError()
-
-        P_x = [P_x[i] for i in np.argsort(P_y)]
-        P_x_d = [P_x_d[i] for i in np.argsort(P_y)]
-        P_y_d = [P_y_d[i] for i in np.argsort(P_y)]
-        P_y = np.sort(P_y)
-
-        # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = np.array(P_x)
-        P_y = np.array(P_y)
-        P_x_d = np.array(P_x_d)
-        P_y_d = np.array(P_y_d)
+        param = np.linspace(x[0], x[-1], int(round(prec)))
+        P_x, P_y, P_x_d, P_y_d = self.compute_curve_from_parametrization(P, k, x, param)
 
         if self.all_slices:
-            P_y = np.array([int(np.round(P_y[i])) for i in range(0, len(P_y))])
-
-            # not perfect but works (if "enough" points), in order to deal with missing z slices
-            for i in range(min(P_y), max(P_y) + 1, 1):
-                if i not in P_y:
-                    P_y_temp = np.insert(P_y, np.where(P_y == i - 1)[-1][-1] + 1, i)
-                    P_x_temp = np.insert(P_x, np.where(P_y == i - 1)[-1][-1] + 1, (
-                                P_x[np.where(P_y == i - 1)[-1][-1]] + P_x[np.where(P_y == i - 1)[-1][-1] + 1]) / 2)
-                    P_x_d_temp = np.insert(P_x_d, np.where(P_y == i - 1)[-1][-1] + 1, (
-                                P_x_d[np.where(P_y == i - 1)[-1][-1]] + P_x_d[np.where(P_y == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_d_temp = np.insert(P_y_d, np.where(P_y == i - 1)[-1][-1] + 1, (
-                                P_y_d[np.where(P_y == i - 1)[-1][-1]] + P_y_d[np.where(P_y == i - 1)[-1][-1] + 1]) / 2)
-                    P_x, P_y, P_x_d, P_y_d = P_x_temp, P_y_temp, P_x_d_temp, P_y_d_temp
-
-            coord_mean = np.array([[np.mean(P_x[P_y == i]), i] for i in range(min(P_y), max(P_y) + 1, 1)])
-
-            P_x = coord_mean[:, :][:, 0]
-
-            coord_mean_d = np.array(
-                [[np.mean(P_x_d[P_y == i]), np.mean(P_y_d[P_y == i])] for i in range(min(P_y), max(P_y) + 1, 1)])
-
-            P_y = coord_mean[:, :][:, 1]
-
-            P_x_d = coord_mean_d[:, :][:, 0]
-            P_y_d = coord_mean_d[:, :][:, 1]
+            P_y, (P_x, P_x_d, P_y_d) = _average_over_slices(P_y, [P_x, P_x_d, P_y_d])
 
         return [P_x, P_y], [P_x_d, P_y_d]
 
-    def Tk(self, k, Q, Nik, ubar, u):
-        return Q[k] - self.evaluateN(Nik[-1], ubar, u) * Q[-1] - self.evaluateN(Nik[0], ubar, u) * Q[0]
-
     def isXinY(self, y, x):
-        result = True
-        for i in range(0, len(y) - 1):
-            if y[i] - y[i + 1] != 0.0:
-                result_temp = False
-                for j in range(0, len(x)):
-                    if y[i] - y[i + 1] != 0.0 and y[i] <= x[j] <= y[i + 1]:
-                        result_temp = True
-                        break
-                result = result and result_temp
-        return result
+        """
+        Check that there is at least one value of x in each non-empty interval [y[i], y[i + 1]].
+        """
+        y, x = np.asarray(y), np.sort(x)
+        ind_intervals = np.nonzero(np.diff(y) != 0.0)[0]
+        # first value of x which is >= lower bound of each interval
+        ind_x = np.searchsorted(x, y[ind_intervals], side='left')
+        is_in = ind_x < len(x)
+        is_in[is_in] = x[ind_x[is_in]] <= y[ind_intervals + 1][is_in]
+        return bool(np.all(is_in))
 
     def reconstructGlobalApproximation(self, P_x, P_y, P_z, p, n, w):
-        # p = degre de la NURBS
-        # n = nombre de points de controle desires
-        # w is the weigth on each point P
-        global Nik_temp
-        m = len(P_x)
-
-        # Calcul des chords
-        di = 0.0
-        for k in range(m - 1):
-            di += np.sqrt((P_x[k + 1] - P_x[k]) ** 2 + (P_y[k + 1] - P_y[k]) ** 2 + (P_z[k + 1] - P_z[k]) ** 2)
-        ubar = [0]
-        for k in range(m - 1):
-            # ubar.append((k+1)/float(m))  # uniform method
-            # ubar.append(ubar[-1]+abs((P_x[k+1]-P_x[k])**2 + (P_y[k+1]-P_y[k])**2 + (P_z[k+1]-P_z[k])**2)/di)  # chord length method
-            ubar.append(ubar[-1] + np.sqrt((P_x[k + 1] - P_x[k]) ** 2 + (P_y[k + 1] - P_y[k]) ** 2 + (
-                        P_z[k + 1] - P_z[k]) ** 2) / di)  # centripetal method
-
-        # the knot vector should reflect the distribution of ubar
-        d = (m + 1) / (n - p + 1)
-        u_nonuniform = [0.0] * p
-        for j in range(n - p):
-            i = int((j + 1) * d)
-            alpha = (j + 1) * d - i
-            u_nonuniform.append((1 - alpha) * ubar[i - 1] + alpha * ubar[i])
-        u_nonuniform.extend([1.0] * p)
-
-        # the knot vector can also is uniformly distributed
-        u_uniform = [0.0] * p
-        for j in range(n - p):
-            u_uniform.append((float(j) + 1) / float(n - p))
-        u_uniform.extend([1.0] * p)
-
-        # The only condition for NURBS to work here is that there is at least one point P_.. in each knot space.
-        # The uniform knot vector does not ensure this condition while the nonuniform knot vector ensure it but lack of uniformity in case of variable density of points.
-        # We need a compromise between the two methods: the knot vector must be as uniform as possible, with at least one point between each pair of knots.
-        # New algo:
-        # knotVector = uniformKnotVector
-        # while isKnotSpaceEmpty:
-        #     knotVector += gamma * (nonuniformKnotVector - nonuniformKnotVector)
-        #     # where gamma is a ratio [0,1] multiplier of an integer: 1/gamma = int
-        u_uniform = np.array(u_uniform)
-        u_nonuniform = np.array(u_nonuniform)
-        u = np.array(u_uniform, copy=True)
-        gamma = 1.0 / 10.0
-        n_iter = 0
-        while not self.isXinY(y=u, x=ubar) and n_iter <= 10000:
-            u += gamma * (u_nonuniform - u_uniform)
-            n_iter += 1
-
-        Nik_temp = [[-1 for j in range(p)] for i in range(n)]  # noqa
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        R = []
-        for k in range(m - 1):
-            Rtemp = []
-            den = 0
-            for Ni in Nik:
-                den += self.evaluateN(Ni, ubar[k], u)
-            for i in range(n - 1):
-                Rtemp.append(self.evaluateN(Nik[i], ubar[k], u) / den)
-            R.append(Rtemp)
-        R = np.matrix(R)
-
-        # create W diagonal matrix
-        W = np.diag(w[0:-1])
-
-        # calcul des denominateurs par ubar
-        denU = []
-        for k in range(m - 1):
-            temp = 0
-            for Ni in Nik:
-                temp += self.evaluateN(Ni, ubar[k], u)
-            denU.append(temp)
-        Tx = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_x, Nik, ubar[k], u) / denU[k]
-            Tx.append(somme)
-        Tx = np.matrix(Tx)
-
-        Ty = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_y, Nik, ubar[k], u) / denU[k]
-            Ty.append(somme)
-        Ty = np.matrix(Ty)
-
-        Tz = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_z, Nik, ubar[k], u) / denU[k]
-            Tz.append(somme)
-        Tz = np.matrix(Tz)
-
-        P_xb = np.linalg.pinv(R.T * W * R) * Tx.T
-        P_yb = np.linalg.pinv(R.T * W * R) * Ty.T
-        P_zb = np.linalg.pinv(R.T * W * R) * Tz.T
+        return self.reconstructGlobalApproximationND(np.column_stack((P_x, P_y, P_z)), p, n, w)
 
-        # Modification of first and last control points
-        P_xb[0], P_yb[0], P_zb[0] = P_x[0], P_y[0], P_z[0]
-        P_xb[-1], P_yb[-1], P_zb[-1] = P_x[-1], P_y[-1], P_z[-1]
-
-        # At this point, we need to check if the control points are in a correct range or if there were instability.
-        # Typically, control points should be far from the data points. One way to do so is to ensure that the
-        from numpy import std
-        std_factor = 10.0
-        std_Px, std_Py, std_Pz, std_x, std_y, std_z = std(P_xb), std(P_yb), std(P_zb), std(np.array(P_x)), std(
-            np.array(P_y)), std(np.array(P_z))
-        if std_x >= 0.1 and std_y >= 0.1 and std_z >= 0.1 and (
-                std_Px > std_factor * std_x or std_Py > std_factor * std_y or std_Pz > std_factor * std_z):
-            raise ReconstructionError()
-
-        P = [[P_xb[i, 0], P_yb[i, 0], P_zb[i, 0]] for i in range(len(P_xb))]
+    def reconstructGlobalApproximation2D(self, P_x, P_y, p, n, w):
+        return self.reconstructGlobalApproximationND(np.column_stack((P_x, P_y)), p, n, w)
 
-        return P
+    def reconstructGlobalApproximationND(self, Q, p, n, w):
+        """
+        Approximate the data points Q (array of shape (m, dim)) in the weighted least square sense with a NURBS of
+        order p and n control points.
+
+        :param Q: (m, dim) data points
+        :param p: order of the NURBS (degree + 1)
+        :param n: number of control points
+        :param w: weight of each data point
+        :return: list of control points
+        """
+        m = len(Q)
+        w = np.asarray(w, dtype=float)
 
-    def reconstructGlobalApproximation2D(self, P_x, P_y, p, n, w):
-        # p = degre de la NURBS
-        # n = nombre de points de controle desires
-        # w is the weigth on each point P
-        global Nik_temp
-        m = len(P_x)
-
-        # Calcul des chords
-        di = 0.0
-        for k in range(m - 1):
-            di += np.sqrt((P_x[k + 1] - P_x[k]) ** 2 + (P_y[k + 1] - P_y[k]) ** 2)
-        ubar = [0]
-        for k in range(m - 1):
-            # ubar.append((k+1)/float(m))  # uniform method
-            # ubar.append(ubar[-1]+abs((P_x[k+1]-P_x[k])**2 + (P_y[k+1]-P_y[k])**2 + (P_z[k+1]-P_z[k])**2)/di)  # chord length method
-            ubar.append(
-                ubar[-1] + np.sqrt((P_x[k + 1] - P_x[k]) ** 2 + (P_y[k + 1] - P_y[k]) ** 2) / di)  # centripetal method
+        # Calcul des chords (centripetal method)
+        dist = np.sqrt(np.sum(np.diff(Q, axis=0) ** 2, axis=1))
+        ubar = np.concatenate(([0.0], np.cumsum(dist / np.sum(dist))))
 
         # the knot vector should reflect the distribution of ubar
         d = (m + 1) / (n - p + 1)
-        u_nonuniform = [0.0] * p
-        for j in range(n - p):
-            i = int((j + 1) * d)
-            alpha = (j + 1) * d - i
-            u_nonuniform.append((1 - alpha) * ubar[i - 1] + alpha * ubar[i])
-        u_nonuniform.extend([1.0] * p)
+        j = np.arange(n - p)
+        i = ((j + 1) * d).astype(int)
+        alpha = (j + 1) * d - i
+        u_nonuniform = np.concatenate(([0.0] * p, (1 - alpha) * ubar[i - 1] + alpha * ubar[i], [1.0] * p))
 
         # the knot vector can also is uniformly distributed
-        u_uniform = [0.0] * p
-        for j in range(n - p):
-            u_uniform.append((float(j) + 1) / float(n - p))
-        u_uniform.extend([1.0] * p)
+        u_uniform = np.concatenate(([0.0] * p, (j + 1.0) / float(n - p), [1.0] * p))
 
         # The only condition for NURBS to work here is that there is at least one point P_.. in each knot space.
-        # The uniform knot vector does not ensure this condition while the nonuniform knot vector ensure it but lack of uniformity in case of variable density of points.
-        # We need a compromise between the two methods: the knot vector must be as uniform as possible, with at least one point between each pair of knots.
-        # New algo:
+        # The uniform knot vector does not ensure this condition while the nonuniform knot vector ensure it but lack of
+        # uniformity in case of variable density of points.
+        # We need a compromise between the two methods: the knot vector must be as uniform as possible, with at least
+        # one point between each pair of knots:
         # knotVector = uniformKnotVector
         # while isKnotSpaceEmpty:
         #     knotVector += gamma * (nonuniformKnotVector - nonuniformKnotVector)
         #     # where gamma is a ratio [0,1] multiplier of an integer: 1/gamma = int
-        u_uniform = np.array(u_uniform)
-        u_nonuniform = np.array(u_nonuniform)
         u = np.array(u_uniform, copy=True)
         gamma = 1.0 / 10.0
         n_iter = 0
@@ -745,71 +344,30 @@ class NURBS:
             u += gamma * (u_nonuniform - u_uniform)
             n_iter += 1
 
-        Nik_temp = [[-1 for j in range(p)] for i in range(n)]  # noqa
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        R = []
-        for k in range(m - 1):
-            Rtemp = []
-            den = 0
-            for Ni in Nik:
-                den += self.evaluateN(Ni, ubar[k], u)
-            for i in range(n - 1):
-                Rtemp.append(self.evaluateN(Nik[i], ubar[k], u) / den)
-            R.append(Rtemp)
-        R = np.matrix(R)
-
-        # create W diagonal matrix
-        W = np.diag(w[0:-1])
-
-        # calcul des denominateurs par ubar
-        denU = []
-        for k in range(m - 1):
-            temp = 0
-            for Ni in Nik:
-                temp += self.evaluateN(Ni, ubar[k], u)
-            denU.append(temp)
-        Tx = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_x, Nik, ubar[k], u) / denU[k]
-            Tx.append(somme)
-        Tx = np.matrix(Tx)
-
-        Ty = []
-        for i in range(n - 1):
-            somme = 0
-            for k in range(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_y, Nik, ubar[k], u) / denU[k]
-            Ty.append(somme)
-        Ty = np.matrix(Ty)
-
-        P_xb = (R.T * W * R).I * Tx.T
-        P_yb = (R.T * W * R).I * Ty.T
+        # Basis functions evaluated at all the parameters of the data points at once. The last data point and the last
+        # control point are not part of the system.
+        Nik, _ = _basis_functions(u, p, ubar[:-1])
+        den = np.sum(Nik, axis=1)
+        R = Nik[:, :n - 1] / den[:, np.newaxis]
+        T = Q[:-1] - np.outer(Nik[:, -1], Q[-1]) - np.outer(Nik[:, 0], Q[0])
+
+        # Weighted least square fit of all coordinates at once
+        sqrt_w = np.sqrt(w[:-1])[:, np.newaxis]
+        P = np.linalg.lstsq(sqrt_w * R, sqrt_w * T, rcond=None)[0]
 
         # Modification of first and last control points
-        P_xb[0], P_yb[0] = P_x[0], P_y[0]
-        P_xb[-1], P_yb[-1] = P_x[-1], P_y[-1]
+        P[0], P[-1] = Q[0], Q[-1]
 
         # At this point, we need to check if the control points are in a correct range or if there were instability.
         # Typically, control points should be far from the data points. One way to do so is to ensure that the
-        from numpy import std
         std_factor = 10.0
-        std_Px, std_Py, std_x, std_y = std(P_xb), std(P_yb), std(np.array(P_x)), std(np.array(P_y))
-        if std_x >= 0.1 and std_y >= 0.1 and (std_Px > std_factor * std_x or std_Py > std_factor * std_y):
+        std_P, std_Q = np.std(P, axis=0), np.std(Q, axis=0)
+        if np.all(std_Q >= 0.1) and np.any(std_P > std_factor * std_Q):
             raise ReconstructionError()
 
-        P = [[P_xb[i, 0], P_yb[i, 0]] for i in range(len(P_xb))]
-
-        return P
+        return P.tolist()
 
     def reconstructGlobalInterpolation(self, P_x, P_y, P_z, p):  # now in 3D
-        global Nik_temp
         n = 13
         l = len(P_x)
         newPx = P_x[::int(np.round(l / (n - 1)))]
@@ -818,194 +376,120 @@ class NURBS:
         newPx.append(P_x[-1])
         newPy.append(P_y[-1])
         newPz.append(P_z[-1])
-        n = len(newPx)
+        Q = np.column_stack((newPx, newPy, newPz))
+        n = len(Q)
 
         # Calcul du vecteur de noeuds
-        di = 0
-        for k in range(n - 1):
-            di += np.sqrt(
-                (newPx[k + 1] - newPx[k]) ** 2 + (newPy[k + 1] - newPy[k]) ** 2 + (newPz[k + 1] - newPz[k]) ** 2)
-        u = [0] * p
-        ubar = [0]
-        for k in range(n - 1):
-            ubar.append(ubar[-1] + np.sqrt(
-                (newPx[k + 1] - newPx[k]) ** 2 + (newPy[k + 1] - newPy[k]) ** 2 + (newPz[k + 1] - newPz[k]) ** 2) / di)
-        for j in range(n - p):
-            sumU = 0
-            for i in range(p):
-                sumU = sumU + ubar[j + i]
-            u.append(sumU / p)
-        u.extend([1] * p)
-
-        # Construction des fonctions basiques
-        Nik_temp = [[-1 for j in range(p)] for i in range(n)]
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Construction des matrices
-        M = []
-        for i in range(n):
-            ligneM = []
-            for j in range(n):
-                ligneM.append(self.evaluateN(Nik[j], ubar[i], u))
-            M.append(ligneM)
-        M = np.matrix(M)
-
-        # Matrice des points interpoles
-        Qx = np.matrix(newPx).T
-        Qy = np.matrix(newPy).T
-        Qz = np.matrix(newPz).T
+        dist = np.sqrt(np.sum(np.diff(Q, axis=0) ** 2, axis=1))
+        ubar = np.concatenate(([0.0], np.cumsum(dist / np.sum(dist))))
+        u = np.concatenate(([0.0] * p, [np.sum(ubar[j:j + p]) / p for j in range(n - p)], [1.0] * p))
 
         # Calcul des points de controle
-        P_xb = M.I * Qx
-        P_yb = M.I * Qy
-        P_zb = M.I * Qz
-
-        return [[P_xb[i, 0], P_yb[i, 0], P_zb[i, 0]] for i in range(len(P_xb))]
-
-    def compute_curve_from_parametrization(self, P, k, x, Nik, Nikp, param):
-        n = len(P)  # Nombre de points de controle - 1
-        P_x, P_y, P_z = [], [], []  # coord fitees
-        P_x_d, P_y_d, P_z_d = [], [], []  # derivees
-        for i in range(len(param)):
-            sum_num_x, sum_num_y, sum_num_z, sum_den = 0, 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_num_z_der, sum_den_der = 0, 0, 0, 0
-
-            for l in range(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l  # TODO: can yield UnboundLocalError: local variable 'debut' referenced before assignment
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_num_z += N_temp * point[2]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_num_z_der += N_temp_deriv * point[2]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_z.append(sum_num_z / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-            P_z_d.append(sum_num_z_der)
-
-            if sum_den <= 0.05:
-                raise ReconstructionError()
-
-        P_x = [P_x[i] for i in np.argsort(P_z)]
-        P_y = [P_y[i] for i in np.argsort(P_z)]
-        P_x_d = [P_x_d[i] for i in np.argsort(P_z)]
-        P_y_d = [P_y_d[i] for i in np.argsort(P_z)]
-        P_z_d = [P_z_d[i] for i in np.argsort(P_z)]
-        P_z = np.sort(P_z)
-
-        # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = np.array(P_x)
-        P_y = np.array(P_y)
-        P_x_d = np.array(P_x_d)
-        P_y_d = np.array(P_y_d)
-        P_z_d = np.array(P_z_d)
-        return P_x, P_y, P_z, P_x_d, P_y_d, P_z_d
+        M, _ = _basis_functions(u, p, ubar)
+        return np.linalg.solve(M, Q).tolist()
 
-    def construct3D_uniform(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
+    def compute_curve_from_parametrization(self, P, k, x, param):
+        """
+        Evaluate the curve defined by the control points P, its order k and its knot vector x, and its derivatives, at
+        each value of param. The outputs are sorted along the last coordinate.
 
+        :return: each coordinate of the curve, followed by each coordinate of the derivatives
+        """
+        P = np.asarray(P, dtype=float)
+        Nik, Nikp = _basis_functions(x, k, param)
+        sum_den = np.sum(Nik, axis=1)  # sum_den = 1 !
+        if np.any(sum_den <= 0.05):
+            raise ReconstructionError()
+        coord = Nik.dot(P) / sum_den[:, np.newaxis]
+        deriv = Nikp.dot(P)
+
+        ind_sort = np.argsort(coord[:, -1], kind='stable')
+        return tuple(coord[ind_sort].T) + tuple(deriv[ind_sort].T)
+
+    def construct3D_uniform(self, P, k, prec):  # P point de controles
         # Calcul des xi
         x = self.calculX3D(P, k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in range(k)] for i in range(n)]
-        for i in range(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in range(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in range(n)]
-        for i in range(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in range(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
         # reparametrization of the curve
         param = np.linspace(x[0], x[-1], prec)
-        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, Nik, Nikp, param)
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
         centerline = Centerline(P_x, P_y, P_z, P_x_d, P_y_d, P_z_d)
-        distances_between_points = centerline.progressive_length[1:]
         range_points = np.linspace(0.0, 1.0, prec)
-        dist_curved = np.zeros(prec)
-        for i in range(1, prec):
-            dist_curved[i] = dist_curved[i - 1] + distances_between_points[i - 1] / centerline.length
+        dist_curved = np.array(centerline.incremental_length) / centerline.length
         param = x[0] + (x[-1] - x[0]) * np.interp(range_points, dist_curved, range_points)
-        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, Nik, Nikp, param)
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
 
         if self.all_slices:
-            P_z = np.array([int(np.round(P_z[i])) for i in range(0, len(P_z))])
-
-            # not perfect but works (if "enough" points), in order to deal with missing z slices
-            for i in range(min(P_z), max(P_z) + 1, 1):
-                if i not in P_z:
-                    P_z_temp = np.insert(P_z, np.where(P_z == i - 1)[-1][-1] + 1, i)
-                    P_x_temp = np.insert(P_x, np.where(P_z == i - 1)[-1][-1] + 1,
-                                         (P_x[np.where(P_z == i - 1)[-1][-1]] + P_x[
-                                             np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_temp = np.insert(P_y, np.where(P_z == i - 1)[-1][-1] + 1,
-                                         (P_y[np.where(P_z == i - 1)[-1][-1]] + P_y[
-                                             np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_x_d_temp = np.insert(P_x_d, np.where(P_z == i - 1)[-1][-1] + 1, (
-                            P_x_d[np.where(P_z == i - 1)[-1][-1]] + P_x_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_y_d_temp = np.insert(P_y_d, np.where(P_z == i - 1)[-1][-1] + 1, (
-                            P_y_d[np.where(P_z == i - 1)[-1][-1]] + P_y_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_z_d_temp = np.insert(P_z_d, np.where(P_z == i - 1)[-1][-1] + 1, (
-                            P_z_d[np.where(P_z == i - 1)[-1][-1]] + P_z_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
-                    P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp
-
-            coord_mean = np.array(
-                [[np.mean(P_x[P_z == i]), np.mean(P_y[P_z == i]), i] for i in range(min(P_z), max(P_z) + 1, 1)])
-
-            P_x = coord_mean[:, :][:, 0]
-            P_y = coord_mean[:, :][:, 1]
-
-            coord_mean_d = np.array(
-                [[np.mean(P_x_d[P_z == i]), np.mean(P_y_d[P_z == i]), np.mean(P_z_d[P_z == i])] for i in
-                 range(min(P_z), max(P_z) + 1, 1)])
-
-            P_z = coord_mean[:, :][:, 2]
-
-            P_x_d = coord_mean_d[:, :][:, 0]
-            P_y_d = coord_mean_d[:, :][:, 1]
-            P_z_d = coord_mean_d[:, :][:, 2]
+            P_z, (P_x, P_y, P_x_d, P_y_d, P_z_d) = _average_over_slices(P_z, [P_x, P_y, P_x_d, P_y_d, P_z_d])
 
             # check if slice should be in the result, based on self.P_z
-            indexes_to_remove = []
-            for i, ind_z in enumerate(P_z):
-                if ind_z not in self.P_z:
-                    indexes_to_remove.append(i)
-
-            P_x = np.delete(P_x, indexes_to_remove)
-            P_y = np.delete(P_y, indexes_to_remove)
-            P_z = np.delete(P_z, indexes_to_remove)
-            P_x_d = np.delete(P_x_d, indexes_to_remove)
-            P_y_d = np.delete(P_y_d, indexes_to_remove)
-            P_z_d = np.delete(P_z_d, indexes_to_remove)
+            ind_keep = np.isin(P_z, self.P_z)
+            P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = [arr[ind_keep] for arr in [P_x, P_y, P_z, P_x_d, P_y_d, P_z_d]]
 
         return [P_x, P_y, P_z], [P_x_d, P_y_d, P_z_d]
 
 
+def _basis_functions(knots, k, t):
+    """
+    Evaluate all the B-spline basis functions of order k (degree k - 1) defined by a knot vector, and their
+    derivatives, for all the parameter values t at once, using the Cox-de Boor recursion.
+
+    :param knots: non-decreasing knot vector, of length n + k for n basis functions
+    :param k: int: order of the basis functions
+    :param t: parameter values, within [knots[0], knots[-1]]
+    :return: (len(t), n) matrix of basis functions, (len(t), n) matrix of their derivatives. Derivatives are scaled by\
+    k / (k - 1), as in the original polynomial implementation (only their direction is used).
+    """
+    knots = np.asarray(knots, dtype=float)
+    t = np.atleast_1d(np.asarray(t, dtype=float))[:, np.newaxis]
+    # Order 1: indicator of the knot span [knots[j], knots[j + 1][ of each parameter. The last knot belongs to the
+    # last non-empty span.
+    spans_nonempty = np.nonzero(np.diff(knots) > 0)[0]
+    span = np.clip(np.searchsorted(knots, t[:, 0], side='right') - 1, spans_nonempty[0], spans_nonempty[-1])
+    N = np.zeros((len(t), len(knots) - 1))
+    inside = (t[:, 0] >= knots[0]) & (t[:, 0] <= knots[-1])
+    N[np.nonzero(inside)[0], span[inside]] = 1.0
+    Np = np.zeros_like(N)
+
+    with np.errstate(divide='ignore'):
+        for q in range(2, k + 1):
+            den_g, den_d = knots[q - 1:-1] - knots[:-q], knots[q:] - knots[1:len(knots) - q + 1]
+            coef_g = np.where(den_g != 0, 1.0 / den_g, 0.0)
+            coef_d = np.where(den_d != 0, 1.0 / den_d, 0.0)
+            if q == k:
+                Np = k * (coef_g * N[:, :-1] - coef_d * N[:, 1:])
+            N = (t - knots[:-q]) * coef_g * N[:, :-1] + (knots[q:] - t) * coef_d * N[:, 1:]
+    return N, Np
+
+
+def _average_over_slices(z, values):
+    """
+    Round z to the nearest slice, and average values over each slice. Values of missing slices are interpolated between
+    the previous slice and the next point (not perfect but works if there are "enough" points).
+
+    :param z: sorted coordinates along the slice axis
+    :param values: list of arrays of the same length as z
+    :return: slices (float), list of averaged values for each slice
+    """
+    z = np.round(z).astype(int)
+    values = np.column_stack(values)
+    z_missing = np.setdiff1d(np.arange(z.min(), z.max() + 1), z)
+    values_missing = np.zeros((len(z_missing), values.shape[1]))
+    for i_missing, i in enumerate(z_missing):
+        ind_next = np.searchsorted(z, i)
+        if i_missing > 0 and z_missing[i_missing - 1] == i - 1:
+            value_previous = values_missing[i_missing - 1]
+        else:
+            value_previous = values[ind_next - 1]
+        values_missing[i_missing] = (value_previous + values[ind_next]) / 2
+    z, values = np.concatenate((z, z_missing)), np.vstack((values, values_missing))
+
+    slices, ind_slice, count_slice = np.unique(z, return_inverse=True, return_counts=True)
+    values_mean = [np.bincount(ind_slice, weights=values[:, i]) / count_slice for i in range(values.shape[1])]
+    return slices.astype(float), values_mean
+
+
 def getSize(x, y, z, file_name=None):
     from math import sqrt
     # get pixdim
@@ -5,6 +5,7 @@
 import os, sys, logging
 
 import numpy as np
+import psutil
 from scipy.ndimage.measurements import center_of_mass, label
 from skimage.exposure import rescale_intensity
 from scipy.ndimage import distance_transform_edt
@@ -189,16 +190,22 @@ def crop_image_around_centerline(im_in, ctr_in, crop_size):
 
 
 def scan_slice(z_slice, model, mean_train, std_train, coord_lst, patch_shape, z_out_dim):
-    """Scan the entire axial slice to detect the centerline."""
+    """
+    Scan the entire axial slice to detect the centerline. All the non-overlapping blocks of the slice (listed in\
+    coord_lst) are predicted at once.
+    """
     z_slice_out = np.zeros(z_out_dim)
     sum_lst = []
-    # loop across all the non-overlapping blocks of a cross-sectional slice
-    for idx, coord in enumerate(coord_lst):
-        block = z_slice[coord[0]:coord[2], coord[1]:coord[3]]
-        block_nn = np.expand_dims(np.expand_dims(block, 0), -1)
-        block_nn_norm = _normalize_data(block_nn, mean_train, std_train)
-        block_pred = model.predict(block_nn_norm, batch_size=BATCH_SIZE)
+    # all the non-overlapping blocks of the cross-sectional slice: (n_x, n_y, patch_shape[0], patch_shape[1]) view
+    # Note: the slice is padded/cropped in heatmap() so that it is tiled by the blocks
+    px, py = patch_shape[0], patch_shape[1]
+    blocks_grid = z_slice.reshape(z_slice.shape[0] // px, px, z_slice.shape[1] // py, py).swapaxes(1, 2)
+    blocks = np.stack([blocks_grid[coord[0] // px, coord[1] // py] for coord in coord_lst])
+    blocks_nn_norm = _normalize_data(np.expand_dims(blocks, -1), mean_train, std_train)
+    blocks_pred = model.predict(blocks_nn_norm, batch_size=len(coord_lst))
 
+    for idx, coord in enumerate(coord_lst):
+        block_pred = blocks_pred[idx:idx + 1]
         if coord[2] > z_out_dim[0]:
             x_end = patch_shape[0] - (coord[2] - z_out_dim[0])
         else:
@@ -266,7 +273,8 @@ def heatmap(im, model, patch_shape, mean_train, std_train, brain_bool=True):
             x_0, x_1 = _find_crop_start_end(x_CoM, patch_shape[0], data_im.shape[0])
             y_0, y_1 = _find_crop_start_end(y_CoM, patch_shape[1], data_im.shape[1])
             block = data_im[x_0:x_1, y_0:y_1, zz]
-            block_nn = np.expand_dims(np.expand_dims(block, 0), -1)
+            # copy, so that the normalization does not modify data_im (which is scanned if the SC is not detected)
+            block_nn = np.expand_dims(np.expand_dims(block, 0), -1).copy()
             block_nn_norm = _normalize_data(block_nn, mean_train, std_train)
             block_pred = model.predict(block_nn_norm, batch_size=BATCH_SIZE)
 
@@ -334,10 +342,29 @@ def _normalize_data(data, mean, std):
     return data
 
 
-def segment_2d(model_fname, contrast_type, input_size, im_in):
+def _get_batch_size_2d(input_size, features=32, ram_fraction=0.1, batch_size_max=64):
+    """
+    Number of axial slices predicted at once by segment_2d(), given the available RAM. The memory used by a slice is\
+    dominated by the activations of the network, which are roughly bounded by 16 float32 feature maps of `features`\
+    channels at the input resolution.
+
+    :param input_size: (height, width) of the slices
+    :param features: int: number of features of the first layer of the network
+    :param ram_fraction: float: fraction of the available RAM that can be used
+    :param batch_size_max: int
+    :return: int
     """
-    Segment data using 2D convolutions.
+    bytes_per_slice = 16 * features * input_size[0] * input_size[1] * 4
+    batch_size = int(psutil.virtual_memory().available * ram_fraction // bytes_per_slice)
+    return max(1, min(batch_size, batch_size_max))
+
 
+def segment_2d(model_fname, contrast_type, input_size, im_in, batch_size=None):
+    """
+    Segment data using 2D convolutions. Axial slices are stacked into (batch_size, height, width, 1) tensors, so that\
+    the model is called once per batch of slices.
+
+    :param batch_size: int: number of slices predicted at once. If None, it is set according to the available RAM.
     :return: seg_crop.data: ndarray float32: Output prediction
     """
     seg_model = nn_architecture_seg(height=input_size[0],
@@ -350,13 +377,18 @@ def segment_2d(model_fname, contrast_type, input_size, im_in):
 
     seg_crop = zeros_like(im_in, dtype=np.float32)
 
+    if batch_size is None:
+        batch_size = _get_batch_size_2d(input_size)
+    logger.debug("Batch size for 2D segmentation: {}".format(batch_size))
+
     data_norm = im_in.data
     # TODO: use sct_progress_bar
-    for zz in range(im_in.dim[2]):
-        # 2D CNN prediction
-        pred_seg = seg_model.predict(np.expand_dims(np.expand_dims(data_norm[:, :, zz], -1), 0),
-                                     batch_size=BATCH_SIZE)[0, :, :, 0]
-        seg_crop.data[:, :, zz] = pred_seg
+    for z_start in range(0, im_in.dim[2], batch_size):
+        z_stop = min(z_start + batch_size, im_in.dim[2])
+        # 2D CNN prediction: (z, x, y, 1) tensor
+        batch = np.expand_dims(np.moveaxis(data_norm[:, :, z_start:z_stop], -1, 0), -1)
+        pred_seg = seg_model.predict(batch, batch_size=z_stop - z_start)[..., 0]
+        seg_crop.data[:, :, z_start:z_stop] = np.moveaxis(pred_seg, 0, -1)
 
     return seg_crop.data
 
@@ -422,7 +454,8 @@ def uncrop_image(ref_in, data_crop, x_crop_lst, y_crop_lst, z_crop_lst):
 
 
 def deep_segmentation_spinalcord(im_image, contrast_type, ctr_algo='cnn', ctr_file=None, brain_bool=True,
-                                 kernel_size='2d', threshold_seg=None, remove_temp_files=1, verbose=1):
+                                 kernel_size='2d', threshold_seg=None, remove_temp_files=1, verbose=1,
+                                 batch_size=None):
     """
     Main pipeline for CNN-based segmentation of the spinal cord.
 
@@ -436,6 +469,8 @@ def deep_segmentation_spinalcord(im_image, contrast_type, ctr_algo='cnn', ctr_fi
         for no binarization (i.e. soft segmentation output)
     :param remove_temp_files:
     :param verbose:
+    :param batch_size: Number of slices segmented at once with the 2D kernel. If None, it is set according to the\
+        available RAM. See segment_2d().
     :return:
     """
     if threshold_seg is None:
@@ -506,7 +541,8 @@ def deep_segmentation_spinalcord(im_image, contrast_type, ctr_algo='cnn', ctr_fi
         seg_crop = segment_2d(model_fname=segmentation_model_fname,
                               contrast_type=contrast_type,
                               input_size=(crop_size, crop_size),
-                              im_in=im_norm_in)
+                              im_in=im_norm_in,
+                              batch_size=batch_size)
     elif kernel_size == '3d':
         # segment data using 3D convolutions
         logger.info("Segmenting the spinal cord using deep learning on 3D patches...")
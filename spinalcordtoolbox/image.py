@@ -906,6 +906,32 @@ def find_zmin_zmax(im, threshold=0.1):
     return zmin, zmax
 
 
+def load_slab(fname, zmin, zmax, orientation='RPI'):
+    """
+    Load the slices [zmin, zmax) of an image, along the 3rd axis of the given orientation (e.g. I-S for RPI). Only\
+    this slab is read from the file (through nibabel array proxies), which saves I/O and memory when a small part of\
+    a large volume is needed.
+
+    :param fname: str: image file (at least 3D)
+    :param zmin: int: first slice of the slab, in the given orientation
+    :param zmax: int: last slice of the slab + 1, in the given orientation
+    :param orientation: str: orientation of the output image
+    :return: Image: slab, in the given orientation. It has no path.
+    """
+    img = nib.load(fname)
+    orientation_native = orientation_string_nib2sct("".join(nib.orientations.aff2axcodes(img.header.get_best_affine())))
+    perm, inversion = _get_permutations(orientation_native, orientation)
+    # Axis of the file that corresponds to the 3rd axis of the output orientation
+    axis = perm.index(2)
+    n = img.shape[axis]
+    if not 0 <= zmin < zmax <= n:
+        raise ValueError("Invalid slab [{}, {}) for {} slices: {}".format(zmin, zmax, n, fname))
+    slicer = [slice(None)] * len(img.shape)
+    slicer[axis] = slice(zmin, zmax) if inversion[axis] == 1 else slice(n - zmax, n - zmin)
+    img_slab = img.slicer[tuple(slicer)]
+    return Image(np.asanyarray(img_slab.dataobj), hdr=img_slab.header).change_orientation(orientation)
+
+
 def get_dimension(im_file, verbose=1):
     """
     Get dimension from Image or nibabel object. Manages 2D, 3D or 4D images.
@@ -6,7 +6,12 @@ from __future__ import absolute_import
 
 import math
 import platform
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import cpu_count
 import numpy as np
+from scipy.ndimage import map_coordinates
+from scipy.spatial import ConvexHull
 from skimage import measure, transform
 import logging
 import nibabel
@@ -18,7 +23,8 @@ from spinalcordtoolbox.resampling import resample_nib
 from spinalcordtoolbox.utils import sct_progress_bar
 
 
-def compute_shape(segmentation, angle_correction=True, param_centerline=None, verbose=1):
+def compute_shape(segmentation, angle_correction=True, param_centerline=None, verbose=1, n_jobs=1, chunksize=None,
+                  method='upsampling', crop_margin=5):
     """
     Compute morphometric measures of the spinal cord in the transverse (axial) plane from the segmentation.
     The segmentation could be binary or weighted for partial volume [0,1].
@@ -27,6 +33,16 @@ def compute_shape(segmentation, angle_correction=True, param_centerline=None, ve
     :param angle_correction:
     :param param_centerline: see centerline.core.ParamCenterline()
     :param verbose:
+    :param n_jobs: int: number of processes used to compute the shape of the slices. Slices are independent once the\
+    centerline is fitted, so they are distributed across a pool of processes if n_jobs > 1. Set to 0 or a negative\
+    value to use all available cores minus abs(n_jobs).
+    :param chunksize: int: number of slices sent at once to each process. If None, slices are split in about 4 chunks\
+    per process.
+    :param method: {'upsampling', 'moments'}: method used to compute the shape properties of each slice. See\
+    _properties2d() and _properties2d_moments().
+    :param crop_margin: int: margin (in voxels of the input image) kept around the segmentation in the axial plane. Only\
+    this region is resampled and processed. Along z, the region is restricted to the slices of the segmentation, unless\
+    param_centerline.minmax is False (the centerline is then fitted on all slices, as without cropping).
     :return metrics: Dict of class Metric(). If a metric cannot be calculated, its value will be nan.
     :return fit_results: class centerline.core.FitResults()
     """
@@ -46,16 +62,20 @@ def compute_shape(segmentation, angle_correction=True, param_centerline=None, ve
     # Getting image dimensions. x, y and z respectively correspond to RL, PA and IS.
     nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
     pr = min([px, py])
-    # Resample to isotropic resolution in the axial plane. Use the minimum pixel dimension as target dimension.
-    im_segr = resample_nib(im_seg, new_size=[pr, pr, pz], new_size_type='mm', interpolation='linear')
+    # Resample to isotropic resolution in the axial plane. Use the minimum pixel dimension as target dimension. Only the
+    # region around the segmentation is resampled: im_segr is the box of the resampled grid starting at voxel offset.
+    # When minmax is False, the centerline is fitted on all slices (including the empty ones), so the full z extent
+    # needs to be kept for the fitting to be the same as without cropping.
+    crop_z = param_centerline is None or param_centerline.minmax
+    im_segr, offset = _resample_crop(im_seg, new_size=[pr, pr, pz], margin=crop_margin, crop_z=crop_z)
 
     # Update dimensions from resampled image.
-    nx, ny, nz, nt, px, py, pz, pt = im_segr.dim
+    _, _, _, nt, px, py, pz, pt = im_segr.dim
 
     # Extract min and max index in Z direction
     data_seg = im_segr.data
     X, Y, Z = (data_seg > 0).nonzero()
-    min_z_index, max_z_index = min(Z), max(Z)
+    min_z_index, max_z_index = min(Z) + offset[2], max(Z) + offset[2]
 
     # Initialize dictionary of property_list, with 1d array of nan (default value if no property for a given slice).
     shape_properties = {key: np.full_like(np.empty(nz), np.nan, dtype=np.double) for key in property_list}
@@ -66,65 +86,50 @@ def compute_shape(segmentation, angle_correction=True, param_centerline=None, ve
         # compute the spinal cord centerline based on the spinal cord segmentation
         # here, param_centerline.minmax needs to be False because we need to retrieve the total number of input slices
         _, arr_ctl, arr_ctl_der, fit_results = get_centerline(im_segr, param=param_centerline, verbose=verbose)
+        # Express the coordinates of the centerline in the full resampled grid
+        for key, offset_axis in [('xmean', offset[0]), ('xfit', offset[0]), ('ymean', offset[1]), ('yfit', offset[1]),
+                                 ('zmean', offset[2]), ('zref', offset[2])]:
+            setattr(fit_results.data, key, np.asarray(getattr(fit_results.data, key)) + offset_axis)
+
+    # Gather the inputs of each slice: 2D patch and angles between the centerline and the normal to the slice
+    z_indexes = np.arange(min_z_index, max_z_index + 1)
+    data_slices = im_segr.data[:, :, z_indexes - offset[2]]
+    if angle_correction:
+        angles_AP, angles_RL = _get_angles(arr_ctl_der[0][:len(z_indexes)], arr_ctl_der[1][:len(z_indexes)],
+                                           [px, py, pz])
+        # Apply affine transformation to account for the angle between the centerline and the normal to the patch
+        data_slices = _correct_angles(data_slices, angles_AP, angles_RL, offset[:2])
+    else:
+        angles_AP, angles_RL = np.zeros(len(z_indexes)), np.zeros(len(z_indexes))
+    patches = (data_slices[:, :, i] for i in range(len(z_indexes)))
+    if method not in PROPERTIES2D_METHODS:
+        raise ValueError("method must be one of {}".format(list(PROPERTIES2D_METHODS)))
+    compute_slice = partial(_compute_shape_slice, dim=[px, py, pz], method=method)
 
     # Loop across z and compute shape analysis
-    for iz in sct_progress_bar(range(min_z_index, max_z_index + 1), unit='iter', unit_scale=False, desc="Compute shape analysis",
-                               ascii=True, ncols=80):
-        # Extract 2D patch
-        current_patch = im_segr.data[:, :, iz]
-        if angle_correction:
-            # Extract tangent vector to the centerline (i.e. its derivative)
-            tangent_vect = np.array([arr_ctl_der[0][iz - min_z_index] * px,
-                                     arr_ctl_der[1][iz - min_z_index] * py,
-                                     pz])
-            # Normalize vector by its L2 norm
-            tangent_vect = tangent_vect / np.linalg.norm(tangent_vect)
-            # Compute the angle about AP axis between the centerline and the normal vector to the slice
-            v0 = [tangent_vect[0], tangent_vect[2]]
-            v1 = [0, 1]
-            angle_AP_rad = np.math.atan2(np.linalg.det([v0, v1]), np.dot(v0, v1))
-            # Compute the angle about RL axis between the centerline and the normal vector to the slice
-            v0 = [tangent_vect[1], tangent_vect[2]]
-            v1 = [0, 1]
-            angle_RL_rad = np.math.atan2(np.linalg.det([v0, v1]), np.dot(v0, v1))
-            # Apply affine transformation to account for the angle between the centerline and the normal to the patch
-            tform = transform.AffineTransform(scale=(np.cos(angle_RL_rad), np.cos(angle_AP_rad)))
-            # Convert to float64, to avoid problems in image indexation causing issues when applying transform.warp
-            current_patch = current_patch.astype(np.float64)
-            # TODO: make sure pattern does not go extend outside of image border
-            current_patch_scaled = transform.warp(current_patch,
-                                                  tform.inverse,
-                                                  output_shape=current_patch.shape,
-                                                  order=1,
-                                                  )
-        else:
-            current_patch_scaled = current_patch
-            angle_AP_rad, angle_RL_rad = 0.0, 0.0
-        # compute shape properties on 2D patch
-        shape_property = _properties2d(current_patch_scaled, [px, py])
+    if n_jobs < 1:
+        n_jobs = max(1, cpu_count() + n_jobs)
+    kwargs_progress = dict(total=len(z_indexes), unit='iter', unit_scale=False, desc="Compute shape analysis",
+                           ascii=True, ncols=80)
+    if n_jobs == 1:
+        shape_property_list = [compute_slice(*args) for args in
+                               sct_progress_bar(zip(patches, angles_AP, angles_RL), **kwargs_progress)]
+    else:
+        if chunksize is None:
+            chunksize = max(1, int(math.ceil(len(z_indexes) / (4.0 * n_jobs))))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # Results are yielded in the order of the slices
+            shape_property_list = list(sct_progress_bar(
+                executor.map(compute_slice, patches, angles_AP, angles_RL, chunksize=chunksize), **kwargs_progress))
+
+    for iz, shape_property in zip(z_indexes, shape_property_list):
         if shape_property is not None:
-            # Add custom fields
-            shape_property['angle_AP'] = angle_AP_rad * 180.0 / math.pi
-            shape_property['angle_RL'] = angle_RL_rad * 180.0 / math.pi
-            shape_property['length'] = pz / (np.cos(angle_AP_rad) * np.cos(angle_RL_rad))
             # Loop across properties and assign values for function output
             for property_name in property_list:
                 shape_properties[property_name][iz] = shape_property[property_name]
         else:
             logging.warning('\nNo properties for slice: {}'.format(iz))
 
-        """ DEBUG
-        from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-        from matplotlib.figure import Figure
-        fig = Figure()
-        FigureCanvas(fig)
-        ax = fig.add_subplot(111)
-        ax.imshow(current_patch_scaled)
-        ax.grid()
-        ax.set_xlabel('y')
-        ax.set_ylabel('x')
-        fig.savefig('tmp_fig.png')
-        """
     metrics = {}
     for key, value in shape_properties.items():
         # Making sure all entries added to metrics have results
@@ -134,6 +139,119 @@ def compute_shape(segmentation, angle_correction=True, param_centerline=None, ve
     return metrics, fit_results
 
 
+def _resample_crop(im_seg, new_size, margin, crop_z=True):
+    """
+    Resample the region of a segmentation around the cord. The output grid is the box, around the segmentation, of the\
+    grid that resample_nib(im_seg, new_size, new_size_type='mm') would create, so that voxel (i, j, k) of the output\
+    corresponds to voxel (i, j, k) + offset of the fully resampled image.
+
+    :param im_seg: Image: 3D segmentation
+    :param new_size: list of float: resolution of the output grid (in mm)
+    :param margin: int: margin (in voxels of im_seg) kept around the segmentation along x and y.
+    :param crop_z: bool: restrict the box to the slices containing the segmentation along z. Otherwise, all slices are\
+      kept.
+    :return: Image: resampled segmentation
+    :return: offset: ndarray: voxel coordinates of the origin of the output grid in the full resampled grid
+    """
+    shape = np.array(im_seg.data.shape[:3])
+    # Same grid as resample_nib()
+    shape_r = np.array([int(np.round(shape[i] * float(im_seg.dim[4 + i]) / float(new_size[i]))) for i in range(3)])
+    zooms = shape / shape_r.astype(float)
+    # Bounding box of the segmentation, in voxels of the output grid
+    mask = im_seg.data > 0
+    nonzero = [np.flatnonzero(np.any(mask, axis=axes)) for axes in [(1, 2), (0, 2), (0, 1)]]
+    if not len(nonzero[2]):
+        raise ValueError("The segmentation is empty.")
+    margins = np.array([margin, margin, 0])
+    bbox_min = np.array([idx[0] for idx in nonzero]) - margins
+    bbox_max = np.array([idx[-1] for idx in nonzero]) + margins
+    offset = np.clip(np.floor(bbox_min / zooms).astype(int), 0, shape_r - 1)
+    shape_crop = np.clip(np.ceil(bbox_max / zooms).astype(int) + 1, 1, shape_r) - offset
+    if not crop_z:
+        offset[2], shape_crop[2] = 0, shape_r[2]
+    affine_r = np.dot(im_seg.hdr.get_best_affine(), np.diag(list(zooms) + [1]))
+    affine_crop = affine_r.copy()
+    affine_crop[:3, 3] = np.dot(affine_r, list(offset) + [1])[:3]
+    im_dest = nibabel.nifti1.Nifti1Image(np.zeros(shape_crop, dtype=np.uint8), affine_crop)
+    return resample_nib(im_seg, image_dest=im_dest, interpolation='linear'), offset
+
+
+def _get_angles(deriv_x, deriv_y, dim):
+    """
+    Compute the angles between the centerline and the normal vector to the axial slices.
+
+    :param deriv_x: ndarray: derivative dx/dz of the centerline at each slice (in voxel)
+    :param deriv_y: ndarray: derivative dy/dz of the centerline at each slice (in voxel)
+    :param dim: [px, py, pz]: pixel dimension of the image (in mm).
+    :return: angle_AP_rad, angle_RL_rad: ndarrays of angles (in rad) about the AP and RL axes.
+    """
+    px, py, pz = dim
+    # Extract tangent vector to the centerline (i.e. its derivative)
+    tangent_vect = np.stack([np.asarray(deriv_x) * px, np.asarray(deriv_y) * py, np.full(len(deriv_x), float(pz))])
+    # Normalize vector by its L2 norm
+    tangent_vect /= np.linalg.norm(tangent_vect, axis=0)
+    # Angle about AP axis (resp. RL axis) between the centerline and the normal vector to the slice, i.e. the angle
+    # between the projection of the tangent in the RL-IS plane (resp. AP-IS plane) and the IS axis
+    angle_AP_rad = np.arctan2(tangent_vect[0], tangent_vect[2])
+    angle_RL_rad = np.arctan2(tangent_vect[1], tangent_vect[2])
+    return angle_AP_rad, angle_RL_rad
+
+
+def _correct_angles(data, angle_AP_rad, angle_RL_rad, offset=(0, 0)):
+    """
+    Scale axial slices by the cosine of the angles between the centerline and the normal to the slices, so that the\
+    cross-section of the cord is seen as if the slice was orthogonal to the centerline. The inverse-mapped coordinates\
+    of all slices are built at once and sampled with a single (bilinear) interpolation of the stack of slices.
+
+    :param data: ndarray: (nx, ny, n) stack of axial slices
+    :param angle_AP_rad: ndarray: (n,) angles about the AP axis (in rad), see _get_angles()
+    :param angle_RL_rad: ndarray: (n,) angles about the RL axis (in rad), see _get_angles()
+    :param offset: (x, y): voxel coordinates of the origin of the patches in the full axial slices. The scaling is\
+    about the origin of the full slice, so the same pixels are interpolated whatever the cropping: the output patch is\
+    the window of the scaled full slice starting at floor(scale * offset).
+    :return: ndarray: (nx, ny, n) float64 stack of scaled slices.
+    """
+    nx, ny, n = data.shape
+    coord = np.empty((3, nx, ny, n))
+    # x (resp. y) is scaled by the cosine of the angle about the AP axis (resp. RL axis)
+    for axis, (size, angle) in enumerate([(nx, angle_AP_rad), (ny, angle_RL_rad)]):
+        scale = np.cos(angle)
+        offset_scaled = scale * offset[axis]
+        # Position in the input patch of each pixel of the output patch
+        coord_axis = (np.arange(size)[:, np.newaxis] - (offset_scaled - np.floor(offset_scaled))) / scale
+        coord[axis] = np.expand_dims(coord_axis, axis=1 - axis)
+    coord[2] = np.arange(n)
+    # Pad slices with one voxel of zeros, so that pixels near the borders are interpolated with the zeros outside of\
+    # the patch (like skimage.transform.warp), with mode='constant' (mode='grid-constant' requires scipy>=1.6)
+    coord[:2] += 1
+    # Convert to float64, to avoid problems in image indexation
+    data_pad = np.pad(data.astype(np.float64), ((1, 1), (1, 1), (0, 0)), 'constant')
+    return map_coordinates(data_pad, coord, order=1, mode='constant', cval=0.0)
+
+
+def _compute_shape_slice(current_patch, angle_AP_rad, angle_RL_rad, dim, method='upsampling'):
+    """
+    Compute shape properties of one axial slice.
+
+    :param current_patch: 2D axial patch of the segmentation, already corrected for the angle between the centerline\
+    and the slice (see _correct_angles()).
+    :param angle_AP_rad: float: angle about the AP axis between the centerline and the normal to the slice (in rad).
+    :param angle_RL_rad: float: angle about the RL axis between the centerline and the normal to the slice (in rad).
+    :param dim: [px, py, pz]: pixel dimension of the image (in mm).
+    :param method: {'upsampling', 'moments'}: see compute_shape().
+    :return: dict of properties (see _properties2d()), or None if they could not be computed.
+    """
+    px, py, pz = dim
+    # compute shape properties on 2D patch
+    shape_property = PROPERTIES2D_METHODS[method](current_patch, [px, py])
+    if shape_property is not None:
+        # Add custom fields
+        shape_property['angle_AP'] = angle_AP_rad * 180.0 / math.pi
+        shape_property['angle_RL'] = angle_RL_rad * 180.0 / math.pi
+        shape_property['length'] = pz / (np.cos(angle_AP_rad) * np.cos(angle_RL_rad))
+    return shape_property
+
+
 def _properties2d(image, dim):
     """
     Compute shape property of the input 2D image. Accounts for partial volume information.
@@ -199,6 +317,89 @@ def _properties2d(image, dim):
     return properties
 
 
+def _properties2d_moments(image, dim):
+    """
+    Compute shape property of the input 2D image from its intensity-weighted moments. Same as _properties2d(), but\
+    computed analytically at the native resolution of the partial volume mask instead of upsampling it: area and\
+    centroid are given by the moments of order 0 and 1, and the ellipse (axes, orientation, eccentricity) by the\
+    central moments of order 2. The solidity is computed from the sub-pixel contour of the object (marching squares).
+    :param image: 2D input image in uint8 or float (weighted for partial volume) that has a single object.
+    :param dim: [px, py]: Physical dimension of the image (in mm). X,Y respectively correspond to AP,RL.
+    :return:
+    """
+    # Check if slice is empty
+    if not image.any():
+        logging.debug('The slice is empty.')
+        return None
+    # Normalize between 0 and 1
+    image_norm = ((image - image.min()) / (image.max() - image.min())).astype(np.float64)
+    # Check number of objects
+    if measure.label(image_norm > 0.5).max() > 1:
+        logging.debug('There is more than one object on this slice.')
+        return None
+    # Moments of the partial volume mask
+    mu = measure.moments_central(image_norm, order=2)
+    m00 = mu[0, 0]
+    centroid = tuple(measure.moments(image_norm, order=1)[[1, 0], [0, 1]] / m00)
+    # Covariance matrix of the object, and eigenvalues sorted in decreasing order (same convention as regionprops)
+    cov = np.array([[mu[2, 0], mu[1, 1]], [mu[1, 1], mu[0, 2]]]) / m00
+    eigvals = np.clip(np.linalg.eigvalsh(cov)[::-1], 0, None)
+    major_axis_length, minor_axis_length = 4 * np.sqrt(eigvals)
+    eccentricity = np.sqrt(1 - eigvals[1] / eigvals[0]) if eigvals[0] > 0 else 0.0
+    # Angle between the 0th axis (rows) and the major axis of the ellipse, in [-pi/2, pi/2] (see regionprops)
+    if cov[0, 0] == cov[1, 1]:
+        orientation = math.pi / 4 if cov[0, 1] > 0 else -math.pi / 4
+    else:
+        orientation = 0.5 * math.atan2(2 * cov[0, 1], cov[0, 0] - cov[1, 1])
+    # Compute area with weighted segmentation and adjust area with physical pixel size
+    area = m00 * dim[0] * dim[1]
+    # Compute ellipse orientation, modulo pi, in deg, and between [0, 90]
+    orientation = fix_orientation(orientation)
+    # Find RL and AP diameter based on major/minor axes and cord orientation
+    [diameter_AP, diameter_RL] = _find_AP_and_RL_diameter(major_axis_length, minor_axis_length, orientation, dim)
+    # Deal with https://github.com/neuropoly/spinalcordtoolbox/issues/2307
+    if any(x in platform.platform() for x in ['Darwin-15', 'Darwin-16']):
+        solidity = np.nan
+    else:
+        solidity = _solidity_from_contour(image_norm)
+    # Fill up dictionary
+    properties = {'area': area,
+                  'diameter_AP': diameter_AP,
+                  'diameter_RL': diameter_RL,
+                  'centroid': centroid,
+                  'eccentricity': eccentricity,
+                  'orientation': orientation,
+                  'solidity': solidity,  # convexity measure
+                  }
+
+    return properties
+
+
+def _solidity_from_contour(image):
+    """
+    Compute the solidity (ratio between the area of the object and the area of its convex hull) from the iso-contour\
+    at 0.5 of a 2D image.
+    :param image: 2D image normalized between 0 and 1, with a single object.
+    :return: float
+    """
+    # Pad the image so that the contour is closed, even if the object touches the border of the image
+    contours = measure.find_contours(np.pad(image, 1, mode='constant'), 0.5)
+    if not contours:
+        return np.nan
+    contour = max(contours, key=len)
+    # Shoelace formula
+    area = 0.5 * abs(np.dot(contour[:, 0], np.roll(contour[:, 1], 1)) - np.dot(contour[:, 1], np.roll(contour[:, 0], 1)))
+    # In 2D, the "volume" of the convex hull is its area
+    return area / ConvexHull(contour).volume
+
+
+# Functions computing the shape properties of a 2D slice
+PROPERTIES2D_METHODS = {
+    'upsampling': _properties2d,
+    'moments': _properties2d_moments,
+}
+
+
 def fix_orientation(orientation):
     """Re-map orientation from skimage.regionprops from [-pi/2,pi/2] to [0,90] and rotate by 90deg because image axis
     are inverted"""
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#########################################################################################
+# Utilities for dense displacement fields (ITK/ANTs convention)
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2020 NeuroPoly, Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# License: see the LICENSE.TXT
+#########################################################################################
+
+import logging
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.utils import sct_progress_bar
+
+logger = logging.getLogger(__name__)
+
+# Displacement value used by SCT to flag voxels for which the transformation is not defined
+OUTSIDE_VALUE = 100000.0
+
+
+def warp2ras(data_warp):
+    """
+    Convert the vectors of an ITK displacement field (LPS convention) to the RAS convention used by nibabel.
+
+    :param data_warp: ndarray: (nx, ny, nz, 1, 3) displacement field, as stored in the NIfTI file.
+    :return: ndarray: (3, nx, ny, nz) float32 displacement field in RAS, with undefined vectors set to NaN.
+    """
+    data_ras = np.moveaxis(np.asarray(data_warp, dtype=np.float32).reshape(data_warp.shape[:3] + (3,)), -1, 0).copy()
+    data_ras[np.broadcast_to(np.any(np.abs(data_ras) >= OUTSIDE_VALUE, axis=0), data_ras.shape)] = np.nan
+    data_ras[0:2] *= -1
+    return data_ras
+
+
+def ras2warp(displacements):
+    """
+    Convert RAS displacements to the ITK (LPS) convention, in place. NaN vectors are flagged with OUTSIDE_VALUE.
+
+    :param displacements: ndarray: (..., 3) displacements in RAS.
+    :return: ndarray: the same array, in LPS.
+    """
+    displacements[..., 0:2] *= -1
+    displacements[np.isnan(displacements).any(axis=-1)] = OUTSIDE_VALUE
+    return displacements
+
+
+def create_warp_image(im_ref, data_warp=None):
+    """
+    Create an empty displacement field Image on the grid of a reference image.
+
+    :param im_ref: Image: reference image defining the grid of the field.
+    :param data_warp: ndarray: (nx, ny, nz, 1, 3) data. If None, a field full of zeros is created.
+    :return: Image
+    """
+    nx, ny, nz = im_ref.data.shape[:3]
+    if data_warp is None:
+        data_warp = np.zeros((nx, ny, nz, 1, 3), dtype=np.float32)
+    hdr_warp = im_ref.hdr.copy()
+    hdr_warp.set_data_shape(data_warp.shape)
+    hdr_warp.set_intent('vector', (), '')
+    hdr_warp.set_data_dtype('float32')
+    return Image(data_warp, hdr=hdr_warp)
+
+
+def invert_warp(im_warp, im_ref=None, max_iter=20, tolerance=0.01, chunk_size=8, verbose=1):
+    """
+    Invert a dense displacement field using fixed-point iteration.
+
+    The forward field u maps a point x of its own grid to x + u(x). The inverse field v is defined on the grid of\
+    im_ref and satisfies y + v(y) = x where y = x + u(x), so it is the fixed point of v(y) = -u(y + v(y)). The\
+    forward field is sampled with trilinear interpolation and the output grid is processed by slabs of chunk_size\
+    slices, so that temporary arrays do not scale with the full volume.
+
+    :param im_warp: Image: forward displacement field (nx, ny, nz, 1, 3), ITK convention.
+    :param im_ref: Image: image defining the grid of the inverse field. If None, the grid of im_warp is used.
+    :param max_iter: int: maximum number of fixed-point iterations.
+    :param tolerance: float: convergence tolerance, in mm, on the update of the inverse displacements.
+    :param chunk_size: int: number of slices (along the 3rd axis of im_ref) processed at once.
+    :param verbose: int: display a progress bar if >0.
+    :return: Image: inverse displacement field (nx, ny, nz, 1, 3), float32, on the grid of im_ref. Voxels for which\
+    the inverse could not be computed (outside of the forward field domain) are set to OUTSIDE_VALUE.
+    """
+    if im_ref is None:
+        im_ref = im_warp
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a strictly positive integer.")
+    if max_iter < 1:
+        raise ValueError("max_iter must be a strictly positive integer.")
+
+    data_fwd = warp2ras(im_warp.data)
+    affine_fwd_inv = np.linalg.inv(im_warp.hdr.get_best_affine())
+    affine_ref = im_ref.hdr.get_best_affine()
+    nx, ny, nz = im_ref.data.shape[:3]
+    im_inv = create_warp_image(im_ref)
+
+    n_unconverged, residual_max = 0, 0.0
+    for z_start in sct_progress_bar(range(0, nz, chunk_size), disable=not verbose, unit='slab'):
+        z_stop = min(z_start + chunk_size, nz)
+        indexes = np.mgrid[0:nx, 0:ny, z_start:z_stop].reshape(3, -1).T
+        coord_phys = indexes @ affine_ref[:3, :3].T + affine_ref[:3, 3]
+        disp = np.zeros_like(coord_phys)
+        active = np.arange(len(coord_phys))
+        for _ in range(max_iter):
+            coord_fwd = (coord_phys[active] + disp[active]) @ affine_fwd_inv[:3, :3].T + affine_fwd_inv[:3, 3]
+            disp_new = np.stack([-map_coordinates(data_fwd[i], coord_fwd.T, order=1, mode='constant', cval=np.nan)
+                                 for i in range(3)], axis=-1)
+            residual = np.linalg.norm(disp_new - disp[active], axis=1)
+            disp[active] = disp_new
+            # NaN residuals correspond to points outside of the forward field domain: stop iterating on them
+            active = active[residual > tolerance]
+            if not len(active):
+                break
+        if len(active):
+            n_unconverged += len(active)
+            residual_max = max(residual_max, np.nanmax(residual[residual > tolerance]))
+        im_inv.data[:, :, z_start:z_stop, 0, :] = ras2warp(disp).reshape((nx, ny, z_stop - z_start, 3))
+
+    if n_unconverged:
+        logger.warning("Inversion did not converge for {} voxels after {} iterations (maximum residual: {:.4f} mm)."
+                       .format(n_unconverged, max_iter, residual_max))
+    return im_inv
@@ -10,14 +10,19 @@ from __future__ import absolute_import
 
 import os, time, logging, inspect
 import bisect
+import gzip
+import hashlib
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 import numpy as np
-from nibabel import Nifti1Image, save
 
 from spinalcordtoolbox.types import Centerline
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.centerline.core import ParamCenterline, get_centerline
-from spinalcordtoolbox.utils import sct_progress_bar
+from spinalcordtoolbox.utils import sct_progress_bar, __version__
 
 import sct_utils as sct
 from sct_image import pad_image
@@ -47,6 +52,8 @@ class SpinalCordStraightener(object):
         self.speed_factor = 1.0  # Speed parameter
         self.xy_size = 70  # in mm
         self.param_centerline = param_centerline
+        self.n_slices_per_slab = 8  # number of slices processed at once when computing the warping fields
+        self.n_threads = int(os.getenv('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', cpu_count()))
 
         # QC metrics
         self.accuracy_results = 0
@@ -226,23 +233,11 @@ class SpinalCordStraightener(object):
 
             if self.discs_input_filename != "" and self.discs_ref_filename != "":
                 discs_input_image = Image('labels_input.nii.gz')
-                coord = discs_input_image.getNonZeroCoordinates(sorting='z', reverse_coord=True)
-                coord_physical = []
-                for c in coord:
-                    c_p = discs_input_image.transfo_pix2phys([[c.x, c.y, c.z]]).tolist()[0]
-                    c_p.append(c.value)
-                    coord_physical.append(c_p)
-                centerline.compute_vertebral_distribution(coord_physical)
+                centerline.compute_vertebral_distribution(_get_discs_physical_coordinates(discs_input_image))
                 centerline.save_centerline(image=discs_input_image, fname_output='discs_input_image.nii.gz')
 
                 discs_ref_image = Image('labels_ref.nii.gz')
-                coord = discs_ref_image.getNonZeroCoordinates(sorting='z', reverse_coord=True)
-                coord_physical = []
-                for c in coord:
-                    c_p = discs_ref_image.transfo_pix2phys([[c.x, c.y, c.z]]).tolist()[0]
-                    c_p.append(c.value)
-                    coord_physical.append(c_p)
-                centerline_straight.compute_vertebral_distribution(coord_physical)
+                centerline_straight.compute_vertebral_distribution(_get_discs_physical_coordinates(discs_ref_image))
                 centerline_straight.save_centerline(image=discs_ref_image, fname_output='discs_ref_image.nii.gz')
 
         else:
@@ -357,11 +352,9 @@ class SpinalCordStraightener(object):
             curved_points = centerline.progressive_length
             straight_points = centerline_straight.progressive_length
             range_points = np.linspace(0, 1, number_of_points)
-            dist_curved = np.zeros(number_of_points)
-            dist_straight = np.zeros(number_of_points)
-            for i in range(1, number_of_points):
-                dist_curved[i] = dist_curved[i - 1] + curved_points[i - 1] / centerline.length
-                dist_straight[i] = dist_straight[i - 1] + straight_points[i - 1] / centerline_straight.length
+            dist_curved = np.concatenate(([0], np.cumsum(curved_points[:-1]) / centerline.length))
+            dist_straight = np.concatenate(
+                ([0], np.cumsum(straight_points[:number_of_points - 1]) / centerline_straight.length))
             plt.plot(range_points, dist_curved)
             plt.plot(range_points, dist_straight)
             plt.grid(True)
@@ -371,23 +364,17 @@ class SpinalCordStraightener(object):
         # alignment_mode = 'length'
         alignment_mode = 'levels'
 
-        lookup_curved2straight = list(range(centerline.number_of_points))
+        lookup_curved2straight = np.arange(centerline.number_of_points)
         if self.discs_input_filename != "":
             # create look-up table curved to straight
-            for index in range(centerline.number_of_points):
-                disc_label = centerline.l_points[index]
-                if alignment_mode == 'length':
-                    relative_position = centerline.dist_points[index]
-                else:
-                    relative_position = centerline.dist_points_rel[index]
-                idx_closest = centerline_straight.get_closest_to_absolute_position(disc_label, relative_position,
-                                                                                   backup_index=index,
-                                                                                   backup_centerline=centerline_straight,
-                                                                                   mode=alignment_mode)
-                if idx_closest is not None:
-                    lookup_curved2straight[index] = idx_closest
-                else:
-                    lookup_curved2straight[index] = 0
+            if alignment_mode == 'length':
+                relative_positions = centerline.dist_points
+            else:
+                relative_positions = centerline.dist_points_rel
+            lookup_curved2straight = centerline_straight.get_closest_to_absolute_positions(
+                centerline.l_points, relative_positions, backup_indexes=np.arange(centerline.number_of_points),
+                backup_centerline=centerline_straight, mode=alignment_mode)
+            lookup_curved2straight[lookup_curved2straight == -1] = 0
         for p in range(0, len(lookup_curved2straight) // 2):
             if lookup_curved2straight[p] == lookup_curved2straight[p + 1]:
                 lookup_curved2straight[p] = 0
@@ -398,22 +385,18 @@ class SpinalCordStraightener(object):
                 lookup_curved2straight[p] = 0
             else:
                 break
-        lookup_curved2straight = np.array(lookup_curved2straight)
 
-        lookup_straight2curved = list(range(centerline_straight.number_of_points))
+        lookup_straight2curved = np.arange(centerline_straight.number_of_points)
         if self.discs_input_filename != "":
-            for index in range(centerline_straight.number_of_points):
-                disc_label = centerline_straight.l_points[index]
-                if alignment_mode == 'length':
-                    relative_position = centerline_straight.dist_points[index]
-                else:
-                    relative_position = centerline_straight.dist_points_rel[index]
-                idx_closest = centerline.get_closest_to_absolute_position(disc_label, relative_position,
-                                                                          backup_index=index,
-                                                                          backup_centerline=centerline_straight,
-                                                                          mode=alignment_mode)
-                if idx_closest is not None:
-                    lookup_straight2curved[index] = idx_closest
+            if alignment_mode == 'length':
+                relative_positions = centerline_straight.dist_points
+            else:
+                relative_positions = centerline_straight.dist_points_rel
+            lookup = centerline.get_closest_to_absolute_positions(
+                centerline_straight.l_points, relative_positions,
+                backup_indexes=np.arange(centerline_straight.number_of_points), backup_centerline=centerline_straight,
+                mode=alignment_mode)
+            lookup_straight2curved = np.where(lookup == -1, lookup_straight2curved, lookup)
         for p in range(0, len(lookup_straight2curved) // 2):
             if lookup_straight2curved[p] == lookup_straight2curved[p + 1]:
                 lookup_straight2curved[p] = 0
@@ -424,73 +407,26 @@ class SpinalCordStraightener(object):
                 lookup_straight2curved[p] = 0
             else:
                 break
-        lookup_straight2curved = np.array(lookup_straight2curved)
-
-        # Create volumes containing curved and straight warping fields
-        data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3))
-        data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3))
 
         # 5. compute transformations
         # Curved and straight images and the same dimensions, so we compute both warping fields at the same time.
-        # b. determine which plane of spinal cord centreline it is included
-        # sct.printv(nx * ny * nz, nx_s * ny_s * nz_s)
-
+        # The warping fields are computed by slabs of slices, which are distributed across a pool of threads, and
+        # written directly into uncompressed (memory-mapped) NIfTI files, so that memory usage does not depend on the
+        # number of slices.
         if self.curved2straight:
-            for u in sct_progress_bar(range(nz_s)):
-                x_s, y_s, z_s = np.mgrid[0:nx_s, 0:ny_s, u:u + 1]
-                indexes_straight = np.array(list(zip(x_s.ravel(), y_s.ravel(), z_s.ravel())))
-                physical_coordinates_straight = image_centerline_straight.transfo_pix2phys(indexes_straight)
-                nearest_indexes_straight = centerline_straight.find_nearest_indexes(physical_coordinates_straight)
-                distances_straight = centerline_straight.get_distances_from_planes(physical_coordinates_straight,
-                                                                                   nearest_indexes_straight)
-                lookup = lookup_straight2curved[nearest_indexes_straight]
-                indexes_out_distance_straight = np.logical_or(
-                    np.logical_or(distances_straight > self.threshold_distance,
-                                  distances_straight < -self.threshold_distance), lookup == 0)
-                projected_points_straight = centerline_straight.get_projected_coordinates_on_planes(
-                    physical_coordinates_straight, nearest_indexes_straight)
-                coord_in_planes_straight = centerline_straight.get_in_plans_coordinates(projected_points_straight,
-                                                                                        nearest_indexes_straight)
-
-                coord_straight2curved = centerline.get_inverse_plans_coordinates(coord_in_planes_straight, lookup)
-                displacements_straight = coord_straight2curved - physical_coordinates_straight
-                # Invert Z coordinate as ITK & ANTs physical coordinate system is LPS- (RAI+)
-                # while ours is LPI-
-                # Refs: https://sourceforge.net/p/advants/discussion/840261/thread/2a1e9307/#fb5a
-                #  https://www.slicer.org/wiki/Coordinate_systems
-                displacements_straight[:, 2] = -displacements_straight[:, 2]
-                displacements_straight[indexes_out_distance_straight] = [100000.0, 100000.0, 100000.0]
-
-                data_warp_curved2straight[indexes_straight[:, 0], indexes_straight[:, 1], indexes_straight[:, 2], 0, :]\
-                    = -displacements_straight
-
+            data_warp_curved2straight = _create_warp_file(
+                'tmp.curve2straight.nii', hdr_warp_s, image_centerline_straight.data.shape)
+            _compute_warp_field(
+                image_centerline_straight, centerline_straight, centerline, lookup_straight2curved,
+                self.threshold_distance, to_straight=False, n_slices=self.n_slices_per_slab,
+                n_threads=self.n_threads, out=data_warp_curved2straight)
         if self.straight2curved:
-            for u in sct_progress_bar(range(nz)):
-                x, y, z = np.mgrid[0:nx, 0:ny, u:u + 1]
-                indexes = np.array(list(zip(x.ravel(), y.ravel(), z.ravel())))
-                physical_coordinates = image_centerline_pad.transfo_pix2phys(indexes)
-                nearest_indexes_curved = centerline.find_nearest_indexes(physical_coordinates)
-                distances_curved = centerline.get_distances_from_planes(physical_coordinates,
-                                                                        nearest_indexes_curved)
-                lookup = lookup_curved2straight[nearest_indexes_curved]
-                indexes_out_distance_curved = np.logical_or(
-                    np.logical_or(distances_curved > self.threshold_distance,
-                                  distances_curved < -self.threshold_distance), lookup == 0)
-                projected_points_curved = centerline.get_projected_coordinates_on_planes(physical_coordinates,
-                                                                                         nearest_indexes_curved)
-                coord_in_planes_curved = centerline.get_in_plans_coordinates(projected_points_curved,
-                                                                             nearest_indexes_curved)
-
-                coord_curved2straight = centerline_straight.points[lookup]
-                coord_curved2straight[:, 0:2] += coord_in_planes_curved[:, 0:2]
-                coord_curved2straight[:, 2] += distances_curved
-
-                displacements_curved = coord_curved2straight - physical_coordinates
-
-                displacements_curved[:, 2] = -displacements_curved[:, 2]
-                displacements_curved[indexes_out_distance_curved] = [100000.0, 100000.0, 100000.0]
-
-                data_warp_straight2curved[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements_curved
+            data_warp_straight2curved = _create_warp_file(
+                'tmp.straight2curve.nii', hdr_warp, image_centerline_pad.data.shape)
+            _compute_warp_field(
+                image_centerline_pad, centerline, centerline_straight, lookup_curved2straight,
+                self.threshold_distance, to_straight=True, n_slices=self.n_slices_per_slab,
+                n_threads=self.n_threads, out=data_warp_straight2curved)
 
         # Creation of the safe zone based on pre-calculated safe boundaries
         coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix(
@@ -499,25 +435,22 @@ class SpinalCordStraightener(object):
             [[0, 0, bound_straight[0]]]), image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[1]]])
 
         if radius_safe > 0:
-            data_warp_curved2straight[:, :, 0:coord_bound_straight_inf[0][2], 0, :] = 100000.0
-            data_warp_curved2straight[:, :, coord_bound_straight_sup[0][2]:, 0, :] = 100000.0
-            data_warp_straight2curved[:, :, 0:coord_bound_curved_inf[0][2], 0, :] = 100000.0
-            data_warp_straight2curved[:, :, coord_bound_curved_sup[0][2]:, 0, :] = 100000.0
-
-        # Generate warp files as a warping fields
-        hdr_warp_s.set_intent('vector', (), '')
-        hdr_warp_s.set_data_dtype('float32')
-        hdr_warp.set_intent('vector', (), '')
-        hdr_warp.set_data_dtype('float32')
+            if self.curved2straight:
+                data_warp_curved2straight[:, :, 0:coord_bound_straight_inf[0][2], 0, :] = 100000.0
+                data_warp_curved2straight[:, :, coord_bound_straight_sup[0][2]:, 0, :] = 100000.0
+            if self.straight2curved:
+                data_warp_straight2curved[:, :, 0:coord_bound_curved_inf[0][2], 0, :] = 100000.0
+                data_warp_straight2curved[:, :, coord_bound_curved_sup[0][2]:, 0, :] = 100000.0
+
+        # Flush warping fields to disk
         if self.curved2straight:
-            img = Nifti1Image(data_warp_curved2straight, None, hdr_warp_s)
-            save(img, 'tmp.curve2straight.nii.gz')
-            logger.info('Warping field generated: tmp.curve2straight.nii.gz')
-
+            data_warp_curved2straight.flush()
+            del data_warp_curved2straight
+            logger.info('Warping field generated: tmp.curve2straight.nii')
         if self.straight2curved:
-            img = Nifti1Image(data_warp_straight2curved, None, hdr_warp)
-            save(img, 'tmp.straight2curve.nii.gz')
-            logger.info('Warping field generated: tmp.straight2curve.nii.gz')
+            data_warp_straight2curved.flush()
+            del data_warp_straight2curved
+            logger.info('Warping field generated: tmp.straight2curve.nii')
 
         image_centerline_straight.save(fname_ref)
         if self.curved2straight:
@@ -527,7 +460,7 @@ class SpinalCordStraightener(object):
                      '-r', fname_ref,
                      '-i', 'data.nii',
                      '-o', 'tmp.anat_rigid_warp.nii.gz',
-                     '-t', 'tmp.curve2straight.nii.gz',
+                     '-t', 'tmp.curve2straight.nii',
                      '-n', 'BSpline[3]'],
                     is_sct_binary=True,
                     verbose=verbose)
@@ -543,53 +476,26 @@ class SpinalCordStraightener(object):
                      '-r', fname_ref,
                      '-i', 'centerline.nii.gz',
                      '-o', 'tmp.centerline_straight.nii.gz',
-                     '-t', 'tmp.curve2straight.nii.gz',
+                     '-t', 'tmp.curve2straight.nii',
                      '-n', 'NearestNeighbor'],
                     is_sct_binary=True,
                     verbose=verbose)
             file_centerline_straight = Image('tmp.centerline_straight.nii.gz', verbose=verbose)
-            nx, ny, nz, nt, px, py, pz, pt = file_centerline_straight.dim
-            coordinates_centerline = file_centerline_straight.getNonZeroCoordinates(sorting='z')
-            mean_coord = []
-            for z in range(coordinates_centerline[0].z, coordinates_centerline[-1].z):
-                temp_mean = [coord.value for coord in coordinates_centerline if coord.z == z]
-                if temp_mean:
-                    mean_value = np.mean(temp_mean)
-                    mean_coord.append(
-                        np.mean([[coord.x * coord.value / mean_value, coord.y * coord.value / mean_value]
-                                 for coord in coordinates_centerline if coord.z == z], axis=0))
-
-            # compute error between the straightened centerline and the straight line.
-            x0 = file_centerline_straight.data.shape[0] / 2.0
-            y0 = file_centerline_straight.data.shape[1] / 2.0
-            count_mean = 0
-            if number_of_points >= 10:
-                mean_c = mean_coord[2:-2]  # we don't include the four extrema because there are usually messy.
-            else:
-                mean_c = mean_coord
-            for coord_z in mean_c:
-                if not np.isnan(np.sum(coord_z)):
-                    dist = ((x0 - coord_z[0]) * px) ** 2 + ((y0 - coord_z[1]) * py) ** 2
-                    self.mse_straightening += dist
-                    dist = np.sqrt(dist)
-                    if dist > self.max_distance_straightening:
-                        self.max_distance_straightening = dist
-                    count_mean += 1
-            self.mse_straightening = np.sqrt(self.mse_straightening / float(count_mean))
+            self.mse_straightening, self.max_distance_straightening = _compute_straightening_accuracy(
+                file_centerline_straight, exclude_extrema=number_of_points >= 10)
 
             self.elapsed_time_accuracy = time.time() - time_accuracy_results
 
         os.chdir(curdir)
 
         # Generate output file (in current folder)
-        # TODO: do not uncompress the warping field, it is too time consuming!
         logger.info('Generate output files...')
         if self.curved2straight:
-            sct.generate_output_file(os.path.join(path_tmp, "tmp.curve2straight.nii.gz"),
-                                     os.path.join(self.path_output, "warp_curve2straight.nii.gz"), verbose)
+            _compress_file(os.path.join(path_tmp, "tmp.curve2straight.nii"),
+                           os.path.join(self.path_output, "warp_curve2straight.nii.gz"))
         if self.straight2curved:
-            sct.generate_output_file(os.path.join(path_tmp, "tmp.straight2curve.nii.gz"),
-                                     os.path.join(self.path_output, "warp_straight2curve.nii.gz"), verbose)
+            _compress_file(os.path.join(path_tmp, "tmp.straight2curve.nii"),
+                           os.path.join(self.path_output, "warp_straight2curve.nii.gz"))
 
         # create ref_straight.nii.gz file that can be used by other SCT functions that need a straight reference space
         if self.curved2straight:
@@ -620,6 +526,297 @@ class SpinalCordStraightener(object):
         return fname_straight
 
 
+def get_straightening_params(sc_straight):
+    """
+    Return the parameters of a straightener which influence its outputs (warping fields and straight reference), so
+    that identical straightenings run by different tools share the same cache entry.
+
+    :param sc_straight: SpinalCordStraightener: straightener, configured as it will be run
+    :return: dict
+    """
+    params = {
+        'precision': float(sc_straight.precision),
+        'threshold_distance': float(sc_straight.threshold_distance),
+        'speed_factor': float(sc_straight.speed_factor),
+        'xy_size': float(sc_straight.xy_size),
+        'template_orientation': int(sc_straight.template_orientation),
+        'use_straight_reference': bool(sc_straight.use_straight_reference),
+        'curved2straight': bool(sc_straight.curved2straight),
+        'straight2curved': bool(sc_straight.straight2curved),
+    }
+    for k, v in vars(sc_straight.param_centerline).items():
+        params['centerline_' + k] = v
+    return params
+
+
+class StraighteningCache(object):
+    """
+    Cache of straightening outputs (warping fields and straight reference), shared across folders and tools.
+
+    Entries are stored under a directory named after a key, which is derived from the content of the segmentation
+    (and of any other input file), the straightening parameters and the SCT version. Entries are populated atomically
+    (written in a temporary folder, then renamed) so that concurrent processes never see partial entries, and the least
+    recently used entries are removed when the size of the cache exceeds size_max.
+
+    The location of the cache can be set with the environment variable SCT_STRAIGHTENING_CACHE (set it to "off" to
+    disable the cache), and its maximum size (in MB) with SCT_STRAIGHTENING_CACHE_SIZE.
+    """
+    files = ['warp_curve2straight.nii.gz', 'warp_straight2curve.nii.gz', 'straight_ref.nii.gz']
+
+    def __init__(self, path=None, size_max=None):
+        """
+        :param path: str: folder of the cache. Default: $SCT_STRAIGHTENING_CACHE, or ~/.cache/spinalcordtoolbox/straightening
+        :param size_max: int: maximum size of the cache, in MB. Default: $SCT_STRAIGHTENING_CACHE_SIZE, or 2000.
+        """
+        if path is None:
+            path = os.environ.get('SCT_STRAIGHTENING_CACHE',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'spinalcordtoolbox', 'straightening'))
+        self.enabled = path.lower() not in ['', 'off', 'no', 'false']
+        self.path = os.path.abspath(path) if self.enabled else None
+        if size_max is None:
+            size_max = float(os.environ.get('SCT_STRAIGHTENING_CACHE_SIZE', 2000))
+        self.size_max = size_max * 1024 ** 2
+
+    def key(self, fname_seg, params=None, fnames_extra=()):
+        """
+        Compute the key of an entry.
+
+        :param fname_seg: str: segmentation (or centerline) used for straightening
+        :param params: dict: straightening parameters which can influence the outputs. Use get_straightening_params()\
+          so that keys computed by different tools match.
+        :param fnames_extra: list of str: other input files which can influence the outputs (e.g. disc labels)
+        :return: str
+        """
+        h = hashlib.sha256()
+        for fname in [fname_seg] + list(fnames_extra):
+            img = Image(fname)
+            # Hash image content (and geometry) rather than file bytes, so that the key does not depend on the file
+            # name, compression or irrelevant header fields.
+            h.update(str((img.data.shape, img.data.dtype.str)).encode('utf-8'))
+            h.update(np.ascontiguousarray(img.data).tobytes())
+            h.update(np.asarray(img.hdr.get_best_affine(), dtype=np.float64).tobytes())
+        for k, v in sorted((params or {}).items()):
+            h.update('{}={!r};'.format(k, v).encode('utf-8'))
+        h.update(__version__.encode('utf-8'))
+        return h.hexdigest()
+
+    def fetch(self, key, path_dest='.'):
+        """
+        Copy the outputs of an entry into path_dest.
+
+        :return: bool: True if the entry exists (cache hit), False otherwise
+        """
+        if not self.enabled:
+            return False
+        path_entry = os.path.join(self.path, key)
+        if not all(os.path.isfile(os.path.join(path_entry, fname)) for fname in self.files):
+            return False
+        try:
+            for fname in self.files:
+                shutil.copy(os.path.join(path_entry, fname), os.path.join(path_dest, fname))
+            # Mark entry as recently used
+            os.utime(path_entry, None)
+        except (IOError, OSError):
+            # The entry was removed by another process while copying
+            logger.warning("Straightening cache entry {} could not be read.".format(key))
+            return False
+        logger.info("Reusing straightening outputs from cache: {}".format(path_entry))
+        return True
+
+    def store(self, key, path_src='.'):
+        """
+        Copy the outputs located in path_src into a new entry, then remove the least recently used entries if the cache
+        is too large.
+        """
+        if not self.enabled:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        path_entry = os.path.join(self.path, key)
+        path_tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+        try:
+            for fname in self.files:
+                shutil.copy(os.path.join(path_src, fname), os.path.join(path_tmp, fname))
+            os.rename(path_tmp, path_entry)
+        except (IOError, OSError):
+            # Entry was populated concurrently by another process (or could not be written)
+            shutil.rmtree(path_tmp, ignore_errors=True)
+            return
+        self.prune()
+
+    def prune(self):
+        """
+        Remove the least recently used entries until the size of the cache is below size_max.
+        """
+        entries = []
+        for key in os.listdir(self.path):
+            path_entry = os.path.join(self.path, key)
+            if key.startswith('.') or not os.path.isdir(path_entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path_entry, f)) for f in os.listdir(path_entry))
+                entries.append((os.path.getmtime(path_entry), size, path_entry))
+            except OSError:
+                continue
+        size_total = sum(size for _, size, _ in entries)
+        for _, size, path_entry in sorted(entries):
+            if size_total <= self.size_max:
+                break
+            # Rename before removing, so that other processes never read a partially removed entry
+            path_removed = os.path.join(self.path, '.rm-{}-{}'.format(os.path.basename(path_entry), os.getpid()))
+            try:
+                os.rename(path_entry, path_removed)
+            except OSError:
+                continue
+            shutil.rmtree(path_removed, ignore_errors=True)
+            size_total -= size
+
+
+def _compute_straightening_accuracy(img, exclude_extrema=True):
+    """
+    Compute the error between a straightened centerline/segmentation and the central vertical line of the image.
+
+    :param img: Image of the straightened centerline or segmentation
+    :param exclude_extrema: bool: exclude the two first and last slices, because they are usually messy
+    :return: root mean square distance and maximum distance (in mm) in the axial plane
+    """
+    nx, ny, nz, nt, px, py, pz, pt = img.dim
+    x, y, z = np.nonzero(img.data > 0)
+    weights = img.data[x, y, z].astype(np.float64)
+    # Weighted centroid of each slice, computed for all slices at once
+    sum_weights = np.bincount(z, weights=weights, minlength=nz)
+    centroid_x = np.bincount(z, weights=x * weights, minlength=nz)
+    centroid_y = np.bincount(z, weights=y * weights, minlength=nz)
+    slices = np.arange(z.min(), z.max())
+    slices = slices[np.bincount(z, minlength=nz)[slices] > 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid_x, centroid_y = centroid_x[slices] / sum_weights[slices], centroid_y[slices] / sum_weights[slices]
+    if exclude_extrema:
+        centroid_x, centroid_y = centroid_x[2:-2], centroid_y[2:-2]
+
+    # compute error between the straightened centerline and the straight line.
+    x0, y0 = img.data.shape[0] / 2.0, img.data.shape[1] / 2.0
+    dist_squared = ((x0 - centroid_x) * px) ** 2 + ((y0 - centroid_y) * py) ** 2
+    dist_squared = dist_squared[~np.isnan(dist_squared)]
+    return np.sqrt(np.mean(dist_squared)), np.max(np.sqrt(dist_squared), initial=0.0)
+
+
+def _get_displacements(coord_phys, centerline, centerline_dest, lookup_table, threshold_distance, to_straight):
+    """
+    Compute the displacements (ITK convention) that bring physical points onto the corresponding points of the
+    destination space.
+
+    :param coord_phys: (N, 3) physical coordinates of the voxels of the reference space
+    :param centerline: Centerline of the reference space
+    :param centerline_dest: Centerline of the destination space
+    :param lookup_table: ndarray: index of the destination centerline point corresponding to each point of centerline
+    :param threshold_distance: float: distance to the nearest plane above which the displacement is not defined
+    :param to_straight: bool: whether the destination centerline is straight (i.e. aligned with the z axis)
+    :return: (N, 3) displacements
+    """
+    nearest_indexes = centerline.find_nearest_indexes(coord_phys)
+    distances = centerline.get_distances_from_planes(coord_phys, nearest_indexes)
+    lookup = lookup_table[nearest_indexes]
+    indexes_out_distance = np.logical_or(np.abs(distances) > threshold_distance, lookup == 0)
+    projected_points = centerline.get_projected_coordinates_on_planes(coord_phys, nearest_indexes)
+    coord_in_planes = centerline.get_in_plans_coordinates(projected_points, nearest_indexes)
+
+    if to_straight:
+        coord_dest = centerline_dest.points[lookup]
+        coord_dest[:, 0:2] += coord_in_planes[:, 0:2]
+        coord_dest[:, 2] += distances
+    else:
+        coord_dest = centerline_dest.get_inverse_plans_coordinates(coord_in_planes, lookup)
+
+    displacements = coord_dest - coord_phys
+    # Invert Z coordinate as ITK & ANTs physical coordinate system is LPS- (RAI+)
+    # while ours is LPI-
+    # Refs: https://sourceforge.net/p/advants/discussion/840261/thread/2a1e9307/#fb5a
+    #  https://www.slicer.org/wiki/Coordinate_systems
+    displacements[:, 2] = -displacements[:, 2]
+    displacements[indexes_out_distance] = [100000.0, 100000.0, 100000.0]
+    return -displacements
+
+
+def _compute_warp_field(image, centerline, centerline_dest, lookup_table, threshold_distance, to_straight,
+                        n_slices=8, n_threads=1, out=None):
+    """
+    Compute the warping field defined on the grid of image, by slabs of n_slices slices. Slabs are independent and
+    are distributed across a pool of n_threads threads (numpy and the KDTree queries release the GIL).
+
+    See _get_displacements() for the description of the other parameters.
+    :param out: (nx, ny, nz, 1, 3) array (e.g. memory-mapped file, see _create_warp_file()) in which the warping field\
+    is written. If None, a new float32 array is allocated.
+    :return: (nx, ny, nz, 1, 3) warping field
+    """
+    nx, ny, nz = image.data.shape[:3]
+    affine = image.hdr.get_best_affine()
+    data_warp = np.zeros((nx, ny, nz, 1, 3), dtype=np.float32) if out is None else out
+
+    def compute_slab(z_start):
+        z_stop = min(z_start + n_slices, nz)
+        indexes = np.mgrid[0:nx, 0:ny, z_start:z_stop].reshape(3, -1).T
+        coord_phys = indexes @ affine[:3, :3].T + affine[:3, 3]
+        displacements = _get_displacements(coord_phys, centerline, centerline_dest, lookup_table, threshold_distance,
+                                           to_straight)
+        data_warp[:, :, z_start:z_stop, 0, :] = displacements.reshape((nx, ny, z_stop - z_start, 3))
+
+    slabs = range(0, nz, n_slices)
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        # Consume the iterator so that exceptions raised in threads are propagated
+        for _ in sct_progress_bar(executor.map(compute_slab, slabs), total=len(slabs), unit='slab'):
+            pass
+    return data_warp
+
+
+def _create_warp_file(fname, hdr, shape_ref):
+    """
+    Create an uncompressed NIfTI warping field file and map its data in memory.
+
+    :param fname: str: file name (.nii)
+    :param hdr: Nifti1Header of the reference image of the warping field
+    :param shape_ref: shape of the reference image
+    :return: (nx, ny, nz, 1, 3) float32 numpy.memmap. Changes are written to the file once flushed.
+    """
+    shape = tuple(shape_ref[:3]) + (1, 3)
+    hdr = hdr.copy()
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype('float32')
+    hdr.set_intent('vector', (), '')
+    hdr.set_slope_inter(None, None)
+    hdr['vox_offset'] = 0  # let nibabel compute the offset of the data
+    with open(fname, 'wb') as f:
+        hdr.write_to(f)
+        offset = int(hdr.get_data_offset())
+        # Allocate the (sparse) file without writing the data
+        f.truncate(offset + int(np.prod(shape)) * 4)
+    # NIfTI data are stored in Fortran order
+    return np.memmap(fname, dtype=hdr.get_data_dtype(), mode='r+', offset=offset, shape=shape, order='F')
+
+
+def _compress_file(fname_in, fname_out):
+    """
+    Compress a file with gzip (e.g. .nii to .nii.gz) by chunks, without loading it in memory, and remove the input.
+    """
+    with open(fname_in, 'rb') as f_in, gzip.open(fname_out, 'wb', compresslevel=1) as f_out:
+        shutil.copyfileobj(f_in, f_out, 16 * 1024 ** 2)
+    os.remove(fname_in)
+    logger.info('File created: {}'.format(fname_out))
+
+
+def _get_discs_physical_coordinates(img):
+    """
+    Return the physical coordinates and values of the disc labels, sorted by decreasing z.
+
+    :param img: Image of disc labels
+    :return: list of [x, y, z, value]
+    """
+    x, y, z = np.nonzero(img.data > 0)
+    order = np.argsort(-z, kind='stable')
+    coord = np.stack((x[order], y[order], z[order]), axis=1)
+    values = img.data[x[order], y[order], z[order]]
+    return np.hstack((img.transfo_pix2phys(coord), values[:, np.newaxis])).tolist()
+
+
 def _get_centerline(img, param_centerline, verbose):
     nx, ny, nz, nt, px, py, pz, pt = img.dim
     _, arr_ctl, arr_ctl_der, _ = get_centerline(img, param_centerline, verbose=verbose)
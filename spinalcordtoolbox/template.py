@@ -4,12 +4,242 @@
 
 from __future__ import absolute_import
 
+import os
+import json
 import logging
+import hashlib
+import tempfile
+from collections import namedtuple
+
 import numpy as np
 
+from spinalcordtoolbox.image import Image, load_slab
+from spinalcordtoolbox.utils import __version__
+
 logger = logging.getLogger(__name__)
 
 
+class VertLevelIndex(object):
+    """
+    Index of the vertebral level of each slice of a vertebral labeling, computed in a single pass over the image. The\
+    level of a slice is the average of its non-null and finite values, rounded to the closest integer (same as\
+    get_slices_from_vertebral_levels()).
+    Important: This class assumes that the 3rd dimension is Z.
+
+    Example:
+
+    .. code:: python
+
+        index = VertLevelIndex(Image('PAM50_levels.nii.gz').change_orientation('RPI'))
+        index.get_slices(3)  # slices of C3
+        index.get_level(120)  # level of slice 120
+    """
+    def __init__(self, im_vertlevel):
+        """
+        :param im_vertlevel: image object of vertebral labeling (e.g., label/template/PAM50_levels.nii.gz)
+        """
+        data = np.asarray(im_vertlevel.data)
+        data = data.reshape(-1, data.shape[2])
+        mask = (data != 0) & np.isfinite(data)
+        counts = np.count_nonzero(mask, axis=0)
+        sums = np.where(mask, data, 0).sum(axis=0, dtype=np.float64)
+        # Level of each slice (None for slices without label)
+        self.levels = [int(np.round(sums[iz] / counts[iz])) if counts[iz] else None for iz in range(len(counts))]
+        # Slices of each level, sorted
+        self.slices = {}
+        for iz, level in enumerate(self.levels):
+            if level is not None:
+                self.slices.setdefault(level, []).append(iz)
+
+    def get_slices(self, level):
+        """
+        :param level: int: vertebral level
+        :return: list of int: slices of this level
+        """
+        return list(self.slices.get(level, []))
+
+    def get_level(self, idx_slice):
+        """
+        :param idx_slice: int: slice (z)
+        :return: int: vertebral level. If no level is found (only zeros on this slice), return None.
+        """
+        return self.levels[idx_slice]
+
+
+# Label cropped to its bounding box. Values are data * scale if data was quantized (scale is None otherwise).
+CompactLabel = namedtuple('CompactLabel', ['shape', 'start', 'data', 'scale', 'dtype'])
+
+
+class LabelStack(object):
+    """
+    Stack of partial volume labels (e.g. the white matter atlas), stored compactly. Each label is cropped to the\
+    bounding box of its non-null voxels and can optionally be quantized to uint8, and label files are only read when\
+    one of their labels is accessed. Indexing the last dimension returns a dense array, like the array obtained by\
+    concatenating all labels along the 4th dimension:
+
+    .. code:: python
+
+        labels = LabelStack(['PAM50_atlas_00.nii.gz', 'PAM50_atlas_01.nii.gz', 'PAM50_atlas_02.nii.gz'])
+        labels[..., 1]  # (nx, ny, nz): only reads PAM50_atlas_01.nii.gz
+        labels[..., [0, 2]]  # (nx, ny, nz, 2)
+
+    Labels are reoriented to RPI. Compact labels can be cached on disk (see path_cache), so that processes using the\
+    same atlas (e.g. batch jobs in template space) do not read and crop the label files again. Cached labels are\
+    memory-mapped: all processes share the same copy through the page cache of the operating system, or in RAM if the\
+    cache is located in a tmpfs such as /dev/shm.
+    """
+    def __init__(self, fnames, quantize=False, path_cache=None, slab=None):
+        """
+        :param fnames: list of str: label files, in the order of the last dimension.
+        :param quantize: bool: quantize each label to uint8, i.e. 256 values between 0 and its maximum. Labels with\
+        negative or non-finite values are not quantized.
+        :param path_cache: str: folder of the cache of compact labels. Default: $SCT_ATLAS_CACHE. If not set (or set\
+        to "off"), labels are not cached.
+        :param slab: (zmin, zmax): only read the slices [zmin, zmax) of the label files (along the I-S axis). The\
+        shape of the stack is then (nx, ny, zmax-zmin, n_labels).
+        """
+        self.fnames = [os.path.abspath(fname) for fname in fnames]
+        self.quantize = quantize
+        self.slab = tuple(slab) if slab is not None else None
+        if path_cache is None:
+            path_cache = os.environ.get('SCT_ATLAS_CACHE', '')
+        self.path_cache = os.path.abspath(path_cache) if path_cache.lower() not in ['', 'off', 'no', 'false'] \
+            else None
+        self._labels = [None] * len(self.fnames)
+        self._dense = None
+
+    def __len__(self):
+        return len(self.fnames)
+
+    @property
+    def shape(self):
+        return tuple(self.get_compact_label(0).shape) + (len(self),)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        """Memory used by the labels loaded so far"""
+        nbytes = sum(label.data.nbytes for label in self._labels if label is not None)
+        return nbytes + (self._dense.nbytes if self._dense is not None else 0)
+
+    def __getitem__(self, key):
+        if not (isinstance(key, tuple) and len(key) == 2 and key[0] is Ellipsis):
+            raise IndexError("LabelStack can only be indexed along its last dimension, e.g. labels[..., [0, 2]]")
+        if isinstance(key[1], (int, np.integer)):
+            return self.get_label(key[1])
+        ids = list(key[1])
+        compact_labels = [self.get_compact_label(i) for i in ids]
+        dtype = np.result_type(*[label.dtype for label in compact_labels]) if ids else np.float64
+        data = np.zeros(self.shape[:-1] + (len(ids),), dtype=dtype)
+        for i, label in enumerate(compact_labels):
+            self._paste(label, data[..., i])
+        return data
+
+    def get_dense(self):
+        """
+        Dense stack of all labels, built on the first call and then kept in memory. Use it when all labels are needed\
+        several times (e.g. ML/MAP estimation of each label), rather than indexing the stack repeatedly.
+
+        :return: nd-array: (nx, ny, nz, n_labels)
+        """
+        if self._dense is None:
+            self._dense = self[..., list(range(len(self)))]
+        return self._dense
+
+    def get_label(self, i):
+        """
+        :param i: int: index of the label
+        :return: nd-array: dense label
+        """
+        label = self.get_compact_label(i)
+        data = np.zeros(label.shape, dtype=label.dtype)
+        self._paste(label, data)
+        return data
+
+    def get_compact_label(self, i):
+        """
+        :param i: int: index of the label, loaded if needed.
+        :return: CompactLabel
+        """
+        if self._labels[i] is None:
+            self._labels[i] = self._load(self.fnames[i])
+        return self._labels[i]
+
+    @staticmethod
+    def _paste(label, data):
+        """Write a compact label into the dense array data"""
+        bbox = tuple(slice(start, start + size) for start, size in zip(label.start, label.data.shape))
+        data[bbox] = label.data if label.scale is None else label.data * label.scale
+
+    def _load(self, fname):
+        key = self._key(fname) if self.path_cache is not None else None
+        if key is not None:
+            label = self._fetch(key)
+            if label is not None:
+                return label
+        if self.slab is None:
+            data = np.asarray(Image(fname).change_orientation('RPI').data)
+        else:
+            data = np.asarray(load_slab(fname, self.slab[0], self.slab[1], orientation='RPI').data)
+        nonzero = data != 0
+        if nonzero.any():
+            start, stop = [], []
+            for axis in range(data.ndim):
+                index = np.flatnonzero(nonzero.any(axis=tuple(i for i in range(data.ndim) if i != axis)))
+                start.append(int(index[0]))
+                stop.append(int(index[-1]) + 1)
+        else:
+            start, stop = [0] * data.ndim, [0] * data.ndim
+        data_crop = data[tuple(slice(i, j) for i, j in zip(start, stop))]
+        scale = None
+        if self.quantize and data_crop.size and np.all(np.isfinite(data_crop)) and data_crop.min() >= 0 \
+                and data_crop.max() > 0:
+            scale = float(data_crop.max()) / 255
+            data_crop = np.round(data_crop / scale).astype(np.uint8)
+            dtype = np.dtype(np.float32)
+        else:
+            data_crop = np.ascontiguousarray(data_crop)
+            dtype = data_crop.dtype
+        label = CompactLabel(data.shape, tuple(start), data_crop, scale, dtype)
+        if key is not None:
+            self._store(key, label)
+        return label
+
+    def _key(self, fname):
+        """Key of a label in the cache, derived from the file (path, size and modification time) and options"""
+        stat = os.stat(fname)
+        params = (fname, stat.st_size, stat.st_mtime_ns, self.quantize, 'RPI', self.slab, __version__)
+        return hashlib.sha256(repr(params).encode('utf-8')).hexdigest()
+
+    def _fetch(self, key):
+        fname_info = os.path.join(self.path_cache, key + '.json')
+        try:
+            with open(fname_info) as f:
+                info = json.load(f)
+            data = np.load(os.path.join(self.path_cache, key + '.npy'), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        return CompactLabel(tuple(info['shape']), tuple(info['start']), data, info['scale'], np.dtype(info['dtype']))
+
+    def _store(self, key, label):
+        """Write an entry atomically (the info file, written last, marks the entry as complete)"""
+        os.makedirs(self.path_cache, exist_ok=True)
+        info = {'shape': list(label.shape), 'start': list(label.start), 'scale': label.scale,
+                'dtype': label.dtype.str}
+        try:
+            for ext, write in (('.npy', lambda f: np.save(f, label.data)),
+                               ('.json', lambda f: f.write(json.dumps(info).encode('utf-8')))):
+                fd, fname_tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.path_cache)
+                with os.fdopen(fd, 'wb') as f:
+                    write(f)
+                os.replace(fname_tmp, os.path.join(self.path_cache, key + ext))
+        except (IOError, OSError):
+            logger.warning("Label could not be written to the cache: {}".format(self.path_cache))
+
+
 def get_slices_from_vertebral_levels(im_vertlevel, level):
     """
     Find the slices of the corresponding vertebral level.
@@ -18,21 +248,7 @@ def get_slices_from_vertebral_levels(im_vertlevel, level):
     :param level: int: vertebral level
     :return: list of int: slices
     """
-    data_vertlevel = im_vertlevel.data
-    slices = []
-    # loop across z
-    for iz in range(data_vertlevel.shape[-1]):
-        # fetch non-null and finite values
-        data_vertlevel_nonzero = data_vertlevel[..., iz].flatten()[np.nonzero(data_vertlevel[..., iz].flatten())]
-        data_vertlevel_nonzero_finite = [i for i in data_vertlevel_nonzero if np.isfinite(i)]
-        # avoid empty slice
-        if not data_vertlevel_nonzero_finite == []:
-            # average non-null values and round to closest
-            average_value = int(np.round(np.mean(data_vertlevel_nonzero_finite)))
-            # if that matches the desired level, append it to slice list
-            if average_value == level:
-                slices.append(iz)
-    return slices
+    return VertLevelIndex(im_vertlevel).get_slices(level)
 
 
 def get_vertebral_level_from_slice(im_vertlevel, idx_slice):
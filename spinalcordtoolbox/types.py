@@ -168,6 +168,39 @@ class CoordinateValue(Coordinate):
         return hash(self.value)
 
 
+def _argmin_abs(values, targets):
+    """
+    For each target, return the index of the closest value, with the same result (including ties and NaNs) as
+    np.argmin(np.abs(values - target)), but in O(log(n)) per target using np.searchsorted.
+
+    :param values: 1d array
+    :param targets: 1d array
+    :return: 1d array of int
+    """
+    values, targets = np.asarray(values, dtype=float), np.asarray(targets, dtype=float)
+    if np.isnan(values).any():
+        # np.argmin returns the first NaN
+        return np.full(len(targets), np.flatnonzero(np.isnan(values))[0], dtype=int)
+    order = np.argsort(values, kind='stable')
+    values_sorted = values[order]
+    # first value greater or equal to the target, and first occurrence of the value just below the target
+    high = np.clip(np.searchsorted(values_sorted, targets, side='left'), 0, len(values) - 1)
+    low = np.searchsorted(values_sorted, values_sorted[np.clip(high - 1, 0, None)], side='left')
+    dist_low, dist_high = np.abs(values_sorted[low] - targets), np.abs(values_sorted[high] - targets)
+    result = np.where(dist_low < dist_high, order[low],
+                      np.where(dist_high < dist_low, order[high], np.minimum(order[low], order[high])))
+    result[np.isnan(targets)] = 0
+    return result
+
+
+def _norm_rows(vectors):
+    """
+    Return the norm of each row of a (N, 3) array, as a (N, 1) array. The norms are computed with a batched dot
+    product, so that they are identical to numpy.linalg.norm applied to each row separately.
+    """
+    return np.sqrt(np.matmul(vectors[:, np.newaxis, :], vectors[:, :, np.newaxis]))[:, 0]
+
+
 class Centerline:
     """
     This class represents a centerline in an image. Its coordinates can be in voxel space as well as in physical space.
@@ -260,12 +293,9 @@ class Centerline:
 
         # computation of centerline features, based on points and derivatives
         self.compute_length()
-        self.coordinate_system = [self.compute_coordinate_system(index) for index in range(0, self.number_of_points)]
-        self.plans_parameters = [self.get_plan_parameters(index) for index in range(0, self.number_of_points)]
-
-        self.matrices = stack([item[4] for item in self.coordinate_system])
-        self.inverse_matrices = stack([item[5] for item in self.coordinate_system])
-        self.offset_plans = array([item[3] for item in self.plans_parameters])
+        self.compute_coordinate_systems()
+        # per-point lists of coordinate systems and plane parameters are only built when accessed
+        self._coordinate_system, self._plans_parameters = None, None
 
         # initialization of KDTree for enabling computation of nearest points in centerline
         self.tree_points = cKDTree(self.points)
@@ -274,19 +304,56 @@ class Centerline:
             self.compute_vertebral_distribution(disks_levels=self.disks_levels, label_reference=self.label_reference)
 
     def compute_length(self):
-        for i in range(0, self.number_of_points - 1):
-            distance = np.sqrt((self.points[i][0] - self.points[i + 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i + 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i + 1][2]) ** 2)
-            self.length += distance
-            self.progressive_length.append(distance)
-            self.incremental_length.append(self.incremental_length[-1] + distance)
-        for i in range(self.number_of_points - 1, 0, -1):
-            distance = np.sqrt((self.points[i][0] - self.points[i - 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i - 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i - 1][2]) ** 2)
-            self.progressive_length_inverse.append(distance)
-            self.incremental_length_inverse.append(self.incremental_length_inverse[-1] + distance)
+        distances = np.sqrt(np.sum(np.diff(self.points, axis=0) ** 2, axis=1))
+        distances_inverse = distances[::-1]
+        self.progressive_length = [0.0] + distances.tolist()
+        self.progressive_length_inverse = [0.0] + distances_inverse.tolist()
+        self.incremental_length = [0.0] + np.cumsum(distances).tolist()
+        self.incremental_length_inverse = [0.0] + np.cumsum(distances_inverse).tolist()
+        self.length = self.incremental_length[-1]
+
+    def compute_coordinate_systems(self):
+        """
+        Compute the coordinate reference system (X, Y, and Z axes) and the plane parameters of all points of the
+        centerline at once. See compute_coordinate_system() and get_plan_parameters().
+        Derivatives are normalized in the process.
+        """
+        self.derivatives = np.asarray(self.derivatives, dtype=float)
+        self.derivatives /= _norm_rows(self.derivatives)
+        z_prime_axes = self.derivatives
+        # projection of the y axis [0, 1, 0] on the planes
+        y_prime_axes = -z_prime_axes[:, 1:2] * z_prime_axes
+        y_prime_axes[:, 1] += 1
+        y_prime_axes /= _norm_rows(y_prime_axes)
+        x_prime_axes = cross(y_prime_axes, z_prime_axes)
+        x_prime_axes /= _norm_rows(x_prime_axes)
+
+        # (N, 3, 3) matrices, whose columns are the axes of the coordinate systems
+        self.matrices = stack((x_prime_axes, y_prime_axes, z_prime_axes), axis=2)
+        self.inverse_matrices = inv(self.matrices)
+        self.offset_plans = -(self.derivatives[:, 0] * self.points[:, 0] + self.derivatives[:, 1] * self.points[:, 1] +
+                              self.derivatives[:, 2] * self.points[:, 2])
+
+    @property
+    def coordinate_system(self):
+        """
+        List of coordinate systems of each point: (origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base,
+        inverse_matrix), as returned by compute_coordinate_system().
+        """
+        if self._coordinate_system is None:
+            self._coordinate_system = [(self.points[i], self.matrices[i, :, 0], self.matrices[i, :, 1],
+                                        self.matrices[i, :, 2], self.matrices[i], self.inverse_matrices[i])
+                                       for i in range(self.number_of_points)]
+        return self._coordinate_system
+
+    @property
+    def plans_parameters(self):
+        """
+        List of parameters [a, b, c, d] of the plane of each point, as returned by get_plan_parameters().
+        """
+        if self._plans_parameters is None:
+            self._plans_parameters = np.column_stack((self.derivatives, self.offset_plans)).tolist()
+        return self._plans_parameters
 
     def find_nearest_index(self, coord):
         """
@@ -513,8 +580,7 @@ class Centerline:
         index_disk_inv = sorted(index_disk_inv, key=itemgetter(0))
 
         progress_length = zeros(self.number_of_points)
-        for i in range(self.number_of_points - 1):
-            progress_length[i + 1] = progress_length[i] + self.progressive_length[i]
+        progress_length[1:] = np.cumsum(self.progressive_length[:self.number_of_points - 1])
 
         self.label_reference = label_reference
         if self.label_reference not in self.index_disk:
@@ -642,6 +708,76 @@ class Centerline:
             result = result[0]
         return result
 
+    def get_closest_to_absolute_positions(self, vertebral_levels, relative_positions, backup_indexes=None,
+                                          backup_centerline=None, mode='levels'):
+        """
+        Vectorized version of get_closest_to_absolute_position(), for many positions at once. The nearest positions are
+        found with np.searchsorted over the (monotonic) cumulative distances along the centerline, instead of a full
+        scan of the centerline for each position. Results are identical to get_closest_to_absolute_position().
+
+        :param vertebral_levels: sequence of vertebral levels (e.g. self.l_points), as labels or 0.
+        :param relative_positions: sequence of relative positions (same length as vertebral_levels).
+        :param backup_indexes: sequence of indexes in backup_centerline (same length as vertebral_levels).
+        :param backup_centerline: Centerline
+        :param mode: {'levels', 'length'}
+        :return: ndarray of int: index of the closest point, or -1 when there is no point at the requested level\
+          (i.e. when get_closest_to_absolute_position() returns None).
+        """
+        if mode not in ['levels', 'length']:
+            raise ValueError("Mode must be either 'levels' or 'length'.")
+        vertebral_levels = list(vertebral_levels)
+        relative_positions = np.asarray(relative_positions, dtype=float)
+        result = np.full(len(vertebral_levels), -1, dtype=int)
+        dist_points = np.array(self.dist_points)
+        # Distinct levels (0 is stored as '0'), position of their first occurrence, and level of each position as an
+        # index in levels_unique
+        levels_unique, levels_first, levels_inverse = np.unique(np.array(vertebral_levels, dtype=str),
+                                                                return_index=True, return_inverse=True)
+
+        # Classify each position: nearest point relatively to the first label, to the last label, or within its level
+        reference = np.full(len(vertebral_levels), '', dtype=object)
+        if mode == 'levels':
+            index_first, index_last = self.list_labels.index(self.first_label), self.list_labels.index(self.last_label)
+            # Index of each distinct level in potential_list_labels (-1 for 0)
+            lookup = np.array([self.potential_list_labels.index(self.labels_regions[level]) if level != '0' else -1
+                               for level in levels_unique], dtype=int)
+            index_level = lookup[levels_inverse]
+            no_level = index_level == -1
+            reference[no_level] = 'first' if backup_centerline is not None else 'none'
+            reference[~no_level & (index_level < index_first)] = 'first'
+            reference[~no_level & (index_level >= index_last)] = 'last'
+
+        for label, name in [(self.first_label, 'first'), (self.last_label, 'last')]:
+            mask = reference == name
+            if not mask.any():
+                continue
+            disk = self.regions_labels[str(label)]
+            position_reference_self = self.dist_points[self.index_disk[disk]]
+            if backup_centerline is not None:
+                position_reference_backup = backup_centerline.dist_points[backup_centerline.index_disk[disk]]
+                targets = np.array(backup_centerline.dist_points)[np.asarray(backup_indexes)[mask]] - \
+                    position_reference_backup
+            else:
+                targets = relative_positions[mask]
+            result[mask] = _argmin_abs(dist_points - position_reference_self, targets)
+        mask = reference == 'none'
+        if mask.any():
+            result[mask] = _argmin_abs(dist_points, relative_positions[mask])
+
+        # Remaining positions: closest relative position within the same vertebral level
+        mask = reference == ''
+        if mask.any():
+            l_points = np.array(self.l_points)
+            dist_points_rel = np.array(self.dist_points_rel, dtype=float)
+            for i_level in np.unique(levels_inverse[mask]):
+                mask_level = mask & (levels_inverse == i_level)
+                # same comparison as in get_closest_to_relative_position()
+                indexes_vert = np.argwhere(l_points == vertebral_levels[levels_first[i_level]]).ravel()
+                if len(indexes_vert):
+                    result[mask_level] = indexes_vert[_argmin_abs(dist_points_rel[indexes_vert],
+                                                                  relative_positions[mask_level])]
+        return result
+
     def get_coordinate_interpolated(self, vertebral_level, relative_position, backup_index=None, backup_centerline=None, mode='levels'):
         index_closest = self.get_closest_to_absolute_position(vertebral_level, relative_position, backup_index=backup_index, backup_centerline=backup_centerline, mode=mode)
         if index_closest is None:
@@ -668,12 +804,45 @@ class Centerline:
     def extract_perpendicular_square(self, image, index, size=20, resolution=0.5, interpolation_mode=0, border='constant', cval=0.0):
         # TODO: use native resolution instead of forcing to 0.5. In case native is much higher res, we loose precision!!!
         # TODO: replace with existing function (if exists). There is a lot of arbitrary params in there
-        x_grid, y_grid, z_grid = np.mgrid[-size:size:resolution, -size:size:resolution, 0:1]
-        coordinates_grid = np.array(list(zip(x_grid.ravel(), y_grid.ravel(), z_grid.ravel())))
-        coordinates_phys = self.get_inverse_plans_coordinates(coordinates_grid, np.array([index] * len(coordinates_grid)))
-        coordinates_im = image.transfo_phys2pix(coordinates_phys, real=False)
-        square = image.get_values(coordinates_im.transpose(), interpolation_mode=interpolation_mode, border=border, cval=cval)
-        return square.reshape((len(x_grid), len(x_grid)))
+        return self.extract_perpendicular_squares(image, [index], size=size, resolution=resolution,
+                                                  interpolation_mode=interpolation_mode, border=border, cval=cval)[0]
+
+    def extract_perpendicular_squares(self, image, indexes=None, size=20, resolution=0.5, interpolation_mode=0,
+                                      border='constant', cval=0.0, chunk_size=None):
+        """
+        Extract the squares of the image that are perpendicular to the centerline, at several points of the centerline.
+        The coordinates of all squares are computed at once from the coordinate systems of the centerline, and the
+        image is sampled with a single call to map_coordinates per chunk.
+
+        :param image: Image to sample
+        :param indexes: indexes of the centerline points. Default: all points.
+        :param size: float: half-size of the squares, in mm
+        :param resolution: float: resolution of the squares, in mm
+        :param interpolation_mode: int: order of the interpolation (see Image.get_values())
+        :param border: str: mode of map_coordinates for points outside of the image
+        :param cval: float: value of points outside of the image (if border is 'constant')
+        :param chunk_size: int: number of squares sampled at once. Decrease it to reduce memory usage. Default: all.
+        :return: (len(indexes), n, n) float32 array
+        """
+        if indexes is None:
+            indexes = np.arange(self.number_of_points)
+        indexes = np.asarray(indexes, dtype=int)
+        if chunk_size is None:
+            chunk_size = max(len(indexes), 1)
+        x_grid, y_grid = np.mgrid[-size:size:resolution, -size:size:resolution]
+        # in-plane coordinates (z = 0), so that only the first two axes of the coordinate systems are needed
+        coordinates_grid = np.stack((x_grid, y_grid), axis=-1)
+        affine_phys2pix = inv(image.hdr.get_best_affine())
+        squares = np.empty((len(indexes),) + x_grid.shape, dtype=np.float32)
+        for start in range(0, len(indexes), chunk_size):
+            indexes_chunk = indexes[start:start + chunk_size]
+            # (n, h, w, 3) physical coordinates
+            coordinates_phys = (einsum('nij,hwj->nhwi', self.matrices[indexes_chunk, :, 0:2], coordinates_grid) +
+                                self.points[indexes_chunk, np.newaxis, np.newaxis, :])
+            coordinates_im = coordinates_phys @ affine_phys2pix[:3, :3].T + affine_phys2pix[:3, 3]
+            squares[start:start + len(indexes_chunk)] = image.get_values(
+                np.moveaxis(coordinates_im, -1, 0), interpolation_mode=interpolation_mode, border=border, cval=cval)
+        return squares
 
     def save_centerline(self, image=None, fname_output='centerline.sct'):
         if image is not None:
@@ -699,43 +868,32 @@ class Centerline:
                          disks_levels=self.disks_levels, label_reference=self.label_reference)
 
     def average_coordinates_over_slices(self, image):
-        # extracting points information for each coordinates
-        P_x = np.array([point[0] for point in self.points])
-        P_y = np.array([point[1] for point in self.points])
-        P_z = np.array([point[2] for point in self.points])
-        P_z_vox = np.array([coord[2] for coord in image.transfo_phys2pix(self.points)])
-        P_x_d = np.array([deriv[0] for deriv in self.derivatives])
-        P_y_d = np.array([deriv[1] for deriv in self.derivatives])
-        P_z_d = np.array([deriv[2] for deriv in self.derivatives])
-
-        P_z_vox = np.array([int(np.round(P_z_vox[i])) for i in range(0, len(P_z_vox))])
-        # not perfect but works (if "enough" points), in order to deal with missing z slices
-        for i in range(min(P_z_vox), max(P_z_vox) + 1, 1):
-            if i not in P_z_vox:
-                from bisect import bisect_right
-                idx_closest = bisect_right(P_z_vox, i)
-                z_min, z_max = P_z_vox[idx_closest - 1], P_z_vox[idx_closest]
-                if z_min == z_max:
-                    weight_min = weight_max = 0.5
-                else:
-                    weight_min, weight_max = abs((z_min - i) / (z_max - z_min)), abs((z_max - i) / (z_max - z_min))
-                P_x_temp = np.insert(P_x, idx_closest, weight_min * P_x[idx_closest - 1] + weight_max * P_x[idx_closest])
-                P_y_temp = np.insert(P_y, idx_closest, weight_min * P_y[idx_closest - 1] + weight_max * P_y[idx_closest])
-                P_z_temp = np.insert(P_z, idx_closest, weight_min * P_z[idx_closest - 1] + weight_max * P_z[idx_closest])
-                P_x_d_temp = np.insert(P_x_d, idx_closest, weight_min * P_x_d[idx_closest - 1] + weight_max * P_x_d[idx_closest])
-                P_y_d_temp = np.insert(P_y_d, idx_closest, weight_min * P_y_d[idx_closest - 1] + weight_max * P_y_d[idx_closest])
-                P_z_d_temp = np.insert(P_z_d, idx_closest, weight_min * P_z_d[idx_closest - 1] + weight_max * P_z_d[idx_closest])
-                P_z_vox_temp = np.insert(P_z_vox, idx_closest, i)
-                P_x, P_y, P_z, P_x_d, P_y_d, P_z_d, P_z_vox = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp, P_z_vox_temp
-
-        coord_mean = np.array([[np.mean(P_x[P_z_vox == i]), np.mean(P_y[P_z_vox == i]), np.mean(P_z[P_z_vox == i])] for i in range(min(P_z_vox), max(P_z_vox) + 1, 1)])
-        x_centerline_fit = coord_mean[:, :][:, 0]
-        y_centerline_fit = coord_mean[:, :][:, 1]
-        coord_mean_d = np.array([[np.mean(P_x_d[P_z_vox == i]), np.mean(P_y_d[P_z_vox == i]), np.mean(P_z_d[P_z_vox == i])] for i in range(min(P_z_vox), max(P_z_vox) + 1, 1)])
-        z_centerline = coord_mean[:, :][:, 2]
-        x_centerline_deriv = coord_mean_d[:, :][:, 0]
-        y_centerline_deriv = coord_mean_d[:, :][:, 1]
-        z_centerline_deriv = coord_mean_d[:, :][:, 2]
+        from bisect import bisect_right
+        # extracting points information (coordinates and derivatives) for each coordinates
+        P = np.hstack((self.points, self.derivatives))
+        P_z_vox = image.transfo_phys2pix(self.points)[:, 2].astype(int)
+
+        # not perfect but works (if "enough" points), in order to deal with missing z slices: each missing slice is
+        # interpolated between the previous slice (which may itself be interpolated) and the next existing point
+        z_missing = np.setdiff1d(np.arange(min(P_z_vox), max(P_z_vox) + 1), P_z_vox)
+        P_missing = np.zeros((len(z_missing), P.shape[1]))
+        for i_missing, i in enumerate(z_missing):
+            idx_closest = bisect_right(P_z_vox, i)
+            z_min, z_max = i - 1, P_z_vox[idx_closest]
+            if i_missing > 0 and z_missing[i_missing - 1] == z_min:
+                P_previous = P_missing[i_missing - 1]
+            else:
+                P_previous = P[idx_closest - 1]
+            weight_min, weight_max = abs((z_min - i) / (z_max - z_min)), abs((z_max - i) / (z_max - z_min))
+            P_missing[i_missing] = weight_min * P_previous + weight_max * P[idx_closest]
+        P = np.vstack((P, P_missing))
+        P_z_vox = np.concatenate((P_z_vox, z_missing))
+
+        # average coordinates and derivatives over each slice
+        _, ind_z, count_z = np.unique(P_z_vox, return_inverse=True, return_counts=True)
+        P_mean = np.array([np.bincount(ind_z, weights=P[:, i]) / count_z for i in range(P.shape[1])])
+        x_centerline_fit, y_centerline_fit, z_centerline = P_mean[0], P_mean[1], P_mean[2]
+        x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = P_mean[3], P_mean[4], P_mean[5]
 
         return x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
 
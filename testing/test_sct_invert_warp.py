@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Test function for sct_invert_warp
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2020 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import absolute_import
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.registration.warp import warp2ras
+
+
+def init(param_test):
+    """
+    Initialize class: param_test
+    """
+    # initialization
+    param_test.fname_warp = 't2/warp_template2anat.nii.gz'
+    param_test.fname_out = 'warp_anat2template_inv.nii.gz'
+    default_args = ['-i {} -d template/template/PAM50_small_t2.nii.gz -o {}'.format(
+        param_test.fname_warp, param_test.fname_out)]
+
+    # assign default params
+    if not param_test.args:
+        param_test.args = default_args
+
+    return param_test
+
+
+def test_integrity(param_test):
+    """
+    Test integrity of function
+    """
+    # Composing the inverse warp with the forward warp should give the identity: for each point y of the inverse warp
+    # grid, x = y + v(y) and x + u(x) should be close to y.
+    im_fwd, im_inv = Image(param_test.fname_warp), Image(param_test.fname_out)
+    fwd, inv = warp2ras(im_fwd.data), warp2ras(im_inv.data)
+    affine_inv = im_inv.hdr.get_best_affine()
+    affine_fwd_inv = np.linalg.inv(im_fwd.hdr.get_best_affine())
+    indexes = np.mgrid[[slice(0, n) for n in im_inv.data.shape[:3]]].reshape(3, -1)
+    coord = affine_inv[:3, :3] @ indexes + affine_inv[:3, 3:]
+    coord_warped = coord + inv.reshape(3, -1)
+    indexes_fwd = affine_fwd_inv[:3, :3] @ coord_warped + affine_fwd_inv[:3, 3:]
+    disp_fwd = np.stack([map_coordinates(fwd[i], indexes_fwd, order=1, mode='constant', cval=np.nan)
+                         for i in range(3)])
+    error = np.linalg.norm(coord_warped + disp_fwd - coord, axis=0)
+    # Only consider points for which both warping fields are defined
+    error = error[np.isfinite(error)]
+    if not len(error):
+        param_test.output += '\nThe inverse warping field is not defined on the destination grid.'
+        param_test.status = 99
+    elif np.percentile(error, 95) > 0.5:
+        param_test.output += '\nComposition of the warping field with its inverse is not the identity: 95th ' \
+                             'percentile of the error = {:.3f} mm'.format(np.percentile(error, 95))
+        param_test.status = 99
+    return param_test
@@ -19,6 +19,7 @@ sys.path.append(os.path.join(__sct_dir__, 'scripts'))
 from spinalcordtoolbox import aggregate_slicewise
 from spinalcordtoolbox.process_seg import Metric
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.template import LabelStack, VertLevelIndex, get_vertebral_level_from_slice
 
 
 @pytest.fixture(scope="session")
@@ -93,7 +94,7 @@ def test_aggregate_across_selected_slices(dummy_metrics):
     assert agg_metrics['with int'][(1, 2)]['WA()'] == 100.5
     # check that even if there is an error in metric estimation, the function outputs a dict for specific slicegroup
     assert agg_metrics['with nan'][(1, 2)]['WA()'] == 101.0
-    assert agg_metrics['inconsistent length'][(1, 2)]['WA()'] == 'index 2 is out of bounds for axis 0 with size 2'
+    assert agg_metrics['inconsistent length'][(1, 2)]['WA()'] == 'Slices (1, 2) are not within the data (slices 0 to 1)'
     assert agg_metrics['with string'][(1, 2)]['WA()'] == "ufunc 'isfinite' not supported for the input types, and " \
                                                            "the inputs could not be safely coerced to any supported " \
                                                            "types according to the casting rule ''safe''"
@@ -300,3 +301,319 @@ def test_save_as_csv_extract_metric(dummy_data_and_labels):
         spamreader = csv.reader(csvfile, delimiter=',')
         next(spamreader)  # skip header
         assert next(spamreader)[1:-1] == [__version__, '', '0:4', '', 'label_0', '2.5', '38.0']
+
+
+# noinspection 801,PyShadowingNames
+def test_save_as_sqlite(dummy_metrics, tmp_path):
+    """Test writing, querying and exporting results with the SQLite backend"""
+    fname_db = str(tmp_path / 'results.db')
+    agg_metric = aggregate_slicewise.aggregate_per_slice_or_level(dummy_metrics['with float'], perslice=True,
+                                                                  group_funcs=(('WA', aggregate_slicewise.func_wa),))
+    aggregate_slicewise.save_results(agg_metric, fname_db, fname_in='sub-01.nii.gz', subject='sub-01')
+    aggregate_slicewise.save_results(agg_metric, fname_db, fname_in='sub-02.nii.gz', subject='sub-02', append=True)
+    rows = aggregate_slicewise.query_sqlite(fname_db, where={'Subject': 'sub-02'})
+    assert [row['Slice'] for row in rows] == ['0', '1', '2', '3', '4']
+    assert [row['Value'] for row in rows] == [29., 31., 39., 41., 50.]
+    assert (rows[0]['Metric'], rows[0]['Filename'], rows[0]['SCTVersion']) == ('WA()', 'sub-02.nii.gz', __version__)
+    # Group-level aggregation
+    stats = aggregate_slicewise.aggregate_sqlite(fname_db, 'WA()', group_by=('Subject',), where={'Slice': ['3', '4']})
+    assert stats[('sub-01',)]['N'] == 2
+    assert stats[('sub-01',)]['MEAN'] == pytest.approx(45.5)
+    assert stats[('sub-01',)]['STD'] == pytest.approx(np.std([41., 50.], ddof=1))
+    stats = aggregate_slicewise.aggregate_sqlite(fname_db, 'WA()', group_by=())
+    assert stats[()]['N'] == 10 and stats[()]['MAX'] == 50.
+    # Overwrite
+    aggregate_slicewise.save_results(agg_metric, fname_db, fname_in='sub-03.nii.gz', subject='sub-03')
+    assert {row['Subject'] for row in aggregate_slicewise.query_sqlite(fname_db)} == {'sub-03'}
+    # Export as csv
+    aggregate_slicewise.sqlite_to_csv(fname_db, str(tmp_path / 'results.csv'))
+    with open(str(tmp_path / 'results.csv'), 'r') as csvfile:
+        reader = csv.DictReader(csvfile, delimiter=',')
+        row = next(reader)
+        assert row['Subject'] == 'sub-03' and row['Slice (I->S)'] == '0' and row['WA()'] == '29.0'
+    # Empty slice group
+    aggregate_slicewise.save_results({(): {'VertLevel': [7], 'WA()': None}}, fname_db, subject='sub-04')
+    rows = aggregate_slicewise.query_sqlite(fname_db)
+    assert (rows[0]['Slice'], rows[0]['VertLevel'], rows[0]['Value']) == ('', '7', None)
+
+
+# noinspection 801,PyShadowingNames
+def test_save_as_sqlite_concurrent(dummy_metrics, tmp_path):
+    """Concurrent appends from several processes must not lose or interleave rows"""
+    from concurrent.futures import ProcessPoolExecutor
+    fname_db = str(tmp_path / 'results.db')
+    agg_metric = aggregate_slicewise.aggregate_per_slice_or_level(dummy_metrics['with float'], perslice=True,
+                                                                  group_funcs=(('WA', aggregate_slicewise.func_wa),))
+    subjects = ['sub-{:02d}'.format(i) for i in range(8)]
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(aggregate_slicewise.save_as_sqlite, [agg_metric] * len(subjects), [fname_db] * len(subjects),
+                          subjects, [True] * len(subjects), subjects))
+    rows = aggregate_slicewise.query_sqlite(fname_db)
+    assert len(rows) == 5 * len(subjects)
+    for i in range(len(subjects)):
+        # Rows of one call are contiguous
+        assert len({row['Subject'] for row in rows[5 * i:5 * (i + 1)]}) == 1
+
+
+# noinspection 801,PyShadowingNames
+def test_aggregate_per_level_with_index(dummy_metrics, dummy_vert_level):
+    """Test aggregation using a precomputed VertLevelIndex instead of the vertebral labeling image"""
+    vert_level_index = VertLevelIndex(dummy_vert_level)
+    for kwargs in [{'perlevel': True}, {'perslice': True}, {'perlevel': False, 'perslice': False}]:
+        agg_metric = aggregate_slicewise.aggregate_per_slice_or_level(dummy_metrics['with float'], levels=[2, 3],
+                                                                      vert_level=dummy_vert_level, **kwargs)
+        assert aggregate_slicewise.aggregate_per_slice_or_level(dummy_metrics['with float'], levels=[2, 3],
+                                                                vert_level=vert_level_index, **kwargs) == agg_metric
+    for iz in range(dummy_vert_level.data.shape[2]):
+        assert vert_level_index.get_level(iz) == get_vertebral_level_from_slice(dummy_vert_level, iz)
+    assert vert_level_index.get_slices(3) == [2, 3]
+    assert vert_level_index.get_slices(12) == []
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('kwargs', [{'perslice': True}, {'perslice': False}, {'slices': [0, 2, 3, 7], 'perslice': True}])
+def test_aggregate_grouped(kwargs, dtype):
+    """Results of the grouped computation of WA, STD and BIN should match the per slice group computation"""
+    rng = np.random.RandomState(0)
+    data = (rng.rand(5, 4, 8) * 10).astype(dtype)
+    data[rng.rand(*data.shape) < 0.1] = np.nan
+    mask = (rng.rand(5, 4, 8, 2) * (rng.rand(5, 4, 8, 2) < 0.5)).astype(dtype)
+    mask[:, :, 2, 0] = 0  # weights sum to zero
+    mask[:, :, 3, :] = 0  # empty mask
+    funcs = [('WA', aggregate_slicewise.func_wa), ('BIN', aggregate_slicewise.func_bin),
+             ('STD', aggregate_slicewise.func_std)]
+    agg_metric = aggregate_slicewise.aggregate_per_slice_or_level(Metric(data=data.copy(), label='x'),
+                                                                  mask=Metric(data=mask, label='label'),
+                                                                  group_funcs=funcs, **kwargs)
+    # Wrapped functions are not recognized, so they are computed separately for each slice group
+    funcs_loop = [(name, lambda d, m, c, func=func: func(d, m, c)) for name, func in funcs]
+    agg_metric_loop = aggregate_slicewise.aggregate_per_slice_or_level(Metric(data=data.copy(), label='x'),
+                                                                       mask=Metric(data=mask, label='label'),
+                                                                       group_funcs=funcs_loop, **kwargs)
+    assert agg_metric.keys() == agg_metric_loop.keys()
+    for slicegroup in agg_metric:
+        assert agg_metric[slicegroup].keys() == agg_metric_loop[slicegroup].keys()
+        for key, value in agg_metric[slicegroup].items():
+            value_loop = agg_metric_loop[slicegroup][key]
+            if isinstance(value, (float, np.floating)):
+                # Same type, so that results are written the same way
+                assert np.asarray(value).dtype == np.asarray(value_loop).dtype
+                # float32 sums of the per slice group computation are less accurate
+                assert value == pytest.approx(value_loop, rel=1e-10 if dtype == np.float64 else 1e-6)
+            else:
+                assert value == value_loop
+
+
+@pytest.mark.parametrize('method', ['ml', 'map'])
+def test_extract_metric_multiple_metrics(method, monkeypatch):
+    """Estimating several metrics with one atlas should give the same results as estimating each metric separately"""
+    rng = np.random.RandomState(0)
+    labels = rng.rand(6, 5, 4, 3)
+    labels /= labels.sum(axis=-1, keepdims=True)
+    labels[:, :, 1, 2] = 0  # label absent from a slice: singular design matrix
+    label_struc = {0: aggregate_slicewise.LabelStruc(id=0, name='label_0', map_cluster=0),
+                   1: aggregate_slicewise.LabelStruc(id=1, name='label_1', map_cluster=1),
+                   2: aggregate_slicewise.LabelStruc(id=2, name='label_2', map_cluster=1)}
+    list_data = [Metric(data=rng.rand(6, 5, 4) * scale, label='metric_{}'.format(scale)) for scale in (1, 10, 100)]
+    # nonfinite values at the same voxel for all metrics in slice 2, only in one metric in slice 3
+    for data in list_data:
+        data.data[0, 0, 2] = np.nan
+    list_data[1].data[1, 1, 3] = np.inf
+    solver = aggregate_slicewise.PartialVolumeSolver()
+    n_solves = []
+    estimate_ml = aggregate_slicewise._estimate_ml
+    monkeypatch.setattr(aggregate_slicewise, '_estimate_ml', lambda *args: n_solves.append(1) or estimate_ml(*args))
+    list_agg_metric = aggregate_slicewise.extract_metric(list_data, labels=labels, label_struc=label_struc,
+                                                         id_label=0, indiv_labels_ids=[0, 1, 2], perslice=True,
+                                                         method=method, solver=solver)
+    # one solve per slice for all metrics, except slice 3 which is solved for each metric
+    assert len(n_solves) == 3 + len(list_data)
+    # pseudo-inverses cached when the mask is not changed because of nonfinite values, i.e. for slices 0, 1 and 3
+    # (shared by the metrics without nonfinite values), and per cluster design matrix for MAP
+    assert len(solver._cache) == 3 * (2 if method == 'map' else 1)
+    monkeypatch.undo()
+    for data, agg_metric in zip(list_data, list_agg_metric):
+        agg_metric_ref = aggregate_slicewise.extract_metric(data, labels=labels, label_struc=label_struc, id_label=0,
+                                                            indiv_labels_ids=[0, 1, 2], perslice=True, method=method)
+        assert agg_metric.keys() == agg_metric_ref.keys()
+        for slicegroup in agg_metric:
+            for key, value in agg_metric[slicegroup].items():
+                if isinstance(value, float):
+                    assert value == pytest.approx(agg_metric_ref[slicegroup][key], rel=1e-10)
+                else:
+                    assert value == agg_metric_ref[slicegroup][key]
+
+
+@pytest.mark.parametrize('func', [aggregate_slicewise.func_ml, aggregate_slicewise.func_map])
+def test_estimate_multiple_right_hand_sides(func):
+    """func_ml() and func_map() estimate all metrics at once when data has an additional last dimension"""
+    rng = np.random.RandomState(0)
+    mask = rng.rand(10, 4)
+    data = rng.rand(10, 3)
+    map_clusters = [[0], [1], [1], [2]]
+    _, beta = func(data, mask, map_clusters)
+    assert beta.shape == (4, 3)
+    for i in range(3):
+        assert np.allclose(beta[:, i], func(data[:, i], mask, map_clusters)[1])
+
+
+@pytest.mark.parametrize('method', ['ml', 'map'])
+def test_partial_volume_solver_cache(method):
+    """Pseudo-inverses are cached by mask and slice group, and only for the last mask"""
+    rng = np.random.RandomState(0)
+    mask = Metric(data=rng.rand(10, 1, 3), label='label')
+    data = rng.rand(10, 1)
+    map_clusters = [[0], [1], [1]]
+    solver = aggregate_slicewise.PartialVolumeSolver()
+    func = getattr(solver, method)
+    func_ref = {'ml': aggregate_slicewise.func_ml, 'map': aggregate_slicewise.func_map}[method]
+    _, beta = func(data, mask.data, map_clusters, key=(mask, (0,)))
+    assert np.allclose(beta, func_ref(data, mask.data, map_clusters)[1])
+    n_cached = len(solver._cache)
+    # Same key: Xt . X is not computed again, so the cached pseudo-inverse is used even if the design matrix differs
+    _, beta_cached = func(data, 2 * mask.data, map_clusters, key=(mask, (0,)))
+    assert len(solver._cache) == n_cached
+    assert not np.allclose(beta_cached, func_ref(data, 2 * mask.data, map_clusters)[1])
+    # New mask: the cache is reset
+    mask_new = Metric(data=2 * mask.data, label='label')
+    _, beta_new = func(data, mask_new.data, map_clusters, key=(mask_new, (0,)))
+    assert len(solver._cache) == n_cached
+    assert np.allclose(beta_new, func_ref(data, mask_new.data, map_clusters)[1])
+
+
+@pytest.fixture(scope="session")
+def dummy_atlas(tmp_path_factory):
+    """Create 3 partial volume label files, each one covering a part of the volume."""
+    path = tmp_path_factory.mktemp('atlas')
+    rng = np.random.RandomState(0)
+    labels = rng.rand(8, 7, 6, 3)
+    labels[:4, ..., 0] = 0
+    labels[..., :2, 1] = 0
+    labels /= labels.sum(axis=-1, keepdims=True)
+    fnames = []
+    for i_label in range(labels.shape[-1]):
+        fnames.append(str(path.joinpath('label_{}.nii.gz'.format(i_label))))
+        nib.save(nib.Nifti1Image(labels[..., i_label].astype(np.float32), np.eye(4)), fnames[-1])
+    dense = np.stack([Image(fname).change_orientation('RPI').data for fname in fnames], axis=-1)
+    return fnames, dense
+
+
+@pytest.mark.parametrize('quantize', [False, True])
+def test_label_stack(dummy_atlas, quantize):
+    fnames, dense = dummy_atlas
+    labels = LabelStack(fnames, quantize=quantize, path_cache='off')
+    assert labels[..., 1].shape == dense.shape[:-1]
+    # Labels are only loaded when needed, and cropped to their bounding box
+    assert labels._labels[0] is None and labels._labels[2] is None
+    assert labels.get_compact_label(1).data.shape == (8, 7, 4)
+    assert labels.shape == dense.shape
+    if quantize:
+        assert labels.get_compact_label(1).data.dtype == np.uint8
+        assert np.allclose(labels[..., [0, 1, 2]], dense, atol=0.5 / 255)
+    else:
+        assert np.array_equal(labels[..., [0, 1, 2]], dense)
+    assert np.array_equal(labels[..., [2, 0]], labels[..., [0, 1, 2]][..., [2, 0]])
+
+
+def test_label_stack_slab(dummy_atlas):
+    fnames, dense = dummy_atlas
+    labels = LabelStack(fnames, path_cache='off', slab=(1, 4))
+    assert labels.shape == dense.shape[:2] + (3, 3)
+    assert np.array_equal(labels[..., [0, 1, 2]], dense[:, :, 1:4])
+
+
+def test_label_stack_cache(dummy_atlas, tmp_path):
+    fnames, dense = dummy_atlas
+    labels = LabelStack(fnames, quantize=True, path_cache=str(tmp_path))
+    data = labels[..., [0, 1, 2]]
+    assert len(list(tmp_path.glob('*.npy'))) == len(list(tmp_path.glob('*.json'))) == 3
+    # Labels of a new stack are memory-mapped from the cache
+    labels_cached = LabelStack(fnames, quantize=True, path_cache=str(tmp_path))
+    assert isinstance(labels_cached.get_compact_label(0).data, np.memmap)
+    assert np.array_equal(labels_cached[..., [0, 1, 2]], data)
+    # Entries depend on the options
+    LabelStack(fnames, quantize=False, path_cache=str(tmp_path))[..., [0]]
+    assert len(list(tmp_path.glob('*.npy'))) == 4
+
+
+@pytest.mark.parametrize('method', ['wa', 'ml', 'map'])
+def test_extract_metric_label_stack(dummy_atlas, method):
+    """A LabelStack gives the same results as the concatenated labels"""
+    fnames, dense = dummy_atlas
+    label_struc = {i: aggregate_slicewise.LabelStruc(id=i, name='label_{}'.format(i), map_cluster=min(i, 1))
+                   for i in range(3)}
+    data = Metric(data=np.random.RandomState(1).rand(*dense.shape[:-1]), label='')
+    kwargs = dict(label_struc=label_struc, id_label=0, indiv_labels_ids=[0, 1, 2], perslice=True, method=method)
+    labels = LabelStack(fnames, path_cache='off')
+    dense_stacks = []
+    for id_label in [0, 2]:
+        kwargs['id_label'] = id_label
+        agg_metric = aggregate_slicewise.extract_metric(data, labels=labels, **kwargs)
+        agg_metric_ref = aggregate_slicewise.extract_metric(data, labels=dense, **kwargs)
+        assert agg_metric.keys() == agg_metric_ref.keys()
+        for slicegroup in agg_metric:
+            # float32 sums may differ in the last digits, as labels are not laid out the same way in memory
+            assert agg_metric[slicegroup] == pytest.approx(agg_metric_ref[slicegroup], rel=1e-6)
+        dense_stacks.append(labels._dense)
+    if method in ['ml', 'map']:
+        # The dense stack of all labels is built once, and reused for the next labels
+        assert dense_stacks[0] is not None and dense_stacks[1] is dense_stacks[0]
+    else:
+        assert dense_stacks == [None, None]
+
+
+@pytest.mark.parametrize('kwargs', [{'perlevel': True}, {'perslice': True}, {'perslice': False}])
+def test_aggregate_slab(dummy_vert_level, kwargs):
+    """Aggregating a slab of the data with z_offset gives the same results as aggregating the whole data"""
+    rng = np.random.RandomState(0)
+    data, mask = rng.rand(3, 4, 9), rng.rand(3, 4, 9, 1)
+    vert_level = VertLevelIndex(dummy_vert_level)
+    funcs = (('WA', aggregate_slicewise.func_wa), ('ML', aggregate_slicewise.func_ml))
+    agg_metric = aggregate_slicewise.aggregate_per_slice_or_level(
+        Metric(data=data[..., 2:6].copy()), mask=Metric(data=mask[..., 2:6, :], label='label'), levels=[3, 4],
+        vert_level=vert_level, group_funcs=funcs, z_offset=2, **kwargs)
+    agg_metric_ref = aggregate_slicewise.aggregate_per_slice_or_level(
+        Metric(data=data.copy()), mask=Metric(data=mask, label='label'), levels=[3, 4], vert_level=vert_level,
+        group_funcs=funcs, **kwargs)
+    assert agg_metric == agg_metric_ref
+    # Slices below and above the slab
+    for level in [2, 5]:
+        agg_metric = aggregate_slicewise.aggregate_per_slice_or_level(
+            Metric(data=data[..., 2:6].copy()), mask=Metric(data=mask[..., 2:6, :], label='label'), levels=[level],
+            vert_level=vert_level, group_funcs=funcs[1:], z_offset=2, **kwargs)
+        assert all(value['ML()'].startswith('Slices ') and value['ML()'].endswith(
+            'are not within the data (slices 2 to 5)') for value in agg_metric.values())
+
+
+@pytest.mark.parametrize('method', ['wa', 'ml'])
+@pytest.mark.parametrize('perlevel', [0, 1])
+def test_sct_extract_metric_vert(tmp_path, monkeypatch, method, perlevel):
+    """sct_extract_metric with -vert only loads the slab of the selected levels, and writes the same rows as when\
+    aggregating the full data"""
+    import sct_extract_metric
+    monkeypatch.setenv('SCT_ATLAS_CACHE', 'off')
+    rng = np.random.RandomState(0)
+    data_vert = np.zeros((9, 9, 12))
+    data_vert[4, 4, :] = [2, 2, 3, 3, 3, 4, 4, 5, 5, 6, 6, 6]
+    fnames = {}
+    for name, data in [('data', rng.rand(9, 9, 12)), ('label', rng.rand(9, 9, 12)), ('vert', data_vert)]:
+        fnames[name] = str(tmp_path / '{}.nii.gz'.format(name))
+        nib.save(nib.nifti1.Nifti1Image(data, np.eye(4)), fnames[name])
+    fname_out, fname_out_ref = str(tmp_path / 'out.csv'), str(tmp_path / 'out_ref.csv')
+    sct_extract_metric.main(fname_data=fnames['data'], path_label=fnames['label'], method=method, slices=[],
+                            levels=[3, 5], fname_output=fname_out, labels_user='', append_csv=False,
+                            fname_vertebral_labeling=fnames['vert'], perslice=0, perlevel=perlevel, verbose=0,
+                            combine_labels=False)
+    # Reference: aggregate the full data and labels
+    agg_metric = aggregate_slicewise.extract_metric(
+        Metric(data=Image(fnames['data']).change_orientation('RPI').data, label=''),
+        labels=LabelStack([fnames['label']], path_cache='off'), slices=[], levels=[3, 5],
+        perslice=0, perlevel=perlevel, vert_level=VertLevelIndex(Image(fnames['vert']).change_orientation('RPI')),
+        method=method, label_struc={0: aggregate_slicewise.LabelStruc(id=0, name='label')}, id_label=0,
+        indiv_labels_ids=[0])
+    aggregate_slicewise.save_results(agg_metric, fname_out_ref, fname_in=fnames['data'])
+    rows, rows_ref = [list(csv.DictReader(open(fname))) for fname in [fname_out, fname_out_ref]]
+    assert len(rows) == (2 if perlevel else 1)
+    for row, row_ref in zip(rows, rows_ref):
+        row.pop('Timestamp'), row_ref.pop('Timestamp')
+        assert row == row_ref
@@ -161,6 +161,66 @@ def test_get_centerline_nurbs(img_ctl, expected, params):
     assert fit_results.laplacian_max < expected['laplacian']
 
 
+def test_get_centerline_cache(tmp_path):
+    """Test that cached centerlines are identical to fresh ones"""
+    from spinalcordtoolbox.centerline import core
+    img_sub = dummy_centerline(size_arr=(30, 20, 50), subsampling=3, orientation='AIL')[1]
+    param = ParamCenterline(algo_fitting='bspline', minmax=False)
+    ref = get_centerline(img_sub.copy(), param, verbose=VERBOSE)
+    core.centerline_cache.enable(str(tmp_path))
+    try:
+        for _ in range(2):
+            img_out, arr_out, arr_deriv_out, fit_results = get_centerline(img_sub.copy(), param, verbose=VERBOSE)
+            assert np.array_equal(img_out.data, ref[0].data)
+            assert img_out.orientation == ref[0].orientation
+            assert np.array_equal(arr_out, ref[1])
+            assert np.array_equal(arr_deriv_out, ref[2])
+            assert fit_results.rmse == ref[3].rmse
+            assert np.array_equal(fit_results.data.xfit, ref[3].data.xfit)
+            # Modifying outputs should not alter the cache
+            arr_out[:] = 0
+        # Entries are also read from disk
+        core.centerline_cache.clear()
+        assert len(os.listdir(str(tmp_path))) == 1
+        assert np.array_equal(get_centerline(img_sub.copy(), param, verbose=VERBOSE)[1], ref[1])
+        # Different parameters should not hit the cache
+        param_other = ParamCenterline(algo_fitting='bspline', minmax=False, smooth=10)
+        assert not np.array_equal(get_centerline(img_sub.copy(), param_other, verbose=VERBOSE)[1], ref[1])
+    finally:
+        core.centerline_cache.disable()
+
+
+def test_nurbs_basis_functions():
+    """Test vectorized NURBS basis functions against scipy's B-splines"""
+    from scipy.interpolate import BSpline
+    from spinalcordtoolbox.centerline.nurbs import _basis_functions
+    k = 4
+    knots = np.array([0, 0, 0, 0, 0.2, 0.25, 0.6, 1, 1, 1, 1])
+    t = np.linspace(0, 1, 101)
+    N, Np = _basis_functions(knots, k, t)
+    bspline = BSpline(knots, np.eye(len(knots) - k), k - 1)
+    assert np.allclose(N, bspline(t))
+    assert np.allclose(N.sum(axis=1), 1)
+    assert np.allclose(Np, k / (k - 1) * bspline.derivative()(t))
+
+
+def test_nurbs_threads():
+    """Test that NURBS fitting gives the same results when run concurrently"""
+    from concurrent.futures import ThreadPoolExecutor
+    from spinalcordtoolbox.centerline.nurbs import b_spline_nurbs
+    z = np.arange(60.)
+    data = [(10 + amplitude * np.sin(z / 20.), 10 + np.cos(z / 30.), z) for amplitude in [1, 2, 3, 4]]
+
+    def fit(xyz):
+        return b_spline_nurbs(*[list(arr) for arr in xyz], nbControl=None, point_number=1000, verbose=0)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(fit, data))
+    for xyz, result in zip(data, results):
+        assert all(np.array_equal(arr, arr_ref) for arr, arr_ref in zip(result, fit(xyz)))
+        assert np.max(np.abs(result[0] - xyz[0])) < 0.5
+
+
 # noinspection 801,PyShadowingNames
 @pytest.mark.parametrize('params', param_optic)
 def test_get_centerline_optic(params):
@@ -101,3 +101,55 @@ def test_uncrop_image():
                        y_crop_lst[z_rand]:y_crop_lst[z_rand]+crop_size,
                        z_rand],
                        data_crop[:, :, z_rand])
+
+
+class DummyModel2d(object):
+    """Stand-in for the 2D segmentation network: a per-slice function of the input, with Keras' predict() API."""
+    def __init__(self, **kwargs):
+        self.n_calls = 0
+
+    def load_weights(self, fname):
+        pass
+
+    def predict(self, x, batch_size=None):
+        assert x.ndim == 4 and x.shape[-1] == 1
+        self.n_calls += 1
+        return np.tanh(x * np.arange(x.shape[2])[np.newaxis, np.newaxis, :, np.newaxis])
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 7, None])
+def test_segment_2d_batch(monkeypatch, batch_size):
+    """Segmentation of batches of slices gives the same results as the per-slice segmentation"""
+    models = []
+    monkeypatch.setattr(spinalcordtoolbox.deepseg_sc.core, 'nn_architecture_seg',
+                        lambda **kwargs: models.append(DummyModel2d(**kwargs)) or models[-1])
+    data = np.random.RandomState(0).rand(16, 16, 7).astype(np.float32)
+    nii = nib.nifti1.Nifti1Image(data, np.eye(4))
+    img = Image(data, hdr=nii.header, dim=nii.header.get_data_shape())
+    seg = sct.deepseg_sc.core.segment_2d('model.h5', 't2', (16, 16), img, batch_size=batch_size)
+    assert seg.dtype == np.float32
+    for zz in range(data.shape[2]):
+        assert np.array_equal(seg[:, :, zz], np.tanh(data[:, :, zz] * np.arange(16)).astype(np.float32))
+    if batch_size is not None:
+        assert models[-1].n_calls == int(np.ceil(7 / batch_size))
+
+
+def test_scan_slice():
+    """All the blocks of the slice are predicted at once, without modifying the input slice"""
+    rng = np.random.RandomState(0)
+    patch_shape, z_out_dim = (8, 8), (20, 16)
+    # input slice is padded in the R-L direction so that it can be tiled by patches
+    z_slice = np.pad(rng.rand(*z_out_dim).astype(np.float32) * 255, ((0, 4), (0, 0)), 'constant')
+    z_slice[5:9, 3:7] = 1000
+    z_slice_in = z_slice.copy()
+    coord_lst = [[x * 8, y * 8, (x + 1) * 8, (y + 1) * 8] for y in range(2) for x in range(3)]
+    model = DummyModel2d()
+    model.predict = lambda x, batch_size=None: (x > 2).astype(np.float32)
+    z_slice_out, x_com, y_com, coord_lst_out = sct.deepseg_sc.core.scan_slice(
+        z_slice, model, 100, 200, list(coord_lst), patch_shape, z_out_dim)
+    assert np.array_equal(z_slice, z_slice_in)
+    assert np.array_equal(z_slice_out, ((z_slice_in - 100) / 200 > 2)[:20, :16])
+    assert (x_com, y_com) == (6, 4)
+    # block with the highest prediction is moved first
+    assert coord_lst_out[0] == [0, 0, 8, 8]
+    assert sorted(coord_lst_out) == sorted(coord_lst)
@@ -673,3 +673,22 @@ def test_sequences(fake_3dimage_sct):
      .save(path_b, mutable=True)
     assert img.absolutepath is not None
     assert img.absolutepath == os.path.abspath(path_b)
+
+
+@pytest.mark.parametrize('orientation', ['RAS', 'LPI', 'PIR', 'SAL'])
+def test_load_slab(tmp_path, orientation):
+    """Slab loaded from the file matches the slab of the full image, with the same geometry"""
+    data = np.random.RandomState(0).rand(7, 8, 9).astype(np.float32)
+    affine = np.diag([0.5, 0.8, 1.2, 1])
+    affine[:3, 3] = [-3, 4, 10]
+    im = msct_image.Image(data, hdr=nibabel.Nifti1Image(data, affine).header).change_orientation(orientation)
+    fname = str(tmp_path / 'image.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(im.data, im.hdr.get_best_affine()), fname)
+    im_rpi = msct_image.Image(fname).change_orientation('RPI')
+    im_slab = msct_image.load_slab(fname, 2, 6)
+    assert im_slab.orientation == 'RPI'
+    assert np.array_equal(im_slab.data, im_rpi.data[:, :, 2:6])
+    # First voxel of the slab is at the position of the first voxel of slice 2
+    assert np.allclose(im_slab.hdr.get_best_affine() @ [0, 0, 0, 1], im_rpi.hdr.get_best_affine() @ [0, 0, 2, 1])
+    with pytest.raises(ValueError):
+        msct_image.load_slab(fname, 5, 10)
@@ -11,11 +11,13 @@ import os
 import pytest
 import math
 import numpy as np
+from skimage import transform
 
 from spinalcordtoolbox.utils import __sct_dir__
 sys.path.append(os.path.join(__sct_dir__, 'scripts'))
 from spinalcordtoolbox import process_seg
 from spinalcordtoolbox.centerline.core import ParamCenterline
+from spinalcordtoolbox.resampling import resample_nib
 
 from spinalcordtoolbox.testing.create_test_data import dummy_segmentation
 
@@ -135,3 +137,95 @@ def test_compute_shape(im_seg, expected, params):
         else:
             expected_value = pytest.approx(expected[key], rel=0.05)
         assert obtained_value == expected_value
+
+
+@pytest.mark.parametrize('angle_corr', [False, True])
+def test_compute_shape_parallel(angle_corr):
+    im_seg = dummy_segmentation(size_arr=(64, 64, 20), shape='ellipse', radius_RL=13.0, radius_AP=5.0, angle_RL=-30.0,
+                                zeroslice=[5], debug=DEBUG)
+    metrics, _ = process_seg.compute_shape(im_seg, angle_correction=angle_corr, param_centerline=ParamCenterline(),
+                                           verbose=VERBOSE)
+    metrics_parallel, _ = process_seg.compute_shape(im_seg, angle_correction=angle_corr,
+                                                    param_centerline=ParamCenterline(), verbose=VERBOSE, n_jobs=2,
+                                                    chunksize=3)
+    assert metrics.keys() == metrics_parallel.keys()
+    for key in metrics:
+        np.testing.assert_array_equal(metrics[key].data, metrics_parallel[key].data)
+
+
+@pytest.mark.parametrize('params', [
+    {'shape': 'ellipse', 'radius_RL': 13.0, 'radius_AP': 5.0},
+    {'shape': 'ellipse', 'radius_RL': 13.0, 'radius_AP': 5.0, 'angle_IS': 30},
+    {'shape': 'ellipse', 'radius_RL': 13.0, 'radius_AP': 5.0, 'angle_RL': -30.0},
+    {'shape': 'rectangle', 'radius_RL': 13.0, 'radius_AP': 5.0},
+])
+def test_compute_shape_moments(params):
+    im_seg = dummy_segmentation(size_arr=(64, 64, 20), debug=DEBUG, **params)
+    angle_corr = 'angle_RL' in params
+    metrics, _ = process_seg.compute_shape(im_seg, angle_correction=angle_corr, param_centerline=ParamCenterline(),
+                                           verbose=VERBOSE)
+    metrics_moments, _ = process_seg.compute_shape(im_seg, angle_correction=angle_corr,
+                                                   param_centerline=ParamCenterline(), verbose=VERBOSE,
+                                                   method='moments')
+    for key in ['area', 'diameter_AP', 'diameter_RL', 'eccentricity', 'solidity', 'angle_AP', 'angle_RL', 'length']:
+        assert np.nanmean(metrics_moments[key].data) == pytest.approx(np.nanmean(metrics[key].data), rel=0.03)
+    assert np.nanmean(metrics_moments['orientation'].data) == \
+        pytest.approx(np.nanmean(metrics['orientation'].data), abs=0.5)
+
+
+@pytest.mark.parametrize('offset', [(0, 0), (37, 52)])
+def test_correct_angles(offset):
+    data = dummy_segmentation(size_arr=(40, 30, 6), shape='ellipse', radius_RL=8.0, radius_AP=5.0, angle_IS=20,
+                              orientation='RPI', debug=DEBUG).data
+    angles_AP, angles_RL = np.radians(np.linspace(-30, 30, 6)), np.radians(np.linspace(20, -10, 6))
+    data_scaled = process_seg._correct_angles(data, angles_AP, angles_RL, offset)
+    assert data_scaled.shape == data.shape
+    for iz in range(data.shape[2]):
+        # Reference: per-slice scaling about the origin of the full slice, with skimage (coordinates are (col, row))
+        scale = np.cos([angles_RL[iz], angles_AP[iz]])
+        offset_scaled = scale * np.array(offset[::-1])
+        tform = transform.AffineTransform(scale=scale, translation=offset_scaled - np.floor(offset_scaled))
+        patch = transform.warp(data[:, :, iz].astype(np.float64), tform.inverse, output_shape=data.shape[:2], order=1)
+        np.testing.assert_allclose(data_scaled[:, :, iz], patch, atol=1e-10)
+
+
+@pytest.mark.parametrize('minmax', [True, False])
+def test_compute_shape_crop(monkeypatch, minmax):
+    im_seg = dummy_segmentation(size_arr=(128, 100, 30), pixdim=(0.6, 0.9, 2), shape='ellipse', radius_RL=8.0,
+                                radius_AP=5.0, angle_AP=15.0, zeroslice=[0, 1, 29], debug=DEBUG)
+    metrics, fit_results = process_seg.compute_shape(im_seg, param_centerline=ParamCenterline(minmax=minmax),
+                                                     verbose=VERBOSE)
+    # Reference: resample the full image. The empty edge slices are part of the centerline fitting if minmax is False,
+    # so the results only match if they are not cropped.
+    monkeypatch.setattr(process_seg, '_resample_crop', lambda im, new_size, margin, crop_z: (
+        resample_nib(im, new_size=new_size, new_size_type='mm', interpolation='linear'), np.zeros(3, dtype=int)))
+    metrics_full, fit_results_full = process_seg.compute_shape(
+        im_seg, param_centerline=ParamCenterline(minmax=minmax), verbose=VERBOSE)
+    for key in metrics:
+        np.testing.assert_allclose(metrics[key].data, metrics_full[key].data, rtol=1e-9, atol=1e-9)
+    for key in ['xmean', 'xfit', 'ymean', 'yfit', 'zmean', 'zref']:
+        np.testing.assert_allclose(getattr(fit_results.data, key), getattr(fit_results_full.data, key), atol=1e-9)
+
+
+@pytest.mark.parametrize('offset', [(0, 0), (37, 52)])
+def test_correct_angles_borders(offset):
+    """Pixels near the borders of the patches are interpolated with the zeros outside of the patch"""
+    data = np.random.RandomState(0).rand(20, 15, 8)
+    angles_AP, angles_RL = np.radians(np.linspace(-35, 35, 8)), np.radians(np.linspace(25, -30, 8))
+    data_scaled = process_seg._correct_angles(data, angles_AP, angles_RL, offset)
+    data_pad = np.pad(data, ((1, 2), (1, 2), (0, 0)), 'constant')
+    for iz in range(data.shape[2]):
+        # Reference: explicit bilinear interpolation, with zeros outside of the patch
+        coord = []
+        for axis, angle in enumerate([angles_AP[iz], angles_RL[iz]]):
+            offset_scaled = np.cos(angle) * offset[axis]
+            coord.append((np.arange(data.shape[axis]) - (offset_scaled - np.floor(offset_scaled))) / np.cos(angle))
+        x, y = np.meshgrid(*coord, indexing='ij')
+        inside = (x > -1) & (x < data.shape[0]) & (y > -1) & (y < data.shape[1])
+        x0, y0 = np.floor(np.clip(x, -1, data.shape[0])), np.floor(np.clip(y, -1, data.shape[1]))
+        wx, wy = x - x0, y - y0
+        i, j = x0.astype(int) + 1, y0.astype(int) + 1
+        corners = [(1 - wx) * (1 - wy) * data_pad[i, j, iz], wx * (1 - wy) * data_pad[i + 1, j, iz],
+                   (1 - wx) * wy * data_pad[i, j + 1, iz], wx * wy * data_pad[i + 1, j + 1, iz]]
+        patch = np.sum(corners, axis=0) * inside
+        np.testing.assert_allclose(data_scaled[:, :, iz], patch, atol=1e-10)
@@ -7,10 +7,18 @@ from __future__ import absolute_import
 
 import os, sys
 
+import numpy as np
+import nibabel
+
 from spinalcordtoolbox.utils import __sct_dir__
 sys.path.append(os.path.join(__sct_dir__, 'scripts'))
-from spinalcordtoolbox.straightening import SpinalCordStraightener
+from spinalcordtoolbox.straightening import SpinalCordStraightener, StraighteningCache, get_straightening_params, \
+    _compute_straightening_accuracy, _create_warp_file, _compress_file
+from spinalcordtoolbox.centerline.core import ParamCenterline
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.testing.create_test_data import dummy_centerline
 import sct_utils as sct
+import sct_straighten_spinalcord
 from spinalcordtoolbox.utils import sct_test_path
 
 VERBOSE = 0  # Set to 2 to save images, 0 otherwise
@@ -26,3 +34,89 @@ def test_straighten():
     sc_straight.straighten()
     assert sc_straight.mse_straightening < 0.8
     assert sc_straight.max_distance_straightening < 1.2
+
+
+def test_straightening_cache(tmp_path):
+    """Test population, retrieval and LRU pruning of the straightening cache"""
+    path_src, path_dest = tmp_path / 'src', tmp_path / 'dest'
+    path_src.mkdir()
+    path_dest.mkdir()
+    img_ctl = dummy_centerline(size_arr=(30, 20, 50))[0]
+    img_ctl.save(str(path_src / 'ctl.nii.gz'))
+    img_ctl.save(str(path_src / 'ctl_copy.nii'))
+    for fname in StraighteningCache.files:
+        (path_src / fname).write_bytes(os.urandom(1024 * 300))
+
+    cache = StraighteningCache(path=str(tmp_path / 'cache'), size_max=1)
+    key = cache.key(str(path_src / 'ctl.nii.gz'), params={'precision': 2.0})
+    # The key only depends on the image content and parameters
+    assert key == cache.key(str(path_src / 'ctl_copy.nii'), params={'precision': 2.0})
+    assert key != cache.key(str(path_src / 'ctl.nii.gz'), params={'precision': 4.0})
+    assert not cache.fetch(key, str(path_dest))
+    cache.store(key, str(path_src))
+    assert cache.fetch(key, str(path_dest))
+    for fname in StraighteningCache.files:
+        assert (path_dest / fname).read_bytes() == (path_src / fname).read_bytes()
+    # Storing a second entry exceeds the maximum size, so the least recently used entry is removed
+    key_other = cache.key(str(path_src / 'ctl.nii.gz'), params={'precision': 4.0})
+    cache.store(key_other, str(path_src))
+    assert not cache.fetch(key, str(path_dest))
+    assert cache.fetch(key_other, str(path_dest))
+
+
+def test_get_straightening_params():
+    """Test that straightenings configured identically by different tools get the same parameters"""
+    parser = sct_straighten_spinalcord.get_parser()
+    # Parameters which only change the output file names or the interpolation of the input image are not relevant
+    params = get_straightening_params(sct_straighten_spinalcord.get_straightener(
+        parser.parse_args(['-i', 'data.nii', '-s', 'seg.nii', '-r', '0', '-o', 'out.nii', '-x', 'nn'])))
+    sc_straight = SpinalCordStraightener('other.nii', 'seg.nii',
+                                         param_centerline=ParamCenterline(algo_fitting='nurbs', smooth=10))
+    sc_straight.xy_size = 35
+    sc_straight.speed_factor = 1
+    assert get_straightening_params(sc_straight) == params
+    assert get_straightening_params(sct_straighten_spinalcord.get_straightener(
+        parser.parse_args(['-i', 'data.nii', '-s', 'seg.nii', '-centerline-algo', 'bspline']))) != params
+    assert get_straightening_params(sct_straighten_spinalcord.get_straightener(
+        parser.parse_args(['-i', 'data.nii', '-s', 'seg.nii', '-xy-size', '40']))) != params
+
+
+def test_compute_straightening_accuracy():
+    """Test accuracy metrics against a per-slice reference computation"""
+    data = np.zeros((21, 21, 30))
+    rng = np.random.RandomState(0)
+    for z in range(3, 27):
+        if z == 10:
+            continue  # empty slice
+        x, y = 10 + rng.randint(-2, 3), 10 + rng.randint(-2, 3)
+        data[x, y, z], data[x + 1, y, z] = 1, rng.uniform(0.5, 2)
+    img = Image(data, hdr=nibabel.Nifti1Image(data, np.diag([0.5, 0.8, 1, 1])).header)
+    mse, max_dist = _compute_straightening_accuracy(img)
+    # Reference: weighted centroid of each slice between the first and last nonzero slices (last one excluded)
+    dist = []
+    for z in range(3, 26):
+        x, y = np.nonzero(data[..., z])
+        if len(x):
+            w = data[x, y, z]
+            x_mean, y_mean = np.sum(x * w) / np.sum(w), np.sum(y * w) / np.sum(w)
+            dist.append(((10.5 - x_mean) * 0.5) ** 2 + ((10.5 - y_mean) * 0.8) ** 2)
+    dist = np.array(dist[2:-2])
+    assert np.isclose(mse, np.sqrt(np.mean(dist)))
+    assert np.isclose(max_dist, np.sqrt(dist.max()))
+
+
+def test_create_warp_file(tmp_path):
+    """Test that warping fields written by slabs into a memory-mapped file are read back identically"""
+    nii = nibabel.Nifti1Image(np.zeros((7, 5, 9)), np.diag([0.5, 1, 2, 1]))
+    data_warp = np.random.RandomState(0).rand(7, 5, 9, 1, 3).astype(np.float32)
+    fname = str(tmp_path / 'warp.nii')
+    data_mmap = _create_warp_file(fname, nii.header, nii.shape)
+    for z in range(0, 9, 4):
+        data_mmap[:, :, z:z + 4] = data_warp[:, :, z:z + 4]
+    data_mmap.flush()
+    del data_mmap
+    _compress_file(fname, fname + '.gz')
+    nii_warp = nibabel.load(fname + '.gz')
+    assert nii_warp.header.get_intent()[0] == 'vector'
+    assert np.allclose(nii_warp.affine, nii.affine)
+    assert np.array_equal(np.asanyarray(nii_warp.dataobj), data_warp)
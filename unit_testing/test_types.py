@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.types
+
+from __future__ import absolute_import
+
+import pytest
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.types import Centerline
+
+
+def dummy_centerline_phys(nb_points=200, amplitude=5.0, offset_z=0.0, disks=None):
+    """
+    Create a Centerline object in physical space, curved in the x-z plane, with optional intervertebral disks.
+
+    :param disks: list of (index, label): position of each disk along the centerline
+    """
+    z = np.linspace(0, 100, nb_points) + offset_z
+    x, y = amplitude * np.sin(z / 30.), np.zeros(nb_points)
+    centerline = Centerline(x, y, z, np.gradient(x), np.gradient(y), np.gradient(z))
+    if disks is not None:
+        centerline.compute_vertebral_distribution([[x[i], y[i], z[i], label] for i, label in disks])
+    return centerline
+
+
+@pytest.mark.parametrize('mode', ['levels', 'length'])
+def test_get_closest_to_absolute_positions(mode):
+    centerline = dummy_centerline_phys(disks=[(180, 2), (140, 3), (100, 4), (60, 5), (20, 6)])
+    centerline_ref = dummy_centerline_phys(nb_points=200, amplitude=0, offset_z=3,
+                                           disks=[(170, 2), (130, 3), (105, 4), (50, 5), (15, 6)])
+    relative_positions = centerline.dist_points if mode == 'length' else centerline.dist_points_rel
+    indexes = centerline_ref.get_closest_to_absolute_positions(
+        centerline.l_points, relative_positions, backup_indexes=np.arange(centerline.number_of_points),
+        backup_centerline=centerline_ref, mode=mode)
+    for i in range(centerline.number_of_points):
+        index = centerline_ref.get_closest_to_absolute_position(
+            centerline.l_points[i], relative_positions[i], backup_index=i, backup_centerline=centerline_ref,
+            mode=mode)
+        assert indexes[i] == (-1 if index is None else index)
+
+
+def test_centerline_coordinate_systems():
+    centerline = dummy_centerline_phys()
+    coordinate_system, plans_parameters = centerline.coordinate_system, centerline.plans_parameters
+    assert len(coordinate_system) == len(plans_parameters) == centerline.number_of_points
+    assert np.isclose(centerline.length, np.sum(np.linalg.norm(np.diff(centerline.points, axis=0), axis=1)))
+    assert np.allclose(centerline.incremental_length, np.cumsum(centerline.progressive_length))
+    for i in range(centerline.number_of_points):
+        for axis_batch, axis in zip(coordinate_system[i], centerline.compute_coordinate_system(i)):
+            assert np.allclose(axis_batch, axis)
+        assert np.allclose(plans_parameters[i], centerline.get_plan_parameters(i))
+
+
+def test_extract_perpendicular_squares():
+    centerline = dummy_centerline_phys(nb_points=50)
+    data = np.random.RandomState(0).rand(40, 30, 60)
+    affine = np.diag([0.8, 0.9, 2, 1])
+    affine[:3, 3] = [-15, -12, -5]
+    image = Image(data, hdr=nibabel.Nifti1Image(data, affine).header)
+    squares = centerline.extract_perpendicular_squares(image, size=5, resolution=0.5, interpolation_mode=1)
+    assert squares.shape == (50, 20, 20)
+    assert np.array_equal(squares, centerline.extract_perpendicular_squares(image, size=5, resolution=0.5,
+                                                                            interpolation_mode=1, chunk_size=7))
+    for index in [0, 25, 49]:
+        assert np.array_equal(squares[index], centerline.extract_perpendicular_square(image, index, size=5,
+                                                                                      interpolation_mode=1))
+    # Center of the squares is the centerline point
+    point_vox = np.linalg.inv(affine) @ np.append(centerline.points[25], 1)
+    assert np.isclose(squares[25, 10, 10], image.get_values(point_vox[:3, np.newaxis], interpolation_mode=1)[0])
+
+
+def test_average_coordinates_over_slices():
+    data = np.zeros((20, 20, 10))
+    image = Image(data, hdr=nibabel.Nifti1Image(data, np.eye(4)).header)
+    # two points on slice 1, no point on slices 2 and 3
+    x, z = np.array([0., 2., 4., 8., 9.]), np.array([0., 1., 1., 4., 5.])
+    centerline = Centerline(x, np.zeros(5), z, np.ones(5), np.zeros(5), np.ones(5))
+    x_mean, y_mean, z_mean, _, _, _ = centerline.average_coordinates_over_slices(image)
+    assert len(z_mean) == 6
+    # missing slices are interpolated from the previous slice and the next point
+    x_2, z_2 = 4. / 3 + 8. * 2 / 3, 1. / 3 + 4. * 2 / 3
+    assert np.allclose(x_mean, [0, 3, x_2, x_2 / 2 + 8. / 2, 8, 9])
+    assert np.allclose(z_mean, [0, 1, z_2, z_2 / 2 + 4. / 2, 4, 5])
+    assert np.allclose(y_mean, 0)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.registration.warp
+
+from __future__ import absolute_import
+
+import pytest
+import numpy as np
+import nibabel
+from scipy.ndimage import map_coordinates
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.registration.warp import OUTSIDE_VALUE, create_warp_image, invert_warp, warp2ras
+
+
+def dummy_warp(size_arr=(20, 22, 24), pixdim=(1, 1, 2), amplitude=1.5):
+    """
+    Create a smooth, invertible displacement field (ITK convention) with an anisotropic, shifted grid.
+    """
+    affine = np.diag(list(pixdim) + [1])
+    affine[:3, 3] = [-5, 3, -12]
+    data_ref = np.zeros(size_arr)
+    nii = nibabel.nifti1.Nifti1Image(data_ref, affine)
+    im_ref = Image(data_ref, hdr=nii.header)
+    x, y, z = np.mgrid[0:size_arr[0], 0:size_arr[1], 0:size_arr[2]]
+    data = np.zeros(size_arr + (1, 3), dtype=np.float32)
+    data[..., 0, 0] = amplitude * np.sin(2 * np.pi * z / size_arr[2])
+    data[..., 0, 1] = amplitude * np.cos(2 * np.pi * x / size_arr[0])
+    data[..., 0, 2] = amplitude * np.sin(2 * np.pi * y / size_arr[1])
+    return create_warp_image(im_ref, data)
+
+
+def test_invert_warp():
+    im_warp = dummy_warp()
+    im_inv = invert_warp(im_warp, max_iter=50, tolerance=1e-4, chunk_size=5, verbose=0)
+    assert im_inv.data.shape == im_warp.data.shape
+    assert im_inv.data.dtype == np.float32
+    # Composition x -> x + u(x) -> x + u(x) + v(x + u(x)) should be the identity, away from the borders
+    affine = im_warp.hdr.get_best_affine()
+    fwd, inv = warp2ras(im_warp.data), warp2ras(im_inv.data)
+    nx, ny, nz = im_warp.data.shape[:3]
+    indexes = np.mgrid[4:nx - 4, 4:ny - 4, 4:nz - 4].reshape(3, -1)
+    coord = affine[:3, :3] @ indexes + affine[:3, 3:]
+    coord_warped = coord + fwd[:, indexes[0], indexes[1], indexes[2]]
+    indexes_warped = np.linalg.inv(affine[:3, :3]) @ (coord_warped - affine[:3, 3:])
+    disp_inv = np.stack([map_coordinates(inv[i], indexes_warped, order=1) for i in range(3)])
+    assert np.max(np.abs(coord_warped + disp_inv - coord)) < 0.1
+
+
+def test_invert_warp_outside():
+    im_warp = dummy_warp()
+    im_warp.data[0:3] = OUTSIDE_VALUE
+    im_inv = invert_warp(im_warp, verbose=0)
+    assert np.all(im_inv.data[0:2] == OUTSIDE_VALUE)
+    assert np.all(np.abs(im_inv.data[8:-4, 4:-4, 4:-4]) < OUTSIDE_VALUE)
+
+
+@pytest.mark.parametrize('kwargs', [{'max_iter': 0}, {'chunk_size': 0}])
+def test_invert_warp_invalid(kwargs):
+    with pytest.raises(ValueError):
+        invert_warp(dummy_warp(), verbose=0, **kwargs)